@@ -1,115 +1,381 @@
 #!/usr/bin/env python3
 """
-Performance Benchmark Script
-Measures execution time and efficiency of multiprocessing
+Performance Benchmark Suite
+
+Self-contained: generates synthetic ECOSTRESS scenes, a MapBiomas coverage
+raster and a buffer shapefile in a temporary folder, points `config` at it and
+times every stage of the pipeline:
+
+- load / mask / regrid / write: per scene, in-process, for each regrid engine
+- engines: the mean of every scene, each engine against the first one
+  (including a scene in EPSG:4326, not the template CRS)
+- pipeline: main.process_single_file() end to end, per engine, execution
+  backend and worker count
+- extract: extract_to_csv.main(), per execution backend and worker count
+- plot: one validation figure (generate_plot) and the batch renderer per scene
+
+Results are written as JSON so runs can be compared across commits:
+
+    python -m src.regrid_project.benchmark --scenes 8 --workers 1 4 --output bench.json
+    python -m src.regrid_project.benchmark --output new.json --compare bench.json
 """
 
 import os
-import time
 import sys
+import io
+import json
+import time
+import glob
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import numpy as np
+import rasterio
+import geopandas as gpd
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+from src.regrid_project import config
 
-def benchmark_main_processing():
-    """Benchmark main.py execution"""
-    print("\n" + "="*60)
-    print("BENCHMARKING: main.py (Regridding)")
-    print("="*60)
-    
-    start_time = time.time()
-    exit_code = os.system("python main.py")
-    end_time = time.time()
-    
-    elapsed_time = end_time - start_time
-    print(f"\nExecution time: {elapsed_time:.2f} seconds ({elapsed_time/60:.2f} minutes)")
-    
-    return elapsed_time, exit_code == 0
-
-def benchmark_csv_extraction():
-    """Benchmark extract_to_csv.py execution"""
-    print("\n" + "="*60)
-    print("BENCHMARKING: extract_to_csv.py (CSV Extraction)")
-    print("="*60)
-    
-    start_time = time.time()
-    exit_code = os.system("python extract_to_csv.py")
-    end_time = time.time()
-    
-    elapsed_time = end_time - start_time
-    print(f"\nExecution time: {elapsed_time:.2f} seconds ({elapsed_time/60:.2f} minutes)")
-    
-    return elapsed_time, exit_code == 0
-
-def benchmark_plot_generation():
-    """Benchmark plot_results.py execution"""
-    print("\n" + "="*60)
-    print("BENCHMARKING: plot_results.py (Plot Generation)")
-    print("="*60)
-    
-    start_time = time.time()
-    exit_code = os.system("python plot_results.py")
-    end_time = time.time()
-    
-    elapsed_time = end_time - start_time
-    print(f"\nExecution time: {elapsed_time:.2f} seconds ({elapsed_time/60:.2f} minutes)")
-    
-    return elapsed_time, exit_code == 0
-
-def print_summary(results):
-    """Print benchmark summary"""
+SITE_NAME = "BENCH"
+SITE_CENTER = (-59.0, -2.14)  # lon, lat (ATTO region, UTM 21S)
+FIXTURE_YEAR = 2019
+ECOSTRESS_RES = 70.0
+MAPBIOMAS_RES = 0.00027  # ~30 m in degrees
+ECOSTRESS_RES_DEG = 0.00063  # ~70 m, for the scene delivered in EPSG:4326
+
+def make_fixtures(workdir, scenes=4, variables=("LST",), buffer_km=30.0, nan_fraction=0.2, seed=0,
+                  geographic_scenes=1):
+    """
+    Create the synthetic inputs under `workdir` and point config at them.
+    `geographic_scenes` extra scenes per variable are written in EPSG:4326, so
+    the regrid runs on a source grid that is not the template's (bincount falls
+    back to the GDAL warp there).
+
+    Returns:
+        dict: Fixture description (sizes and paths) stored with the results
+    """
+    rng = np.random.default_rng(seed)
+    config.BASE_PATH = workdir
+    config.PATH_MAPBIOMAS_DIR = os.path.join(workdir, "Coverage_mapbiomas")
+    config.PATH_MAPBIOMAS_CUT = os.path.join(workdir, "Coverage_mapbiomas_cut")
+    config.PATH_MAPBIOMAS_MANIFEST = os.path.join(config.PATH_MAPBIOMAS_CUT, "manifest.json")
+    config.PATH_MASK_CACHE = os.path.join(workdir, "Cache_forest_masks")
+    config.OUTPUT_ROOT = os.path.join(workdir, "Output_Regrid_OCO3_Multi")
+    config.VARIABLES = list(variables)
+
+    # 1. Buffer shapefile (circle around the site centre)
+    center = gpd.GeoSeries([Point(*SITE_CENTER)], crs="EPSG:4326").to_crs("EPSG:32721")
+    buffer_utm = center.buffer(buffer_km * 1000.0)
+    shp_dir = os.path.join(workdir, "Buffers", f"{SITE_NAME}_buffer")
+    os.makedirs(shp_dir, exist_ok=True)
+    shp_path = os.path.join(shp_dir, f"buffer_{SITE_NAME}.shp")
+    gpd.GeoDataFrame(geometry=buffer_utm.to_crs("EPSG:4326")).to_file(shp_path)
+    config.SITES = {SITE_NAME: shp_path}
+
+    # 2. ECOSTRESS scenes (70 m, UTM 21S, NaN gaps), one folder per variable
+    minx, miny, maxx, maxy = buffer_utm.total_bounds
+    x0 = np.floor(minx / ECOSTRESS_RES) * ECOSTRESS_RES - 5 * ECOSTRESS_RES
+    y0 = np.ceil(maxy / ECOSTRESS_RES) * ECOSTRESS_RES + 5 * ECOSTRESS_RES
+    width = int((maxx - minx) / ECOSTRESS_RES) + 10
+    height = int((maxy - miny) / ECOSTRESS_RES) + 10
+    for var_name in variables:
+        folder = os.path.join(workdir, "Rasters_buffers_data", f"{var_name}_{SITE_NAME}_ECOSTRESS")
+        os.makedirs(folder, exist_ok=True)
+        for i in range(scenes):
+            data = (300 + rng.normal(0, 5, (height, width))).astype(np.float32)
+            data[rng.random((height, width)) < nan_fraction] = np.nan
+            path = os.path.join(folder, f"ECO_{var_name}_doy{FIXTURE_YEAR}{i + 1:03d}120000_bench.tif")
+            with rasterio.open(path, 'w', driver='GTiff', width=width, height=height, count=1,
+                               dtype='float32', crs="EPSG:32721", nodata=np.nan, tiled=True,
+                               transform=from_origin(x0, y0, ECOSTRESS_RES, ECOSTRESS_RES)) as dst:
+                dst.write(data, 1)
+        for i in range(scenes, scenes + geographic_scenes):
+            lon_min, lat_min, lon_max, lat_max = buffer_utm.to_crs("EPSG:4326").total_bounds
+            geo_width = int((lon_max - lon_min) / ECOSTRESS_RES_DEG) + 10
+            geo_height = int((lat_max - lat_min) / ECOSTRESS_RES_DEG) + 10
+            data = (300 + rng.normal(0, 5, (geo_height, geo_width))).astype(np.float32)
+            data[rng.random((geo_height, geo_width)) < nan_fraction] = np.nan
+            path = os.path.join(folder, f"ECO_{var_name}_doy{FIXTURE_YEAR}{i + 1:03d}120000_bench.tif")
+            with rasterio.open(path, 'w', driver='GTiff', width=geo_width, height=geo_height, count=1,
+                               dtype='float32', crs="EPSG:4326", nodata=np.nan, tiled=True,
+                               transform=from_origin(lon_min - 5 * ECOSTRESS_RES_DEG, lat_max + 5 * ECOSTRESS_RES_DEG,
+                                                     ECOSTRESS_RES_DEG, ECOSTRESS_RES_DEG)) as dst:
+                dst.write(data, 1)
+
+    # 3. Pre-cut MapBiomas coverage (EPSG:4326, mostly forest class 3)
+    lon_min, lat_min, lon_max, lat_max = buffer_utm.to_crs("EPSG:4326").total_bounds
+    mb_width = int((lon_max - lon_min) / MAPBIOMAS_RES) + 10
+    mb_height = int((lat_max - lat_min) / MAPBIOMAS_RES) + 10
+    classes = rng.choice(np.array([3, 12, 15, 33], dtype=np.uint8), size=(mb_height, mb_width),
+                         p=[0.8, 0.08, 0.07, 0.05])
+    cut_dir = os.path.join(config.PATH_MAPBIOMAS_CUT, SITE_NAME)
+    os.makedirs(cut_dir, exist_ok=True)
+    with rasterio.open(os.path.join(cut_dir, f"{FIXTURE_YEAR}_coverage_{SITE_NAME}.tif"), 'w',
+                       driver='GTiff', width=mb_width, height=mb_height, count=1, dtype='uint8',
+                       crs="EPSG:4326", nodata=0, tiled=True,
+                       transform=from_origin(lon_min - 5 * MAPBIOMAS_RES, lat_max + 5 * MAPBIOMAS_RES,
+                                             MAPBIOMAS_RES, MAPBIOMAS_RES)) as dst:
+        dst.write(classes, 1)
+
+    return {
+        'scenes_per_variable': scenes,
+        'geographic_scenes_per_variable': geographic_scenes,
+        'variables': list(variables),
+        'buffer_km': buffer_km,
+        'ecostress_shape': [height, width],
+        'mapbiomas_shape': [mb_height, mb_width],
+    }
+
+def _quiet(function, *args, **kwargs):
+    """Run a pipeline function with its per-file prints silenced."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+def _record(results, stage, seconds, **fields):
+    entry = {'stage': stage, 'seconds': round(seconds, 4)}
+    entry.update(fields)
+    results.append(entry)
+    details = ", ".join(f"{k}={v}" for k, v in fields.items())
+    print(f"   {stage:<9} {seconds:8.3f}s  {details}")
+
+def benchmark_stages(results, engines):
+    """Per-scene load / mask / regrid / write timings, in-process, for each engine."""
+    from src.regrid_project import ecostress_handler as eco_h
+    from src.regrid_project import mapbiomas_handler as mb_h
+    from src.regrid_project.main import load_site_buffer
+
+    gdf_buffer = load_site_buffer(SITE_NAME, config.SITES[SITE_NAME])
+    files = sorted(glob.glob(os.path.join(config.BASE_PATH, "Rasters_buffers_data", "*", "*.tif")))
+    out_dir = os.path.join(config.BASE_PATH, "stage_outputs")
+    os.makedirs(out_dir, exist_ok=True)
+
+    for engine in engines:
+        timings = {'load': 0.0, 'mask': 0.0, 'regrid': 0.0, 'write': 0.0}
+        for filepath in files:
+            start = time.perf_counter()
+            eco_da = _quiet(eco_h.load_ecostress, filepath, gdf_buffer)
+            timings['load'] += time.perf_counter() - start
+
+            # Uncached, so the MapBiomas read + reprojection is what is measured
+            start = time.perf_counter()
+            mask = _quiet(mb_h.create_forest_mask, eco_da, FIXTURE_YEAR, gdf_buffer, use_cache=False)
+            timings['mask'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = _quiet(eco_h.apply_mask_and_regrid_centered, eco_da, mask, gdf_buffer, engine=engine)
+            timings['regrid'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            result.rio.to_raster(os.path.join(out_dir, os.path.basename(filepath)))
+            timings['write'] += time.perf_counter() - start
+
+        for stage, seconds in timings.items():
+            _record(results, stage, seconds, engine=engine, workers=1, files=len(files),
+                    per_file=round(seconds / len(files), 4))
+
+def check_engines(results, engines):
+    """
+    Regrid every scene with each engine and compare the means with the first
+    engine's (float tolerance, same NaN cells). Returns True when all agree.
+    """
+    from src.regrid_project import ecostress_handler as eco_h
+    from src.regrid_project import mapbiomas_handler as mb_h
+    from src.regrid_project.main import load_site_buffer
+
+    gdf_buffer = load_site_buffer(SITE_NAME, config.SITES[SITE_NAME])
+    files = sorted(glob.glob(os.path.join(config.BASE_PATH, "Rasters_buffers_data", "*", "*.tif")))
+    reference, others = engines[0], engines[1:]
+    all_agree = True
+    for filepath in files:
+        eco_da = _quiet(eco_h.load_ecostress, filepath, gdf_buffer)
+        mask = _quiet(mb_h.create_forest_mask, eco_da, FIXTURE_YEAR, gdf_buffer)
+        start = time.perf_counter()
+        expected = _quiet(eco_h.apply_mask_and_regrid_centered, eco_da, mask, gdf_buffer, engine=reference).values
+        for engine in others:
+            got = _quiet(eco_h.apply_mask_and_regrid_centered, eco_da, mask, gdf_buffer, engine=engine).values
+            nan_mismatch = int(np.count_nonzero(np.isnan(expected) != np.isnan(got)))
+            both = ~np.isnan(expected) & ~np.isnan(got)
+            max_abs_diff = float(np.max(np.abs(expected[both] - got[both]))) if both.any() else 0.0
+            agree = nan_mismatch == 0 and np.allclose(expected[both], got[both], rtol=1e-5, atol=1e-4)
+            all_agree &= agree
+            _record(results, "engines", time.perf_counter() - start, engine=engine, reference=reference,
+                    scene=os.path.basename(filepath), crs=str(eco_da.rio.crs), agree=bool(agree),
+                    max_abs_diff=round(max_abs_diff, 6), nan_mismatch=nan_mismatch)
+    if not all_agree:
+        print(f"   [WARNING] Regrid engines disagree with '{reference}' on some scenes")
+    return all_agree
+
+def _reset_caches():
+    """Empty the in-process caches, so a thread-pool run starts as cold as fresh worker processes."""
+    from src.regrid_project import ecostress_handler as eco_h
+    from src.regrid_project import mapbiomas_handler as mb_h
+
+    eco_h._SITE_CONTEXT_CACHE.clear()
+    eco_h._INDEX_MAP_CACHE.clear()
+    mb_h._MASK_CACHE.clear()
+
+def benchmark_pipeline(results, engines, worker_counts, backends):
+    """main.process_single_file() end to end, per engine, backend and worker count."""
+    from src.regrid_project import main as pipeline
+
+    config.BUILD_MANIFEST = False
+    n_files = len(glob.glob(os.path.join(config.BASE_PATH, "Rasters_buffers_data", "*", "*.tif")))
+    for engine in engines:
+        for backend in backends:
+            for workers in worker_counts:
+                shutil.rmtree(config.OUTPUT_ROOT, ignore_errors=True)
+                os.makedirs(config.OUTPUT_ROOT, exist_ok=True)
+                _reset_caches()
+                config.REGRID_ENGINE = engine
+                config.EXECUTION_BACKEND = backend
+                config.NUM_WORKERS = workers
+                start = time.perf_counter()
+                _quiet(pipeline.process_single_file)
+                seconds = time.perf_counter() - start
+                written = len(glob.glob(os.path.join(config.OUTPUT_ROOT, SITE_NAME, "*", "*.tif")))
+                _record(results, "pipeline", seconds, engine=engine, backend=backend, workers=workers,
+                        files=n_files, outputs=written)
+
+def benchmark_extract(results, worker_counts, backends):
+    """extract_to_csv.main() over the outputs of the last pipeline run."""
+    from src.regrid_project import extract_to_csv
+
+    for backend in backends:
+        for workers in worker_counts:
+            config.EXECUTION_BACKEND = backend
+            config.NUM_WORKERS = workers
+            start = time.perf_counter()
+            _quiet(extract_to_csv.main)
+            _record(results, "extract", time.perf_counter() - start, backend=backend, workers=workers,
+                    table_format=config.TABLE_FORMAT)
+
+def benchmark_plot(results):
+    """One full validation figure and the batch renderer over all scenes of a variable."""
+    import matplotlib
+    matplotlib.use("Agg")
+    from src.regrid_project import plot_results
+
+    plot_dir = os.path.join(config.BASE_PATH, "Validation_plots")
+    os.makedirs(plot_dir, exist_ok=True)
+    var_name = config.VARIABLES[0]
+    files = sorted(glob.glob(os.path.join(config.BASE_PATH, "Rasters_buffers_data",
+                                          f"{var_name}_{SITE_NAME}_ECOSTRESS", "*.tif")))
+
+    start = time.perf_counter()
+    _quiet(plot_results.generate_plot, SITE_NAME, var_name, files[0], config.SITES[SITE_NAME], plot_dir)
+    _record(results, "plot", time.perf_counter() - start, mode="single", files=1)
+
+    start = time.perf_counter()
+    _quiet(plot_results.render_all_scenes, SITE_NAME, var_name, files, config.SITES[SITE_NAME], plot_dir)
+    seconds = time.perf_counter() - start
+    _record(results, "plot", seconds, mode="batch", files=len(files), per_file=round(seconds / len(files), 4))
+
+def git_commit():
+    """Current commit of the repository (None outside a git checkout)."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+MEASUREMENTS = ('seconds', 'per_file', 'outputs', 'files', 'agree', 'max_abs_diff', 'nan_mismatch')
+
+def result_key(entry):
+    """Identity of a result across runs (everything but the measurements)."""
+    return tuple(sorted((k, v) for k, v in entry.items() if k not in MEASUREMENTS))
+
+def compare(current, baseline_path):
+    """Print the time ratio of every result also present in a previous run."""
+    with open(baseline_path) as f:
+        baseline = {result_key(entry): entry for entry in json.load(f)['results']}
     print("\n" + "="*60)
-    print("BENCHMARK SUMMARY")
-    print("="*60)
-    
-    total_time = 0
-    for i, (name, elapsed, success) in enumerate(results, 1):
-        status = "✓ SUCCESS" if success else "✗ FAILED"
-        minutes, seconds = divmod(elapsed, 60)
-        print(f"{i}. {name}")
-        print(f"   Time: {minutes:.0f}m {seconds:.1f}s ({elapsed:.2f}s)")
-        print(f"   Status: {status}\n")
-        total_time += elapsed
-    
-    minutes, seconds = divmod(total_time, 60)
-    print(f"Total execution time: {minutes:.0f}m {seconds:.1f}s ({total_time:.2f}s)")
-    print(f"CPU cores available: {os.cpu_count()}")
+    print(f"COMPARISON WITH {baseline_path}")
     print("="*60)
+    for entry in current['results']:
+        old = baseline.get(result_key(entry))
+        if old is None:
+            continue
+        # Per-file times stay comparable when the fixture size changed
+        metric = 'per_file' if 'per_file' in entry and 'per_file' in old else 'seconds'
+        if not old[metric]:
+            continue
+        ratio = entry[metric] / old[metric]
+        flag = "  <-- slower" if ratio > 1.10 else ""
+        label = ", ".join(f"{k}={v}" for k, v in entry.items() if k not in MEASUREMENTS and k != 'stage')
+        print(f"   {entry['stage']:<9} {old[metric]:8.3f}s -> {entry[metric]:8.3f}s  x{ratio:5.2f}  "
+              f"{metric}  {label}{flag}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Regrid pipeline benchmark on synthetic data")
+    parser.add_argument("--scenes", type=int, default=4, help="Scenes per variable")
+    parser.add_argument("--variables", nargs="+", default=["LST"], help="Variables to generate")
+    parser.add_argument("--buffer-km", type=float, default=30.0, help="Buffer radius (scene size)")
+    parser.add_argument("--engines", nargs="+", default=["gdal", "bincount"], help="Regrid engines")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, os.cpu_count() or 1],
+                        help="Worker counts for the pipeline and extraction")
+    parser.add_argument("--backends", nargs="+", default=["process", "thread"],
+                        help="Execution backends for the pipeline and extraction")
+    parser.add_argument("--stages", nargs="+", default=["stages", "engines", "pipeline", "extract", "plot"],
+                        help="Benchmark groups to run")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file")
+    parser.add_argument("--compare", help="Previous JSON results to compare against")
+    parser.add_argument("--workdir", help="Fixture folder (default: temporary, removed at the end)")
+    args = parser.parse_args(argv)
 
-def main():
     print("\n" + "="*60)
     print("REGRID PROJECT - PERFORMANCE BENCHMARK")
     print("="*60)
     print(f"System CPU cores: {os.cpu_count()}")
-    print(f"Current directory: {os.getcwd()}")
-    
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="regrid_bench_")
+    worker_counts = sorted(set(args.workers))
     results = []
-    
-    # Run benchmarks
-    try:
-        elapsed, success = benchmark_main_processing()
-        results.append(("main.py (Regridding)", elapsed, success))
-    except Exception as e:
-        print(f"Error running benchmark: {e}")
-        results.append(("main.py (Regridding)", 0, False))
-    
-    try:
-        elapsed, success = benchmark_csv_extraction()
-        results.append(("extract_to_csv.py (CSV Extraction)", elapsed, success))
-    except Exception as e:
-        print(f"Error running benchmark: {e}")
-        results.append(("extract_to_csv.py (CSV Extraction)", 0, False))
-    
+    fixtures = None
+    engines_agree = True
     try:
-        elapsed, success = benchmark_plot_generation()
-        results.append(("plot_results.py (Plot Generation)", elapsed, success))
-    except Exception as e:
-        print(f"Error running benchmark: {e}")
-        results.append(("plot_results.py (Plot Generation)", 0, False))
-    
-    # Print summary
-    print_summary(results)
-    
-    # Determine exit code
-    all_success = all(success for _, _, success in results)
-    return 0 if all_success else 1
+        print(f"Generating fixtures in {workdir} ...")
+        fixtures = make_fixtures(workdir, args.scenes, args.variables, args.buffer_km)
+        print(f"   {fixtures}")
+
+        if "stages" in args.stages:
+            print("\nStages (per scene, in-process):")
+            benchmark_stages(results, args.engines)
+        if "engines" in args.stages and len(args.engines) > 1:
+            print("\nEngine equivalence (mean per cell vs the first engine):")
+            engines_agree = check_engines(results, args.engines)
+        if "pipeline" in args.stages or "extract" in args.stages:
+            print("\nPipeline (main.py):")
+            benchmark_pipeline(results, args.engines, worker_counts, args.backends)
+        if "extract" in args.stages:
+            print("\nExtraction (extract_to_csv.py):")
+            benchmark_extract(results, worker_counts, args.backends)
+        if "plot" in args.stages:
+            print("\nPlots (plot_results.py):")
+            benchmark_plot(results)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'fixtures': fixtures,
+        'results': results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(report, args.compare)
+    # Non-zero exit when the engines give different results
+    return 0 if engines_agree else 1
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+Incremental build manifest for the regrid outputs.
+
+For every output GeoTIFF, `OUTPUT_ROOT/build_manifest.json` stores:
+- the fingerprint of each input (ECOSTRESS file and MapBiomas coverage file):
+  path, size and mtime (or SHA-256 with config.BUILD_MANIFEST_HASH_INPUTS)
+- the regrid parameters from config (resolution, forest classes, threshold,
+  regrid engine)
+- the code version (hash of the processing modules)
+
+An output is up to date only if it exists and its stored record equals the
+record the current inputs/config/code would produce. The check only stats
+files; no raster is opened.
+"""
+import os
+import json
+import hashlib
+from src.regrid_project import config
+
+MANIFEST_FILENAME = "build_manifest.json"
+
+# Modules whose code determines the values of the outputs (regrid and masks);
+# orchestration (main.py, pipeline.py, executor.py) does not
+_CODE_MODULES = ("ecostress_handler.py", "mapbiomas_handler.py")
+
+_CODE_VERSION = None
+
+
+def file_fingerprint(path):
+    """Fingerprint of one input file (None if it does not exist)."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    fingerprint = {'path': os.path.abspath(path), 'size': stat.st_size}
+    if config.BUILD_MANIFEST_HASH_INPUTS:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        fingerprint['sha256'] = digest.hexdigest()
+    else:
+        fingerprint['mtime_ns'] = stat.st_mtime_ns
+    return fingerprint
+
+
+def pipeline_params():
+    """Configuration values that change the content of an output."""
+    return {
+        'TARGET_RES_X': config.TARGET_RES_X,
+        'TARGET_RES_Y': config.TARGET_RES_Y,
+        'FOREST_CLASSES': sorted(config.FOREST_CLASSES),
+        'COVERAGE_THRESHOLD': config.COVERAGE_THRESHOLD,
+        # The engines agree to float tolerance, not bit for bit
+        'REGRID_ENGINE': config.REGRID_ENGINE,
+        # Diagnostics are written with the output, so switching them on rebuilds it
+        'WRITE_DIAGNOSTICS': config.WRITE_DIAGNOSTICS,
+    }
+
+
+def code_version():
+    """Hash of the processing modules' source (computed once per process)."""
+    global _CODE_VERSION
+    if _CODE_VERSION is None:
+        digest = hashlib.sha1()
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in _CODE_MODULES:
+            with open(os.path.join(package_dir, name), 'rb') as f:
+                digest.update(f.read())
+        _CODE_VERSION = digest.hexdigest()
+    return _CODE_VERSION
+
+
+def output_fingerprint():
+    """Hash of pipeline_params() and code_version(): what an output depends on besides its inputs."""
+    payload = json.dumps({'params': pipeline_params(), 'code': code_version()}, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class BuildManifest:
+    """Output path -> build record, persisted as JSON under OUTPUT_ROOT."""
+
+    def __init__(self, output_root=None):
+        self.output_root = output_root or config.OUTPUT_ROOT
+        self.path = os.path.join(self.output_root, MANIFEST_FILENAME)
+        self.records = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.records = json.load(f).get('outputs', {})
+            except Exception as e:
+                print(f"[WARNING] Ignoring unreadable build manifest {self.path}: {e}")
+
+    def _key(self, out_path):
+        return os.path.relpath(out_path, self.output_root)
+
+    def expected_record(self, input_paths):
+        """Record the current inputs, parameters and code would produce."""
+        return {
+            'inputs': [file_fingerprint(path) for path in input_paths],
+            'params': pipeline_params(),
+            'code': code_version(),
+        }
+
+    def is_up_to_date(self, out_path, record):
+        """True if the output exists and was built from exactly `record`."""
+        return os.path.exists(out_path) and self.records.get(self._key(out_path)) == record
+
+    def reason(self, out_path, record):
+        """Short explanation of why an output is out of date."""
+        if not os.path.exists(out_path):
+            return "missing"
+        stored = self.records.get(self._key(out_path))
+        if stored is None:
+            return "no build record"
+        changed = [part for part in ('inputs', 'params', 'code') if stored.get(part) != record[part]]
+        return f"{'/'.join(changed)} changed"
+
+    def record(self, out_path, record):
+        self.records[self._key(out_path)] = record
+
+    def save(self):
+        """Write atomically (the orchestrator is the only writer)."""
+        os.makedirs(self.output_root, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'outputs': self.records}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
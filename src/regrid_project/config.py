@@ -5,6 +5,10 @@ BASE_PATH = r"D:\Alecsander\Data_Leonardo_30KM\Regrid_project"
 PATH_MAPBIOMAS_DIR = os.path.join(BASE_PATH, "Coverage_mapbiomas")
 # Optional: directory to store MapBiomas files already cropped per buffer/site
 PATH_MAPBIOMAS_CUT = os.path.join(BASE_PATH, "Coverage_mapbiomas_cut")
+# Manifest of pre-cut files (site, year, path, bounds, CRS, checksum), written by prepare_mapbiomas_masks.py
+PATH_MAPBIOMAS_MANIFEST = os.path.join(PATH_MAPBIOMAS_CUT, "manifest.json")
+# Cache of forest masks already aligned to ECOSTRESS grids (bit-packed .npz files)
+PATH_MASK_CACHE = os.path.join(BASE_PATH, "Cache_forest_masks")
 
 # === SITE CONFIGURATION (BUFFERS) ===
 # Dictionary: "SITE_NAME": "SHAPEFILE_PATH"
@@ -28,9 +32,113 @@ OUTPUT_ROOT = os.path.join(BASE_PATH, "Output_Regrid_OCO3_Multi")
 TARGET_RES_X = 2200.0 
 TARGET_RES_Y = 1660.0
 
+# Minimum fraction of valid (forest, non-NaN) 70m pixels for an OCO-3 cell to be kept
+COVERAGE_THRESHOLD = 0.50
+
+# Also write OUTPUT_ROOT/<site>/<var>/diagnostics/<output name>: a 4-band GeoTIFF with
+# the sum, count, max count and coverage fraction behind each output (read by plot_results)
+WRITE_DIAGNOSTICS = False
+
 # === FOREST FILTER (MAPBIOMAS) ===
 FOREST_CLASSES = [3, 4, 5, 6]
 
+# Forest mask cache: in-process LRU (entries per worker) + files in PATH_MASK_CACHE
+MASK_CACHE_ENABLED = True
+MASK_CACHE_SIZE = 64
+
+# === PARALLELISM ===
+# Workers for main.py, extract_to_csv.py and prepare_mapbiomas_masks.py (None = all CPU cores)
+NUM_WORKERS = None
+# "process" -> worker processes (hung workers are killed and replaced)
+# "thread"  -> threads of one process: GDAL releases the GIL, caches are shared and
+#              nothing is pickled, but a hung task can only be abandoned
+EXECUTION_BACKEND = "process"
+# Each worker gets cores // workers GDAL and BLAS/OpenMP threads and a share of the
+# GDAL block cache: MultiprocessingConfig.THREADS_PER_WORKER / GDAL_CACHE_FRACTION
+# (GDAL_NUM_THREADS, GDAL_CACHEMAX, OMP_NUM_THREADS, ... set in the environment win)
+
+# Memory-aware admission (see scheduler.py): tasks are only dispatched while their
+# estimated memory (from raster headers, corrected by measured RSS) fits the budget
+MEMORY_ADMISSION = True
+# Budget in MB for all running tasks (None = MEMORY_BUDGET_FRACTION of available memory)
+MEMORY_BUDGET_MB = None
+MEMORY_BUDGET_FRACTION = 0.75
+
+# Tasks that still failed after their retries (timeout, crashed worker, exception) are
+# listed in PATH_DEAD_LETTER/regrid.jsonl and extract.jsonl (rewritten every run).
+# Deadlines and retry count: MultiprocessingConfig.TASK_TIMEOUT_SECONDS / MAX_TASK_RETRIES
+PATH_DEAD_LETTER = os.path.join(OUTPUT_ROOT, "dead_letter")
+
+# === REGRID ENGINE ===
+# "gdal"     -> three rio.reproject_match passes with Resampling.sum (original method)
+# "bincount" -> source-pixel -> template-cell index map, aggregated in one NumPy pass
+#               (scenes not in the template CRS fall back to "gdal")
+REGRID_ENGINE = "gdal"
+
+# === BATCHED (TIME-STACK) MODE ===
+# Group scenes that share a source grid and regrid them as one (time, y, x) stack
+BATCH_MODE = False
+# Maximum number of scenes per stack (bounds worker memory)
+BATCH_MAX_SCENES = 64
+
+# === PIPELINED MODE ===
+# Tasks of PIPELINE_CHUNK scenes (0 = off, one scene per task) regridded one by one
+# with overlapped I/O: PREFETCH_THREADS threads read up to PREFETCH_DEPTH scenes
+# ahead and a writer thread saves outputs (at most WRITE_QUEUE_DEPTH waiting).
+# BATCH_MODE and FUSE_VARIABLES take precedence.
+PIPELINE_CHUNK = 0
+PREFETCH_THREADS = 2
+PREFETCH_DEPTH = 4
+WRITE_QUEUE_DEPTH = 4
+
+# === FUSED MULTI-VARIABLE MODE ===
+# One task per (site, acquisition timestamp) regridding all VARIABLES with a shared
+# mask and aggregation map (takes precedence over BATCH_MODE)
+FUSE_VARIABLES = False
+
+# === INCREMENTAL BUILD MANIFEST ===
+# OUTPUT_ROOT/build_manifest.json records, for every output, the input fingerprints,
+# the parameters above and the code version. Reruns only recompute outputs that are
+# out of date (outputs without a record are rebuilt once).
+BUILD_MANIFEST = True
+# Fingerprint inputs by SHA-256 instead of size + mtime (slower, survives copies/touches)
+BUILD_MANIFEST_HASH_INPUTS = False
+
+# === DATACUBE OUTPUT (optional, requires zarr) ===
+# Also append every regridded scene to OUTPUT_ROOT/<site>/<site>_<var>.zarr,
+# a compressed (time, y, x) cube with the grid and CRS stored once
+DATACUBE_OUTPUT = False
+# Scenes per chunk along time
+DATACUBE_TIME_CHUNK = 64
+
+# === TIME SERIES TABLES (extract_to_csv) ===
+# "csv"     -> Tables_CSVs/<site>_<var>.csv (one file per site/variable)
+# "parquet" -> PATH_TABLES_PARQUET/site=<site>/variable=<var>/year=<year>/, streamed
+#              row groups with compact dtypes (requires pyarrow)
+TABLE_FORMAT = "csv"
+PATH_TABLES_PARQUET = os.path.join(BASE_PATH, "Tables_Parquet")
+# Rows buffered per partition before a row group is written (bounds memory)
+PARQUET_ROW_GROUP_ROWS = 100_000
+
+# Also build a memory-mapped (pixel, time) float32 matrix per site/variable in
+# PATH_TIME_MATRIX (see time_matrix.py) for single-pixel and date-range queries
+TIME_MATRIX_OUTPUT = False
+PATH_TIME_MATRIX = os.path.join(BASE_PATH, "Tables_Matrix")
+
+# === VALIDATION PLOTS (plot_results) ===
+# False -> one full-resolution figure per site/variable (first scene)
+# True  -> a figure for every scene, Validation_plots/<site>/<var>/, rendered with
+#          one reused figure per site/variable at PLOT_BATCH_DPI
+PLOT_ALL_SCENES = False
+PLOT_BATCH_DPI = 60
+
+# === INSTRUMENTATION ===
+# Record per-task stage timings (load, mask, regrid, write, ...), cache hits, bytes
+# read/written and peak RSS as JSON lines in PATH_INSTRUMENTATION/events_<pid>.jsonl
+# Summary: python -m src.regrid_project.instrumentation
+INSTRUMENTATION = False
+PATH_INSTRUMENTATION = os.path.join(OUTPUT_ROOT, "instrumentation")
+
 # Create root folder if it doesn't exist
 os.makedirs(OUTPUT_ROOT, exist_ok=True)
 # Ensure mapbiomas cut folder exists
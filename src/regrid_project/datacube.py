@@ -0,0 +1,157 @@
+"""
+Appendable (time, y, x) datacube per site and variable.
+
+Next to the per-scene GeoTIFFs, the regridded scenes of a site/variable can be
+appended to one compressed Zarr store `OUTPUT_ROOT/<site>/<site>_<var>.zarr`:
+- the template coordinates (x, y) and the CRS (`spatial_ref`) are stored once
+- `time` is the acquisition timestamp parsed from the filename, with the
+  source `filename` kept as a coordinate along `time`
+- chunks are `config.DATACUBE_TIME_CHUNK` scenes x the whole grid
+
+The orchestrator is the only writer: worker results are buffered (a scene is a
+few KB) and appended in time order when the run ends, so appends are
+serialized and need no locking. A scene that is already in the cube
+(recomputed output) is overwritten in place. Outputs on disk that the cube is
+missing (skipped as up to date by the build manifest, or written before
+DATACUBE_OUTPUT was turned on) are backfilled from their GeoTIFFs. Scenes added
+by a later run are appended after the existing ones; use `ds.sortby('time')`
+if a later run adds older acquisitions.
+
+Requires the optional `zarr` package.
+"""
+import os
+import re
+import glob
+from datetime import datetime
+import numpy as np
+import xarray as xr
+import rioxarray as rxr
+from src.regrid_project import config
+
+
+def acquisition_time(filename):
+    """Acquisition time from filename pattern 'doyYYYYDDDHHMMSS' (None if absent)."""
+    match = re.search(r"doy(\d{4})(\d{3})(\d{2})?(\d{2})?(\d{2})?", filename)
+    if not match:
+        return None
+    year, doy = int(match.group(1)), int(match.group(2))
+    hour, minute, second = (int(g) if g else 0 for g in match.group(3, 4, 5))
+    return np.datetime64(datetime.strptime(f"{year}{doy:03d}", "%Y%j").replace(
+        hour=hour, minute=minute, second=second))
+
+
+def cube_path(site_name, var_name, output_root=None):
+    """Location of the cube for one site/variable."""
+    output_root = output_root or config.OUTPUT_ROOT
+    return os.path.join(output_root, site_name, f"{site_name}_{var_name}.zarr")
+
+
+def open_cube(site_name, var_name, output_root=None):
+    """Open a cube lazily; `ds[var_name].sel(time=slice(...))` reads one slice."""
+    return xr.open_zarr(cube_path(site_name, var_name, output_root), decode_coords="all")
+
+
+class CubeWriter:
+    """Buffered, ordered appends of regridded scenes into one Zarr cube."""
+
+    def __init__(self, site_name, var_name, output_root=None, time_chunk=None):
+        try:
+            import zarr  # noqa: F401  (optional dependency)
+        except ImportError:
+            raise ImportError("DATACUBE_OUTPUT requires the 'zarr' package: pip install zarr")
+
+        self.var_name = var_name
+        self.path = cube_path(site_name, var_name, output_root)
+        self.time_chunk = time_chunk or config.DATACUBE_TIME_CHUNK
+        self.buffer = []
+        self.times = {}  # acquisition time -> index along 'time' in the store
+        self.grid = None  # (y, x) coordinates of the store
+        if os.path.exists(self.path):
+            existing = xr.open_zarr(self.path)
+            self.times = {t: i for i, t in enumerate(existing['time'].values)}
+            self.grid = (existing['y'].values, existing['x'].values)
+            existing.close()
+
+    def add(self, filename, da):
+        """Queue one regridded scene (2D DataArray on the clipped template grid)."""
+        time = acquisition_time(filename)
+        if time is None:
+            print(f"   [WARNING] Datacube: no acquisition time in {filename}, skipped")
+            return
+        self.buffer.append((time, filename, da))
+
+    def _dataset(self, scenes):
+        """(time, y, x) Dataset for a list of (time, filename, da)."""
+        first = scenes[0][2]
+        data = np.stack([np.asarray(da.values, dtype=np.float32) for _, _, da in scenes])
+        ds = xr.Dataset(
+            {self.var_name: (('time', 'y', 'x'), data)},
+            coords={
+                'time': [time for time, _, _ in scenes],
+                # Variable-length strings so later (longer) filenames can be appended
+                'filename': ('time', np.array([filename for _, filename, _ in scenes], dtype=object)),
+                'y': first['y'].values,
+                'x': first['x'].values,
+            }
+        )
+        return ds.rio.write_crs(first.rio.crs)
+
+    def flush(self):
+        """Write buffered scenes in time order."""
+        if not self.buffer:
+            return
+        scenes = sorted(self.buffer, key=lambda scene: scene[0])
+        self.buffer = []
+
+        grid = (scenes[0][2]['y'].values, scenes[0][2]['x'].values)
+        if self.grid is not None and not (np.array_equal(self.grid[0], grid[0]) and
+                                          np.array_equal(self.grid[1], grid[1])):
+            print(f"   [WARNING] Datacube grid changed, recreating {self.path}")
+            self.times, self.grid = {}, None
+
+        # Scenes already in the cube: overwrite their time step in place
+        new_scenes = []
+        for scene in scenes:
+            index = self.times.get(scene[0])
+            if index is None:
+                new_scenes.append(scene)
+                continue
+            region = self._dataset([scene]).drop_vars(['x', 'y', 'spatial_ref'])
+            region.to_zarr(self.path, region={'time': slice(index, index + 1)})
+
+        if not new_scenes:
+            return
+        ds = self._dataset(new_scenes)
+        if self.grid is None:
+            # Set on the variable so the grid_mapping encoding from write_crs is kept
+            ds[self.var_name].encoding['chunks'] = (self.time_chunk, ds.sizes['y'], ds.sizes['x'])
+            ds.to_zarr(self.path, mode='w')
+            self.grid = grid
+        else:
+            ds.to_zarr(self.path, append_dim='time')
+        start = len(self.times)
+        for offset, (time, _, _) in enumerate(new_scenes):
+            self.times[time] = start + offset
+
+    def backfill(self, output_dir):
+        """
+        Queue the regridded GeoTIFFs of `output_dir` whose acquisition is neither
+        in the store nor buffered. Returns the number of scenes queued.
+        """
+        known = set(self.times) | {time for time, _, _ in self.buffer}
+        queued = 0
+        for out_path in sorted(glob.glob(os.path.join(output_dir, "Regrid_*.tif"))):
+            source_filename = os.path.basename(out_path)[len("Regrid_"):]
+            time = acquisition_time(source_filename)
+            if time is None or time in known:
+                continue
+            self.add_from_file(out_path, source_filename)
+            known.add(time)
+            queued += 1
+        return queued
+
+    def add_from_file(self, filepath, source_filename=None):
+        """Queue a scene from a regridded GeoTIFF written by a worker."""
+        da = rxr.open_rasterio(filepath, masked=True).squeeze(drop=True)
+        self.add(source_filename or os.path.basename(filepath), da.load())
+        da.close()
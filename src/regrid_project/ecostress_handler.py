@@ -1,43 +1,162 @@
+import os
+import threading
 import numpy as np
 import xarray as xr
 import rioxarray as rxr
+import rasterio
 from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds
 from . import config
+from . import instrumentation as instr
+from .multiprocessing_config import MultiprocessingConfig
 
 # Define the standard metric projection for the region (UTM Zone 21 South)
 CRS_METRICO = "EPSG:32721"
 
+# Available regrid engines (see config.REGRID_ENGINE)
+REGRID_ENGINES = ("gdal", "bincount")
+
+# Bands of the diagnostics file written next to an output (config.WRITE_DIAGNOSTICS)
+DIAGNOSTIC_BANDS = ("sum", "count", "max_count", "fraction")
+# Bands of the source-grid diagnostics file: the loaded scene and its forest mask (1/0)
+SOURCE_BANDS = ("value", "forest_mask")
+
+# Site contexts already built in this process, keyed by buffer geometry
+_SITE_CONTEXT_CACHE = {}
+
+# Index maps already built in this process, keyed by (source grid, template grid)
+_INDEX_MAP_CACHE = {}
+_INDEX_MAP_CACHE_SIZE = 32
+# Guards the eviction above when tasks run on threads (config.EXECUTION_BACKEND)
+_INDEX_MAP_LOCK = threading.Lock()
+
+class SiteContext:
+    """
+    Everything about a site that does not change between files, variables
+    or workers: the centered template grid, the buffer projected to UTM 21S
+    (and to any other CRS asked for) and the buffer clip mask on the template.
+    """
+
+    def __init__(self, gdf_buffer):
+        self.buffer_utm = gdf_buffer.to_crs(CRS_METRICO)
+        self._buffers = {CRS_METRICO: self.buffer_utm}
+        self._source_buffer = gdf_buffer
+
+        center_point = self.buffer_utm.geometry.centroid.iloc[0]
+        cx, cy = center_point.x, center_point.y
+
+        radius_m = 35000
+        steps_x = int(np.ceil(radius_m / config.TARGET_RES_X))
+        steps_y = int(np.ceil(radius_m / config.TARGET_RES_Y))
+
+        self.x_coords = cx + np.arange(-steps_x, steps_x + 1) * config.TARGET_RES_X
+        self.y_coords = cy + np.arange(-steps_y, steps_y + 1) * config.TARGET_RES_Y
+
+        template = xr.DataArray(
+            data=np.full((len(self.y_coords), len(self.x_coords)), np.nan),
+            coords={'y': self.y_coords, 'x': self.x_coords},
+            dims=('y', 'x'),
+            name="template_oco3"
+        )
+        template.rio.write_crs(CRS_METRICO, inplace=True)
+        template.rio.set_spatial_dims(x_dim="x", y_dim="y", inplace=True)
+        self.template = template
+        self.transform = template.rio.transform()
+
+        # Pre-rasterized clip (same rule as rio.clip: cell centre inside the buffer)
+        self.clip_mask = geometry_mask(
+            self.buffer_utm.geometry,
+            out_shape=template.shape,
+            transform=self.transform,
+            invert=True
+        )
+        rows = np.flatnonzero(self.clip_mask.any(axis=1))
+        cols = np.flatnonzero(self.clip_mask.any(axis=0))
+        self.clip_window = Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+        self._clip_mask_da = xr.DataArray(self.clip_mask, dims=('y', 'x'))
+
+    def buffer_in(self, crs):
+        """Buffer reprojected to `crs` (cached)."""
+        key = crs.to_string() if hasattr(crs, 'to_string') else str(crs)
+        if key not in self._buffers:
+            self._buffers[key] = self._source_buffer.to_crs(crs)
+        return self._buffers[key]
+
+    def clip(self, da):
+        """
+        Equivalent of da.rio.clip(buffer_utm.geometry) for arrays on the
+        template grid, using the pre-rasterized mask.
+        """
+        clipped = da.where(self._clip_mask_da).astype(da.dtype)
+        return clipped.rio.isel_window(self.clip_window)
+
+def get_site_context(gdf_buffer):
+    """
+    Return the cached SiteContext for this buffer (built on first use).
+    """
+    geometry = gdf_buffer.geometry.iloc[0]
+    crs = gdf_buffer.crs.to_string() if gdf_buffer.crs else None
+    key = (crs, geometry.wkb, config.TARGET_RES_X, config.TARGET_RES_Y)
+    context = _SITE_CONTEXT_CACHE.get(key)
+    instr.count("site_context.hit" if context is not None else "site_context.miss")
+    if context is None:
+        context = SiteContext(gdf_buffer)
+        _SITE_CONTEXT_CACHE[key] = context
+    return context
+
 def create_centered_template(gdf_buffer):
     """
     Create an empty grid (template) in UTM 21S centered on the buffer.
     """
-    buffer_utm = gdf_buffer.to_crs(CRS_METRICO)
-    center_point = buffer_utm.geometry.centroid.iloc[0]
-    cx, cy = center_point.x, center_point.y
-    
-    radius_m = 35000 
-    steps_x = int(np.ceil(radius_m / config.TARGET_RES_X))
-    steps_y = int(np.ceil(radius_m / config.TARGET_RES_Y))
-    
-    x_coords = [cx + i * config.TARGET_RES_X for i in range(-steps_x, steps_x + 1)]
-    y_coords = [cy + i * config.TARGET_RES_Y for i in range(-steps_y, steps_y + 1)]
-    
-    coords = {'y': y_coords, 'x': x_coords}
-    
-    template = xr.DataArray(
-        data=np.full((len(y_coords), len(x_coords)), np.nan),
-        coords=coords,
-        dims=('y', 'x'),
-        name="template_oco3"
-    )
-    
-    template.rio.write_crs(CRS_METRICO, inplace=True)
-    template.rio.set_spatial_dims(x_dim="x", y_dim="y", inplace=True)
-    
-    return template
+    return get_site_context(gdf_buffer).template.copy()
 
+def buffer_window(src, bounds):
+    """
+    Pixel window of `bounds` (in the raster CRS) on the open dataset `src`,
+    expanded to whole internal tiles/strips and limited to the raster extent.
+    Returns None when the bounds do not overlap the raster.
+    """
+    window = from_bounds(*bounds, transform=src.transform)
+    block_h, block_w = src.block_shapes[0] if src.block_shapes else (1, 1)
+
+    # One pixel of margin against rounding at the edges, then snap to blocks
+    row_start = int(np.floor((window.row_off - 1) / block_h)) * block_h
+    col_start = int(np.floor((window.col_off - 1) / block_w)) * block_w
+    row_stop = int(np.ceil((window.row_off + window.height + 1) / block_h)) * block_h
+    col_stop = int(np.ceil((window.col_off + window.width + 1) / block_w)) * block_w
+
+    row_start, col_start = max(row_start, 0), max(col_start, 0)
+    row_stop, col_stop = min(row_stop, src.height), min(col_stop, src.width)
+    if row_stop <= row_start or col_stop <= col_start:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+@instr.timed("load")
 def load_ecostress(filepath, gdf_buffer):
-    da = rxr.open_rasterio(filepath, masked=True).squeeze()
+    """
+    Read an ECOSTRESS tile clipped to the buffer.
+    Only the pixel window around the buffer (aligned to the internal tiles)
+    is decoded; the polygon mask is applied afterwards.
+    """
+    window = None
+    try:
+        with rasterio.open(filepath) as src:
+            raster_crs = src.crs if src.crs else CRS_METRICO
+            buffer_proj = get_site_context(gdf_buffer).buffer_in(raster_crs)
+            window = buffer_window(src, buffer_proj.total_bounds)
+            if window is None:
+                print(f"[WARNING] Buffer does not overlap {filepath}")
+                return None
+    except Exception as e:
+        # Header could not be used: read the full tile as before
+        print(f"[WARNING] Could not compute read window, reading full tile: {e}")
+
+    da = rxr.open_rasterio(filepath, masked=True)
+    if window is not None:
+        # Lazy array: only this window is read from disk
+        da = da.rio.isel_window(window)
+    da = da.squeeze()
     if da.rio.crs is None:
         try:
             da.rio.write_crs(CRS_METRICO, inplace=True)
@@ -45,27 +164,162 @@ def load_ecostress(filepath, gdf_buffer):
         
     try:
         raster_crs = da.rio.crs if da.rio.crs else CRS_METRICO
-        buffer_proj = gdf_buffer.to_crs(raster_crs)
+        buffer_proj = get_site_context(gdf_buffer).buffer_in(raster_crs)
         da_clipped = da.rio.clip(buffer_proj.geometry, buffer_proj.crs)
+        instr.add_bytes_read(da_clipped.nbytes)
         return da_clipped
     except Exception as e:
         print(f"[WARNING] Could not crop initial buffer: {e}")
         return None
 
-def apply_mask_and_regrid_centered(eco_da, forest_mask, gdf_buffer, coverage_threshold=0.50):
+def grid_signature(da):
     """
-    Performs regridding using the robust method: SUM / COUNT.
-    This ensures that the average is calculated even with many NaNs.
+    Hashable description of a raster grid: (transform, shape, CRS).
+    Two arrays with the same signature can share any grid-dependent work.
+    """
+    transform = tuple(round(v, 6) for v in da.rio.transform()[:6])
+    shape = (da.rio.height, da.rio.width)
+    crs = da.rio.crs.to_string() if da.rio.crs else None
+    return (transform, shape, crs)
+
+def file_grid_signature(filepath):
+    """
+    Same as grid_signature, read from the GeoTIFF header only (no pixel decode).
+    """
+    with rasterio.open(filepath) as src:
+        transform = tuple(round(v, 6) for v in src.transform[:6])
+        crs = src.crs.to_string() if src.crs else None
+        return (transform, (src.height, src.width), crs)
+
+class RegridIndexMap:
+    """
+    Source-pixel -> template-cell lookup for the SUM / COUNT regrid.
+
+    Entry k says: source pixel `src_index[k]` puts `weights[k]` of its area
+    into template cell `cell_index[k]`. It only depends on the two grids, so
+    it is built once and reused for every scene on the same source grid.
+    """
+
+    def __init__(self, src_index, cell_index, weights, template_shape):
+        self.src_index = src_index
+        self.cell_index = cell_index
+        self.weights = weights
+        self.template_shape = template_shape
+        self.n_cells = template_shape[0] * template_shape[1]
+        # Maximum possible count (every source pixel valid) does not depend on the data
+        self.max_count = np.bincount(cell_index, weights=weights, minlength=self.n_cells)
+
+    def aggregate(self, values):
+        """
+        Sum, valid count and maximum count of `values` on the template grid.
+        `values` is (y, x) or a (time, y, x) stack; sum and count follow its
+        shape, the maximum count is always (y, x).
+        Cells reached by no source pixel are NaN (same as GDAL nodata).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        n_steps = values.shape[0] if values.ndim == 3 else 1
+        gathered = values.reshape(n_steps, -1)[:, self.src_index]
+        valid = ~np.isnan(gathered)
+
+        # One bincount for the whole stack: time step t uses cells [t*n_cells, (t+1)*n_cells)
+        cells = (self.cell_index[None, :] + self.n_cells * np.arange(n_steps)[:, None]).ravel()
+        size = n_steps * self.n_cells
+        sum_flat = np.bincount(cells, weights=(np.where(valid, gathered, 0.0) * self.weights).ravel(),
+                               minlength=size)
+        count_flat = np.bincount(cells, weights=(valid * self.weights).ravel(), minlength=size)
+        max_flat = self.max_count.copy()
+
+        empty = max_flat <= 0
+        max_flat[empty] = np.nan
+        sum_flat = sum_flat.reshape(n_steps, -1)
+        count_flat = count_flat.reshape(n_steps, -1)
+        sum_flat[:, empty] = np.nan
+        count_flat[:, empty] = np.nan
+
+        shape = self.template_shape
+        if values.ndim == 3:
+            return (sum_flat.reshape((n_steps,) + shape), count_flat.reshape((n_steps,) + shape),
+                    max_flat.reshape(shape))
+        return sum_flat.reshape(shape), count_flat.reshape(shape), max_flat.reshape(shape)
+
+def _axis_overlaps(src_origin, src_step, n_src, dst_origin, dst_step, n_dst):
+    """
+    1D overlap between source pixels and template pixels along one axis.
+    Returns (source index, template index, fraction of the source pixel inside).
+    """
+    edges = (src_origin + src_step * np.arange(n_src + 1) - dst_origin) / dst_step
+    lo = np.minimum(edges[:-1], edges[1:])
+    hi = np.maximum(edges[:-1], edges[1:])
+
+    first = np.floor(lo).astype(np.int64)
+    span = np.ceil(hi).astype(np.int64) - first
+
+    src_idx = np.repeat(np.arange(n_src), span)
+    offsets = np.arange(span.sum()) - np.repeat(np.cumsum(span) - span, span)
+    dst_idx = np.repeat(first, span) + offsets
+
+    overlap = np.minimum(hi[src_idx], dst_idx + 1) - np.maximum(lo[src_idx], dst_idx)
+    fraction = overlap / (hi - lo)[src_idx]
+
+    keep = (dst_idx >= 0) & (dst_idx < n_dst) & (fraction > 0)
+    return src_idx[keep], dst_idx[keep], fraction[keep]
+
+def index_map_supported(src_da, template_da):
+    """
+    True when the index map reproduces GDAL's Resampling.sum: same CRS and
+    north-up/south-up grids, where exact area weights are separable per axis.
+    """
+    src_transform = src_da.rio.transform()
+    dst_transform = template_da.rio.transform()
+    src_crs = src_da.rio.crs if src_da.rio.crs else CRS_METRICO
+    axis_aligned = (src_transform.b == 0 and src_transform.d == 0 and
+                    dst_transform.b == 0 and dst_transform.d == 0)
+    return axis_aligned and template_da.rio.crs == src_crs
+
+def build_index_map(src_da, template_da):
+    """
+    Build the RegridIndexMap from the grid of `src_da` to `template_da`, with
+    exact area weights (as GDAL SUM). Only for grids accepted by
+    index_map_supported; other grids need the GDAL warp.
+    """
+    if not index_map_supported(src_da, template_da):
+        raise ValueError("Index map needs a source grid in the template CRS without rotation")
+    src_transform = src_da.rio.transform()
+    dst_transform = template_da.rio.transform()
+    src_h, src_w = src_da.rio.height, src_da.rio.width
+    dst_h, dst_w = template_da.rio.height, template_da.rio.width
+
+    rows, cells_y, w_y = _axis_overlaps(src_transform.f, src_transform.e, src_h,
+                                        dst_transform.f, dst_transform.e, dst_h)
+    cols, cells_x, w_x = _axis_overlaps(src_transform.c, src_transform.a, src_w,
+                                        dst_transform.c, dst_transform.a, dst_w)
+    src_index = (rows[:, None] * src_w + cols[None, :]).ravel()
+    cell_index = (cells_y[:, None] * dst_w + cells_x[None, :]).ravel()
+    weights = (w_y[:, None] * w_x[None, :]).ravel()
+
+    return RegridIndexMap(src_index, cell_index, weights, (dst_h, dst_w))
+
+def get_index_map(src_da, template_da):
+    """
+    Return the cached RegridIndexMap for this (source grid, template grid) pair.
+    """
+    key = (grid_signature(src_da), grid_signature(template_da))
+    index_map = _INDEX_MAP_CACHE.get(key)
+    instr.count("index_map.hit" if index_map is not None else "index_map.miss")
+    if index_map is None:
+        with instr.stage("regrid.index_map"):
+            index_map = build_index_map(src_da, template_da)
+        with _INDEX_MAP_LOCK:
+            if key not in _INDEX_MAP_CACHE and len(_INDEX_MAP_CACHE) >= _INDEX_MAP_CACHE_SIZE:
+                _INDEX_MAP_CACHE.pop(next(iter(_INDEX_MAP_CACHE)))
+            _INDEX_MAP_CACHE[key] = index_map
+    return index_map
+
+def _regrid_sums_gdal(eco_filtered, template_da):
+    """
+    Sum, valid count and maximum count on the template with three GDAL
+    Resampling.sum warps.
     """
-    
-    # 1. Apply forest mask
-    eco_filtered = eco_da.where(forest_mask)
-    template_da = create_centered_template(gdf_buffer)
-    
-    # =========================================================================
-    # ROBUST METHOD: (Sum of Values) / (Sum of Weights)
-    # =========================================================================
-    
     # A. PREPARE DATA (Numerator)
     # Fill NaNs with 0 to sum without propagating error
     data_filled = eco_filtered.fillna(0.0)
@@ -77,21 +331,125 @@ def apply_mask_and_regrid_centered(eco_da, forest_mask, gdf_buffer, coverage_thr
     valid_weights.rio.write_nodata(None, inplace=True)
 
     # C. REGRID (USING SUM)
+    # Warper threads from the worker's share of the cores (GDAL_NUM_THREADS)
+    warp_threads = MultiprocessingConfig.get_warp_threads()
     # Sum of all values within the large pixel
     print("   -> Calculating Sum of Values...")
-    sum_grid = data_filled.rio.reproject_match(
-        template_da,
-        resampling=Resampling.sum,
-        nodata=np.nan
-    )
+    with instr.stage("regrid.sum"):
+        sum_grid = data_filled.rio.reproject_match(
+            template_da,
+            resampling=Resampling.sum,
+            nodata=np.nan,
+            num_threads=warp_threads
+        )
     
     # Sum of weights (How many 70m pixels are valid here?)
     print("   -> Calculating Valid Pixel Count...")
-    count_grid = valid_weights.rio.reproject_match(
-        template_da,
-        resampling=Resampling.sum,
-        nodata=np.nan
-    )
+    with instr.stage("regrid.count"):
+        count_grid = valid_weights.rio.reproject_match(
+            template_da,
+            resampling=Resampling.sum,
+            nodata=np.nan,
+            num_threads=warp_threads
+        )
+    
+    # We need to know what the MAXIMUM possible count would be (if pixel was full)
+    # Create a dummy grid full of 1s (one time step is enough for a stack)
+    spatial_slice = eco_filtered.isel({eco_filtered.dims[0]: 0}) if eco_filtered.ndim == 3 else eco_filtered
+    dummy_full = xr.ones_like(spatial_slice).astype(np.float32)
+    dummy_full.rio.write_nodata(None, inplace=True)
+    
+    with instr.stage("regrid.max_count"):
+        max_count_grid = dummy_full.rio.reproject_match(
+            template_da,
+            resampling=Resampling.sum,
+            nodata=np.nan,
+            num_threads=warp_threads
+        )
+    
+    return sum_grid, count_grid, max_count_grid
+
+def _regrid_sums_bincount(eco_filtered, template_da):
+    """
+    Sum, valid count and maximum count on the template with the cached
+    index map and a single np.bincount pass per quantity.
+    """
+    if not index_map_supported(eco_filtered, template_da):
+        # Reprojected or rotated source: only the warp gives GDAL's area weights
+        print(f"   -> [WARNING] Source grid ({eco_filtered.rio.crs}) is not aligned with the template "
+              f"({template_da.rio.crs}): using the gdal engine for this scene")
+        instr.count("regrid.gdal_fallback")
+        return _regrid_sums_gdal(eco_filtered, template_da)
+
+    print("   -> Calculating Sum / Count / Max Count (bincount)...")
+    index_map = get_index_map(eco_filtered, template_da)
+    sum_arr, count_arr, max_arr = index_map.aggregate(eco_filtered.values)
+
+    out = []
+    for grid in (sum_arr, count_arr, max_arr):
+        if grid.ndim == 3:
+            time_dim = eco_filtered.dims[0]
+            grid_da = xr.DataArray(
+                grid.astype(np.float32),
+                coords={time_dim: eco_filtered[time_dim].values, 'y': template_da.y, 'x': template_da.x},
+                dims=(time_dim, 'y', 'x')
+            )
+            grid_da.rio.write_crs(template_da.rio.crs, inplace=True)
+        else:
+            grid_da = template_da.copy(data=grid.astype(np.float32))
+        grid_da.rio.write_nodata(np.nan, encoded=False, inplace=True)
+        out.append(grid_da)
+    return tuple(out)
+
+def apply_mask_and_regrid_centered(eco_da, forest_mask, gdf_buffer, coverage_threshold=None, engine=None,
+                                   return_diagnostics=False):
+    """
+    Performs regridding using the robust method: SUM / COUNT.
+    This ensures that the average is calculated even with many NaNs.
+
+    `engine` selects how the sums are computed ("gdal" or "bincount");
+    defaults to config.REGRID_ENGINE. `coverage_threshold` defaults to
+    config.COVERAGE_THRESHOLD. With `return_diagnostics` the result is
+    (mean, diagnostics), diagnostics being a Dataset with the clipped
+    DIAGNOSTIC_BANDS (sum, count, max_count, fraction) behind the mean.
+    """
+    # 1. Apply forest mask
+    eco_filtered = eco_da.where(forest_mask)
+    return _regrid_filtered(eco_filtered, gdf_buffer, coverage_threshold, engine, return_diagnostics)
+
+def apply_mask_and_regrid_stack(eco_stack, forest_masks, gdf_buffer, coverage_threshold=None, engine=None,
+                                return_diagnostics=False):
+    """
+    Batched version of apply_mask_and_regrid_centered for a (time, y, x) stack
+    of scenes sharing one source grid. `forest_masks` is a matching stack (or
+    a single 2D mask). The whole stack is aggregated in one call and the
+    result is a (time, y, x) stack on the template grid.
+    """
+    eco_filtered = eco_stack.where(forest_masks)
+    return _regrid_filtered(eco_filtered, gdf_buffer, coverage_threshold, engine, return_diagnostics)
+
+@instr.timed("regrid")
+def _regrid_filtered(eco_filtered, gdf_buffer, coverage_threshold, engine, return_diagnostics=False):
+    """
+    SUM / COUNT regrid, coverage threshold and final clip of already masked data.
+    """
+    engine = engine or config.REGRID_ENGINE
+    if coverage_threshold is None:
+        coverage_threshold = config.COVERAGE_THRESHOLD
+    if engine not in REGRID_ENGINES:
+        raise ValueError(f"Unknown regrid engine '{engine}'. Use one of {REGRID_ENGINES}")
+    
+    context = get_site_context(gdf_buffer)
+    template_da = context.template
+    
+    # =========================================================================
+    # ROBUST METHOD: (Sum of Values) / (Sum of Weights)
+    # =========================================================================
+    
+    if engine == "bincount":
+        sum_grid, count_grid, max_count_grid = _regrid_sums_bincount(eco_filtered, template_da)
+    else:
+        sum_grid, count_grid, max_count_grid = _regrid_sums_gdal(eco_filtered, template_da)
     
     # D. MEAN CALCULATION
     # Mean = Sum / Count
@@ -102,17 +460,6 @@ def apply_mask_and_regrid_centered(eco_da, forest_mask, gdf_buffer, coverage_thr
     # COVERAGE CALCULATION (FRACTION) FOR THRESHOLD
     # =========================================================================
     
-    # We need to know what the MAXIMUM possible count would be (if pixel was full)
-    # Create a dummy grid full of 1s
-    dummy_full = xr.ones_like(eco_filtered).astype(np.float32)
-    dummy_full.rio.write_nodata(None, inplace=True)
-    
-    max_count_grid = dummy_full.rio.reproject_match(
-        template_da,
-        resampling=Resampling.sum,
-        nodata=np.nan
-    )
-    
     # Fraction = Real Count / Maximum Possible Count
     fraction_grid = count_grid / max_count_grid
     
@@ -123,8 +470,80 @@ def apply_mask_and_regrid_centered(eco_da, forest_mask, gdf_buffer, coverage_thr
     print(f"   -> Applying filter: Keep if coverage >= {coverage_threshold*100}%")
     oco3_final = mean_grid.where(fraction_grid >= coverage_threshold)
     
-    # Final clipping
-    buffer_utm = gdf_buffer.to_crs(CRS_METRICO)
-    oco3_final = oco3_final.rio.clip(buffer_utm.geometry)
+    # Final clipping (pre-rasterized buffer mask of the site)
+    oco3_final = context.clip(oco3_final)
+
+    if return_diagnostics:
+        diagnostics = xr.Dataset({
+            'sum': context.clip(sum_grid),
+            'count': context.clip(count_grid),
+            'max_count': context.clip(max_count_grid),
+            'fraction': context.clip(fraction_grid),
+        })
+        return oco3_final, diagnostics
     
     return oco3_final
+
+def diagnostics_path(out_path):
+    """Diagnostics file of an output: <output folder>/diagnostics/<output name>."""
+    return os.path.join(os.path.dirname(out_path), "diagnostics", os.path.basename(out_path))
+
+def source_diagnostics_path(out_path):
+    """Source-grid diagnostics of an output: <output folder>/diagnostics/<output name>_source.tif."""
+    return os.path.splitext(diagnostics_path(out_path))[0] + "_source.tif"
+
+def _write_bands(layers, names, path, stamp, **profile):
+    bands = xr.concat([layer.astype(np.float32) for layer in layers], dim='band')
+    bands = bands.assign_coords(band=np.arange(1, len(names) + 1))
+    bands.attrs['long_name'] = names
+    if stamp is not None:
+        bands.attrs['pipeline_fingerprint'] = stamp
+    bands.rio.write_nodata(np.nan, encoded=False, inplace=True)
+    bands.rio.to_raster(path, **profile)
+
+def write_diagnostics(diagnostics, out_path, source=None, stamp=None):
+    """
+    Write the DIAGNOSTIC_BANDS of one scene (2D variables) as a multi-band
+    GeoTIFF next to its output; band names are stored as band descriptions.
+    `source` (loaded scene, forest mask) adds the SOURCE_BANDS file on the
+    scene's own grid. `stamp` (build_manifest.output_fingerprint) is stored as
+    a tag so stale diagnostics can be told apart. Write them after the output.
+
+    Returns:
+        list: Paths written
+    """
+    path = diagnostics_path(out_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_bands([diagnostics[name] for name in DIAGNOSTIC_BANDS], DIAGNOSTIC_BANDS, path, stamp)
+    paths = [path]
+    if source is not None:
+        eco_da, mask = source
+        mask_da = eco_da.copy(data=np.broadcast_to(np.asarray(mask, dtype=np.float32), eco_da.shape))
+        _write_bands([eco_da, mask_da], SOURCE_BANDS, source_diagnostics_path(out_path), stamp,
+                     compress="DEFLATE", tiled=True)
+        paths.append(source_diagnostics_path(out_path))
+    return paths
+
+def _read_bands(path, names, out_path, stamp):
+    """Bands of a diagnostics file; None if missing, older than the output or stamped differently."""
+    if not os.path.exists(path):
+        return None
+    if os.path.exists(out_path) and os.path.getmtime(path) < os.path.getmtime(out_path):
+        return None  # Output rebuilt without diagnostics
+    bands = rxr.open_rasterio(path, masked=True)
+    if stamp is not None and bands.attrs.get('pipeline_fingerprint') != stamp:
+        bands.close()
+        return None
+    bands = bands.load()
+    return xr.Dataset({name: bands.isel(band=i, drop=True) for i, name in enumerate(names)})
+
+def read_diagnostics(out_path, stamp=None):
+    """
+    Diagnostics of an output as a Dataset; None if they were not written, are
+    older than the output, or (with `stamp`) were written by other parameters/code.
+    """
+    return _read_bands(diagnostics_path(out_path), DIAGNOSTIC_BANDS, out_path, stamp)
+
+def read_source_diagnostics(out_path, stamp=None):
+    """SOURCE_BANDS of an output (value, forest_mask) on the scene grid; None as read_diagnostics."""
+    return _read_bands(source_diagnostics_path(out_path), SOURCE_BANDS, out_path, stamp)
@@ -0,0 +1,420 @@
+"""
+Fault-tolerant task execution for the regrid and extraction pools.
+
+`WorkerPool` replaces multiprocessing.Pool where one bad input must not stall
+the run: every worker process has its own pipe, so the parent knows which task
+each one is running and can
+- enforce a per-task deadline: a worker past it (e.g. GDAL hung on a corrupt
+  tile) is killed and replaced by a fresh, re-initialized process
+- notice a worker that died (segfault, OOM kill) and replace it as well
+
+`ThreadWorkerPool` has the same interface on threads of the calling process,
+for stages that spend their time in GDAL (which releases the GIL): no process
+start-up or pickling, and module caches (site contexts, forest masks, index
+maps) are shared by every task. A thread cannot be killed, so one past its
+deadline is abandoned (left to finish in the background, not retried) and its
+slot reused, up to a cap on the abandoned threads still alive.
+`make_pool` picks either from a backend name ("process" or "thread").
+
+`run_tasks` drives a pool over a job list: failed tasks (exception, timeout,
+dead worker) are requeued up to `retries` times, and whatever still fails is
+yielded as a failure so the caller can write it to a dead-letter list
+(`write_dead_letters`) instead of losing the run.
+"""
+import os
+import json
+import time
+import queue
+import threading
+import traceback
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.connection import wait
+
+# Workers that die before their initializer finishes are replaced at most
+# this many times in a row (a broken initializer would otherwise loop forever)
+MAX_RESPAWNS = 5
+
+# Sent by a worker once its initializer has run
+_READY = "ready"
+
+def _worker_loop(conn, initializer, initargs):
+    """Body of a worker process: run (task_id, func, arg) messages until None."""
+    if initializer is not None:
+        initializer(*initargs)
+    conn.send(_READY)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        task_id, func, arg = message
+        try:
+            reply = (task_id, True, func(arg))
+        except Exception as e:
+            reply = (task_id, False, f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=3)}")
+        conn.send(reply)
+    conn.close()
+
+class _Worker:
+    def __init__(self, ctx, initializer, initargs):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_loop, args=(child_conn, initializer, initargs), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task_id = None
+        self.deadline = None
+        self.started = None
+        self.ready = False
+
+    def receive(self):
+        """Reply waiting on the pipe: a (task_id, ok, value) result, or None."""
+        while self.conn.poll():
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                return None  # Died while replying
+            if message == _READY:
+                self.ready = True
+                continue
+            return message
+        return None
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except (OSError, BrokenPipeError):
+                pass
+        self.process.join(timeout=None if kill else 10)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+class WorkerPool:
+    """
+    Process pool with per-task deadlines and replacement of hung or dead workers.
+
+    Use as a context manager; `submit` a task to an idle worker and collect
+    outcomes with `next_result`.
+    """
+
+    def __init__(self, processes, initializer=None, initargs=()):
+        self.ctx = mp.get_context()
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.size = processes
+        self.workers = [self._spawn() for _ in range(processes)]
+        self.next_id = 0
+        self.replaced = 0
+        self.failed_starts = 0
+
+    def _spawn(self):
+        return _Worker(self.ctx, self.initializer, self.initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # On an error, kill running tasks instead of waiting for them
+        self.close(kill=exc_type is not None)
+        return False
+
+    def close(self, kill=False):
+        for worker in self.workers:
+            worker.stop(kill=kill or worker.task_id is not None)
+        self.workers = []
+
+    @property
+    def busy(self):
+        return sum(worker.task_id is not None for worker in self.workers)
+
+    def worker_pids(self):
+        """Pids of the current worker processes (replaced workers drop out)."""
+        return [worker.process.pid for worker in self.workers]
+
+    def has_idle(self):
+        return self.busy < len(self.workers)
+
+    def can_retry(self, task_id):
+        """A failed task can always be retried: its worker was replaced."""
+        return True
+
+    def submit(self, func, arg, timeout=None):
+        """
+        Send func(arg) to an idle worker; returns the task id. An idle worker
+        that died (broken pipe) is replaced and the task sent to the new one.
+        """
+        task_id = self.next_id
+        self.next_id += 1
+        while True:
+            worker = next(w for w in self.workers if w.task_id is None)
+            try:
+                worker.conn.send((task_id, func, arg))
+                break
+            except (OSError, EOFError):
+                worker.process.join(timeout=1)
+                worker.receive()  # Ready message still unread if it died idle
+                self._count_start(worker)
+                self._replace(worker)
+        worker.task_id = task_id
+        worker.started = time.monotonic()
+        worker.deadline = worker.started + timeout if timeout else None
+        return task_id
+
+    def _count_start(self, worker):
+        """Track workers dying before their initializer finished (raises past MAX_RESPAWNS)."""
+        if worker.ready:
+            self.failed_starts = 0
+            return
+        self.failed_starts += 1
+        if self.failed_starts > MAX_RESPAWNS:
+            raise RuntimeError(f"Worker initializer keeps failing (last exit code {worker.process.exitcode})")
+
+    def _replace(self, worker):
+        index = self.workers.index(worker)
+        worker.stop(kill=True)
+        self.workers[index] = self._spawn()
+        self.replaced += 1
+
+    def next_result(self):
+        """
+        Block until a running task ends. Returns (task_id, ok, value): the
+        result, or an error message when the task raised, timed out or its
+        worker died.
+        """
+        while True:
+            busy = [w for w in self.workers if w.task_id is not None]
+            if not busy:
+                raise RuntimeError("next_result() called with no task running")
+            now = time.monotonic()
+            deadlines = [w.deadline for w in busy if w.deadline is not None]
+            timeout = max(0.0, min(deadlines) - now) if deadlines else None
+
+            wait([w.conn for w in busy] + [w.process.sentinel for w in busy], timeout)
+            for worker in busy:
+                reply = worker.receive()
+                if reply is not None:
+                    worker.task_id = None
+                    return reply
+
+            now = time.monotonic()
+            for worker in busy:
+                task_id = worker.task_id
+                if not worker.process.is_alive():
+                    code = worker.process.exitcode
+                    self._count_start(worker)
+                    self._replace(worker)
+                    return task_id, False, f"worker died (exit code {code})"
+                if worker.deadline is not None and now >= worker.deadline:
+                    elapsed = now - worker.started
+                    self._replace(worker)
+                    return task_id, False, f"timed out after {elapsed:.0f}s (worker killed and replaced)"
+
+class ThreadWorkerPool:
+    """
+    WorkerPool interface on threads of this process. The initializer runs once,
+    in the calling thread, since all tasks share the process state; if it
+    returns a callable, that callable is run on close (e.g. to restore the
+    environment the initializer changed).
+
+    A task past its deadline is abandoned: it is reported as failed and never
+    retried, since its thread may still be writing its outputs. Abandoned
+    threads that are still running count against `max_abandoned` extra threads;
+    once they hold them all, new tasks wait for one of them to finish.
+    """
+
+    def __init__(self, threads, initializer=None, initargs=(), max_abandoned=None):
+        self.finalizer = initializer(*initargs) if initializer is not None else None
+        self.size = threads
+        self.max_abandoned = threads if max_abandoned is None else max_abandoned
+        self.results = queue.Queue()
+        self.running = {}          # task id -> (started, deadline)
+        self.abandoned_live = {}   # task id -> timeout, threads abandoned but still running
+        self.next_id = 0
+        self.abandoned = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self, kill=False):
+        # Daemon threads: a task still running does not keep the process alive
+        self.running = {}
+        if callable(self.finalizer):
+            self.finalizer()
+            self.finalizer = None
+
+    @property
+    def busy(self):
+        return len(self.running)
+
+    def has_idle(self):
+        live = len(self.running) + len(self.abandoned_live)
+        return self.busy < self.size and live < self.size + self.max_abandoned
+
+    def can_retry(self, task_id):
+        """False for an abandoned task (its thread may still be running)."""
+        return task_id not in self.abandoned_live
+
+    def _run(self, task_id, func, arg):
+        try:
+            reply = (task_id, True, func(arg))
+        except Exception as e:
+            reply = (task_id, False, f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=3)}")
+        self.results.put(reply)
+
+    def submit(self, func, arg, timeout=None):
+        """Run func(arg) on a new thread; returns the task id."""
+        task_id = self.next_id
+        self.next_id += 1
+        started = time.monotonic()
+        self.running[task_id] = (started, started + timeout if timeout else None)
+        threading.Thread(target=self._run, args=(task_id, func, arg), daemon=True,
+                         name=f"task-{task_id}").start()
+        return task_id
+
+    def _wait_abandoned(self):
+        """Every slot is held by an abandoned thread: wait for one to finish."""
+        grace = max(self.abandoned_live.values())
+        try:
+            task_id, _, _ = self.results.get(timeout=grace)
+        except queue.Empty:
+            raise RuntimeError(f"{len(self.abandoned_live)} timed-out thread(s) still running after a further "
+                               f"{grace:.0f}s; use the process backend to kill hung tasks")
+        self.abandoned_live.pop(task_id, None)
+
+    def next_result(self):
+        """
+        Same contract as WorkerPool.next_result, except that it returns None
+        when it only waited for an abandoned thread to free its slot.
+        """
+        while True:
+            if not self.running:
+                if not self.abandoned_live:
+                    raise RuntimeError("next_result() called with no task running")
+                self._wait_abandoned()
+                return None
+            deadlines = [deadline for _, deadline in self.running.values() if deadline is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            try:
+                task_id, ok, value = self.results.get(timeout=timeout)
+                if self.running.pop(task_id, None) is not None:
+                    return task_id, ok, value
+                self.abandoned_live.pop(task_id, None)  # Late reply of an abandoned task
+                continue
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            for task_id, (started, deadline) in list(self.running.items()):
+                if deadline is not None and now >= deadline:
+                    del self.running[task_id]
+                    self.abandoned_live[task_id] = deadline - started
+                    self.abandoned += 1
+                    return task_id, False, (f"timed out after {now - started:.0f}s "
+                                            f"(thread abandoned, not retried)")
+
+def make_pool(backend, size, initializer=None, initargs=()):
+    """WorkerPool ("process") or ThreadWorkerPool ("thread") with `size` workers."""
+    if backend == "thread":
+        return ThreadWorkerPool(size, initializer, initargs)
+    if backend == "process":
+        return WorkerPool(size, initializer, initargs)
+    raise ValueError(f"Unknown execution backend '{backend}' (expected 'process' or 'thread')")
+
+class TaskFailure:
+    """Outcome of a task that failed on every attempt."""
+
+    def __init__(self, error, attempts):
+        self.error = error
+        self.attempts = attempts
+
+    def __repr__(self):
+        return f"TaskFailure({self.error.splitlines()[0]!r}, attempts={self.attempts})"
+
+def run_tasks(pool, func, jobs, timeouts=None, retries=0, admission=None, ordered=False, max_ahead=None,
+              describe=str):
+    """
+    Run func(job) for every job on `pool`, yielding (index, outcome) where the
+    outcome is the result or a TaskFailure.
+
+    Args:
+        timeouts (list): Per-job deadline in seconds (None = no deadline)
+        retries (int): Extra attempts for a job that raised, timed out or lost its worker
+            (not for a thread the pool abandoned, see ThreadWorkerPool)
+        admission: Optional object with admit(index, running) -> bool and
+            release(index, ok, value) -> value (see scheduler.MemoryScheduler)
+        ordered (bool): Yield in job order (like imap) instead of completion order
+        max_ahead (int): With ordered, jobs dispatched beyond the next one to yield
+            (bounds the results held back)
+        describe (callable): Job -> text for retry messages
+    """
+    pending = deque(range(len(jobs)))
+    attempts = [0] * len(jobs)
+    running = {}  # task id -> job index
+    held = {}     # ordered mode: finished results waiting for earlier jobs
+    next_out = 0
+
+    while pending or running:
+        while pending and pool.has_idle():
+            index = pending[0]
+            if ordered and max_ahead is not None and index >= next_out + max_ahead:
+                break
+            if admission is not None and not admission.admit(index, len(running)):
+                break
+            pending.popleft()
+            attempts[index] += 1
+            timeout = timeouts[index] if timeouts else None
+            running[pool.submit(func, jobs[index], timeout)] = index
+
+        reply = pool.next_result()
+        if reply is None:
+            continue  # A thread slot was freed, nothing finished
+        task_id, ok, value = reply
+        index = running.pop(task_id)
+        if admission is not None:
+            value = admission.release(index, ok, value)
+        if not ok:
+            first_line = value.splitlines()[0]
+            if attempts[index] <= retries and pool.can_retry(task_id):
+                print(f"      [RETRY] {describe(jobs[index])} ({first_line}), attempt {attempts[index] + 1}")
+                if ordered:
+                    pending.appendleft(index)  # Later jobs wait for it anyway
+                else:
+                    pending.append(index)
+                continue
+            print(f"      [FAILED] {describe(jobs[index])} after {attempts[index]} attempt(s): {first_line}")
+            value = TaskFailure(value, attempts[index])
+
+        if not ordered:
+            yield index, value
+            continue
+        held[index] = value
+        while next_out in held:
+            yield next_out, held.pop(next_out)
+            next_out += 1
+
+def write_dead_letters(path, records):
+    """
+    Write the failed tasks of this run as JSON lines (the file is replaced;
+    removed when nothing failed). Each record is a dict describing the task
+    plus 'error' and 'attempts'.
+    """
+    if not records:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+    print(f"   [WARNING] {len(records)} task(s) failed, listed in {path}")
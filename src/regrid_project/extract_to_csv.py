@@ -1,12 +1,19 @@
 import os
 import glob
 import re
-from multiprocessing import Pool
 import numpy as np
 import pandas as pd
-import rioxarray as rxr
+import rasterio
 from pyproj import Transformer
 from src.regrid_project import config
+from src.regrid_project import instrumentation as instr
+from src.regrid_project.executor import TaskFailure, make_pool, run_tasks, write_dead_letters
+from src.regrid_project.multiprocessing_config import MultiprocessingConfig
+from src.regrid_project.table_writer import ParquetTableWriter
+from src.regrid_project.time_matrix import TimeMatrixWriter
+
+# Pixel coordinates per output grid, shared by every raster written on it
+_GRID_CACHE = {}
 
 def extract_date_info(filename):
     """Extract Year and DOY from filename."""
@@ -15,143 +22,327 @@ def extract_date_info(filename):
         return int(match.group(1)), int(match.group(2))
     return None, None
 
-def process_raster_file(filepath):
-    """Process a single raster file and return dataframe"""
+class GridCoordinates:
+    """
+    Per-pixel x, y, latitude, longitude and pixel_id of one raster grid,
+    flattened in row-major order. All regridded rasters of a site share the
+    same template grid, so this is computed once instead of once per file.
+    """
+
+    def __init__(self, transform, shape, crs):
+        transform = rasterio.Affine(*transform)
+        height, width = shape
+        # Pixel centres, computed like rioxarray's x/y coordinates
+        x_coords, _ = transform * (np.arange(width) + 0.5, np.zeros(width) + 0.5)
+        _, y_coords = transform * (np.zeros(height) + 0.5, np.arange(height) + 0.5)
+        xx, yy = np.meshgrid(x_coords, y_coords)
+        self.x = xx.ravel()
+        self.y = yy.ravel()
+
+        # Convert Coordinates to Lat/Lon
+        transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+        self.longitude, self.latitude = transformer.transform(self.x, self.y)
+
+        # Unique pixel ID (no site name needed, files are separated by site)
+        self.pixel_id = (
+            pd.Series(self.x).astype(int).astype(str) + "_" +
+            pd.Series(self.y).astype(int).astype(str)
+        ).to_numpy()
+
+def get_grid_coordinates(grid):
+    """Cached GridCoordinates for a (transform, shape, crs) grid description."""
+    coords = _GRID_CACHE.get(grid)
+    if coords is None:
+        coords = GridCoordinates(*grid)
+        _GRID_CACHE[grid] = coords
+    return coords
+
+def _read_raster_file(filepath):
+    """
+    Read a single raster and keep its valid pixels.
+
+    Returns:
+        tuple: (filename, year, doy, grid, index, values) where grid is the
+        (transform, shape, crs) description, index the flat positions of the
+        valid pixels and values their data; None if unreadable or empty
+    """
     try:
         filename = os.path.basename(filepath)
         year, doy = extract_date_info(filename)
-        
-        # Load Raster
-        da = rxr.open_rasterio(filepath, masked=True).squeeze()
-        
-        # Convert to DataFrame
-        df = da.to_dataframe(name='value').reset_index()
-        
-        # Remove NaNs and make an explicit copy to avoid SettingWithCopyWarning
-        df_clean = df.dropna(subset=['value']).copy()
-        
-        if df_clean.empty:
-            return None
-        
-        # Add metadata using .loc to avoid SettingWithCopyWarning
-        df_clean.loc[:, 'year'] = year
-        df_clean.loc[:, 'doy'] = doy
 
-        # Create actual date
-        if year and doy:
-            df_clean.loc[:, 'date'] = pd.to_datetime(df_clean['year'] * 1000 + df_clean['doy'], format='%Y%j')
+        with instr.stage("read"), rasterio.open(filepath) as src:
+            data = src.read(1)
+            nodata = src.nodata
+            grid = (tuple(src.transform)[:6], (src.height, src.width),
+                    src.crs.to_wkt() if src.crs else "EPSG:32721")
+
+        # Same validity rule as open_rasterio(masked=True) + dropna
+        if data.dtype.kind != 'f':
+            data = data.astype(np.float64)
+        valid = ~np.isnan(data)
+        if nodata is not None and not np.isnan(nodata):
+            valid &= data != nodata
+
+        instr.add_bytes_read(data.nbytes)
+        index = np.flatnonzero(valid)
+        if index.size == 0:
+            return None
+        return filename, year, doy, grid, index, data.ravel()[index]
 
-        # Store filename for reference
-        df_clean.loc[:, 'filename'] = filename
-        
-        return df_clean
-        
     except Exception as e:
         print(f"   Error reading {filepath}: {e}")
         return None
 
+def process_raster_file(filepath):
+    """Pool worker: `_read_raster_file`, recorded as one instrumentation task."""
+    # Rasters live in OUTPUT_ROOT/<site>/<var>
+    folder = os.path.dirname(filepath)
+    with instr.task("extract.read", site=os.path.basename(os.path.dirname(folder)),
+                    variable=os.path.basename(folder), file=os.path.basename(filepath)):
+        return _read_raster_file(filepath)
+
+class ColumnBuffers:
+    """
+    Preallocated output columns, filled raster by raster: each raster costs one
+    slice assignment per column (coordinates are gathered straight into the
+    buffers from the grid cache), with no per-file DataFrame and no concat.
+    """
+
+    def __init__(self, capacity, value_dtype=np.float32):
+        self.capacity = capacity
+        self.size = 0
+        self.date = np.empty(capacity, dtype='datetime64[ns]')
+        self.year = np.empty(capacity, dtype=np.int64)
+        self.doy = np.empty(capacity, dtype=np.int64)
+        self.dated = np.empty(capacity, dtype=bool)  # False where the filename has no date
+        self.latitude = np.empty(capacity, dtype=np.float64)
+        self.longitude = np.empty(capacity, dtype=np.float64)
+        self.value = np.empty(capacity, dtype=value_dtype)
+        self.pixel_id = np.empty(capacity, dtype=object)
+        self.x = np.empty(capacity, dtype=np.float64)
+        self.y = np.empty(capacity, dtype=np.float64)
+
+    @property
+    def free(self):
+        return self.capacity - self.size
+
+    def append(self, result):
+        """Copy the valid pixels of one raster (output of process_raster_file)."""
+        _, year, doy, grid, index, values = result
+        n = index.size
+        if n > self.free:
+            raise ValueError(f"ColumnBuffers full ({self.size}/{self.capacity}, {n} rows to add)")
+        coords = get_grid_coordinates(grid)
+        rows = slice(self.size, self.size + n)
+
+        self.value[rows] = values
+        for name in ('latitude', 'longitude', 'pixel_id', 'x', 'y'):
+            np.take(getattr(coords, name), index, out=getattr(self, name)[rows])
+
+        # Create actual date
+        if year and doy:
+            self.date[rows] = np.datetime64(pd.to_datetime(year * 1000 + doy, format='%Y%j'))
+            self.year[rows], self.doy[rows] = year, doy
+            self.dated[rows] = True
+        else:
+            self.date[rows] = np.datetime64('NaT')
+            self.year[rows], self.doy[rows] = 0, 0
+            self.dated[rows] = False
+        self.size += n
+
+    def clear(self):
+        self.size = 0
+
+    def to_frame(self, var_name):
+        """DataFrame with the CSV schema (value column named after the variable)."""
+        n = self.size
+        dated = self.dated[:n]
+        if dated.all():
+            year, doy = self.year[:n], self.doy[:n]
+        else:
+            # Missing dates stay empty in the CSV
+            year = pd.array(self.year[:n], dtype='Int64')
+            doy = pd.array(self.doy[:n], dtype='Int64')
+            year[~dated], doy[~dated] = pd.NA, pd.NA
+
+        columns = {}
+        if dated.any():
+            columns['date'] = self.date[:n]
+        columns.update({
+            'year': year,
+            'doy': doy,
+            'latitude': self.latitude[:n],
+            'longitude': self.longitude[:n],
+            # Value column named after the variable (e.g., 'LST', 'NDVI'),
+            # this helps a lot in later analysis
+            var_name: self.value[:n],
+            'pixel_id': self.pixel_id[:n],
+            'x': self.x[:n],
+            'y': self.y[:n],
+        })
+        return pd.DataFrame(columns, copy=False)
+
+def read_rasters(pool, files, dead_letters):
+    """
+    process_raster_file over `files` on the pool, yielding results in file order.
+    A file that hangs or crashes its worker is retried, then yielded as None
+    and recorded in `dead_letters`.
+    """
+    timeout = MultiprocessingConfig.get_task_timeout()
+    # Results held back for ordering are bounded by the dispatch window
+    outcomes = run_tasks(pool, process_raster_file, files, timeouts=[timeout] * len(files),
+                         retries=MultiprocessingConfig.MAX_TASK_RETRIES, ordered=True,
+                         max_ahead=pool.size * 4, describe=os.path.basename)
+    for index, outcome in outcomes:
+        if isinstance(outcome, TaskFailure):
+            dead_letters.append({'file': files[index], 'error': outcome.error, 'attempts': outcome.attempts})
+            outcome = None
+        yield outcome
+
+def fill_matrix(results, matrix):
+    """Pass results through, writing each raster into the time matrix on the way."""
+    for result in results:
+        if result is not None:
+            with instr.stage("matrix"):
+                matrix.add(result, get_grid_coordinates(result[3]))
+        yield result
+
+def save_csv(results, csv_output_dir, site_name, var_name):
+    """Fill one set of column buffers for a site/variable and write its CSV."""
+    # Workers only return the valid indices and values, so keeping them until
+    # the total row count is known is cheap; the columns are then allocated once
+    results = [result for result in results if result is not None]
+
+    # --- SAVE CSV FOR THIS PAIR (SITE + VARIABLE) ---
+    if results:
+        total_rows = sum(result[4].size for result in results)
+        value_dtype = np.result_type(*(result[5].dtype for result in results))
+        with instr.stage("assemble"):
+            buffers = ColumnBuffers(total_rows, value_dtype)
+            for result in results:
+                buffers.append(result)
+            final_df = buffers.to_frame(var_name)
+
+        # CSV filename: E.g., ATTO_LST.csv
+        csv_filename = f"{site_name}_{var_name}.csv"
+        output_path = os.path.join(csv_output_dir, csv_filename)
+
+        with instr.stage("write"):
+            final_df.to_csv(output_path, index=False)
+        instr.add_file_written(output_path)
+        print(f"   -> SAVED: {csv_filename} ({len(final_df)} rows)")
+    else:
+        print(f"   -> No valid data found for {site_name}/{var_name}.")
+
+def save_parquet(results, site_name, var_name):
+    """Stream the rows of one site/variable into its Parquet partitions."""
+    writer = ParquetTableWriter(site_name, var_name)
+    buffers = {}  # year -> ColumnBuffers holding one pending row group
+    try:
+        for result in results:
+            if result is None:
+                continue
+            year, n = result[1], result[4].size
+            pending = buffers.get(year)
+            if pending is None:
+                pending = buffers[year] = ColumnBuffers(max(writer.row_group_rows, n))
+            elif n > pending.free:
+                with instr.stage("write"):
+                    writer.write_row_group(year, pending)
+                pending.clear()
+                if n > pending.capacity:
+                    pending = buffers[year] = ColumnBuffers(n)
+            pending.append(result)
+        with instr.stage("write"):
+            for year, pending in buffers.items():
+                writer.write_row_group(year, pending)
+    except BaseException:
+        writer.abort()
+        raise
+
+    if writer.rows:
+        writer.close()
+        for folder, _, names in os.walk(writer.path):
+            for name in names:
+                instr.add_file_written(os.path.join(folder, name))
+        print(f"   -> SAVED: {writer.path} ({writer.rows} rows)")
+    else:
+        writer.abort()
+        print(f"   -> No valid data found for {site_name}/{var_name}.")
+
 def main():
-    print("=== EXTRACTING DATA TO INDIVIDUAL CSVs (BY BUFFER AND VARIABLE) ===")
+    print(f"=== EXTRACTING DATA TO INDIVIDUAL {config.TABLE_FORMAT.upper()} TABLES (BY BUFFER AND VARIABLE) ===")
     
+    if config.TABLE_FORMAT not in ("csv", "parquet"):
+        raise ValueError(f"Unknown TABLE_FORMAT '{config.TABLE_FORMAT}' (expected 'csv' or 'parquet')")
+
     # Create a specific folder to store the tables
     csv_output_dir = os.path.join(config.BASE_PATH, "Tables_CSVs")
-    os.makedirs(csv_output_dir, exist_ok=True)
+    if config.TABLE_FORMAT == "csv":
+        os.makedirs(csv_output_dir, exist_ok=True)
     
-    # Configure coordinate transformer (UTM 21S -> Lat/Lon)
-    transformer = Transformer.from_crs("EPSG:32721", "EPSG:4326", always_xy=True)
-
-    # 1. Loop through SITES (Buffers)
-    for site_name in config.SITES.keys():
-        
-        # 2. Loop through VARIABLES
-        for var_name in config.VARIABLES:
-            
-            # Build the path to the folder where processed TIFs are
-            # Ex: .../Output_Regrid_OCO3_Multi/ATTO/LST
-            target_folder = os.path.join(config.OUTPUT_ROOT, site_name, var_name)
-            
-            if not os.path.exists(target_folder):
-                # If folder doesn't exist (perhaps NDVI for K34 hasn't been processed yet), skip
-                continue
+    # One pool for every site/variable; workers only read and filter arrays,
+    # coordinates are gathered here from the per-grid cache
+    num_workers = config.NUM_WORKERS or MultiprocessingConfig.get_optimal_workers('io')
+    print(f"Using {num_workers} {config.EXECUTION_BACKEND} workers")
 
-            print(f"\nProcessing: {site_name} - {var_name} ...")
-            
-            # List only TIF files from this specific folder
-            files = glob.glob(os.path.join(target_folder, "*.tif"))
-            
-            if not files:
-                print(f"   [WARNING] Empty folder: {target_folder}")
-                continue
+    resources = MultiprocessingConfig.get_worker_resources(num_workers, config.EXECUTION_BACKEND)
+    print(MultiprocessingConfig.describe_worker_resources(num_workers, resources))
 
-            # Temporary list to store data ONLY from this Site/Variable
-            batch_data = []
+    dead_letters = []
+    with make_pool(config.EXECUTION_BACKEND, num_workers, initializer=MultiprocessingConfig.apply_worker_resources,
+                   initargs=(resources,)) as pool:
+        # 1. Loop through SITES (Buffers)
+        for site_name in config.SITES.keys():
 
-            for filepath in files:
-                filename = os.path.basename(filepath)
-                year, doy = extract_date_info(filename)
-                
-                try:
-                    # Load Raster
-                    da = rxr.open_rasterio(filepath, masked=True).squeeze()
-                except Exception as e:
-                    print(f"   Erro ao ler {filename}: {e}")
+            # 2. Loop through VARIABLES
+            for var_name in config.VARIABLES:
+
+                # Build the path to the folder where processed TIFs are
+                # Ex: .../Output_Regrid_OCO3_Multi/ATTO/LST
+                target_folder = os.path.join(config.OUTPUT_ROOT, site_name, var_name)
+
+                if not os.path.exists(target_folder):
+                    # If folder doesn't exist (perhaps NDVI for K34 hasn't been processed yet), skip
                     continue
 
-                # Convert to DataFrame
-                df = da.to_dataframe(name='value').reset_index()
-                
-                # Remove NaNs (where there's no forest or outside buffer)
-                # Make an explicit copy to avoid SettingWithCopyWarning when adding columns
-                df_clean = df.dropna(subset=['value']).copy()
-                
-                if df_clean.empty:
+                print(f"\nProcessing: {site_name} - {var_name} ...")
+
+                # List only TIF files from this specific folder
+                files = glob.glob(os.path.join(target_folder, "*.tif"))
+
+                if not files:
+                    print(f"   [WARNING] Empty folder: {target_folder}")
                     continue
 
-                # Add basic metadata using .loc to avoid SettingWithCopyWarning
-                df_clean.loc[:, 'year'] = year
-                df_clean.loc[:, 'doy'] = doy
-
-                # Create actual date
-                if year and doy:
-                    df_clean.loc[:, 'date'] = pd.to_datetime(df_clean['year'] * 1000 + df_clean['doy'], format='%Y%j')
-
-                # Convert Coordinates to Lat/Lon
-                lons, lats = transformer.transform(df_clean['x'].values, df_clean['y'].values)
-                df_clean.loc[:, 'longitude'] = lons
-                df_clean.loc[:, 'latitude'] = lats
-
-                # Create unique pixel ID
-                # Note: No need for site name in ID here, as file is already separated by site
-                df_clean.loc[:, 'pixel_id'] = (
-                    df_clean['x'].astype(int).astype(str) + "_" + 
-                    df_clean['y'].astype(int).astype(str)
-                )
-
-                batch_data.append(df_clean)
-
-            # --- SAVE CSV FOR THIS PAIR (SITE + VARIABLE) ---
-            if batch_data:
-                final_df = pd.concat(batch_data, ignore_index=True)
-                
-                # Rename value column to variable name (e.g., 'LST', 'NDVI')
-                # This helps a lot in later analysis
-                final_df.rename(columns={'value': var_name}, inplace=True)
-                
-                # Organize columns
-                cols = ['date', 'year', 'doy', 'latitude', 'longitude', var_name, 'pixel_id', 'x', 'y', 'filename']
-                cols = [c for c in cols if c in final_df.columns]
-                final_df = final_df[cols]
-                
-                # CSV filename: E.g., ATTO_LST.csv
-                csv_filename = f"{site_name}_{var_name}.csv"
-                output_path = os.path.join(csv_output_dir, csv_filename)
-                
-                final_df.to_csv(output_path, index=False)
-                print(f"   -> SAVED: {csv_filename} ({len(final_df)} rows)")
-            else:
-                print(f"   -> No valid data found for {site_name}/{var_name}.")
-
-    print("\n=== ALL CSVs HAVE BEEN GENERATED SUCCESSFULLY ===")
+                results = read_rasters(pool, files, dead_letters)
+
+                matrix = None
+                if config.TIME_MATRIX_OUTPUT:
+                    # Filled in the same pass as the tables
+                    matrix = TimeMatrixWriter(site_name, var_name, files)
+                    results = fill_matrix(results, matrix)
+
+                try:
+                    # Parent-side record: waiting on the pool, assembly and writing
+                    with instr.task("extract", site=site_name, variable=var_name, files=len(files)):
+                        if config.TABLE_FORMAT == "parquet":
+                            # Stream row groups, nothing is accumulated for the whole archive
+                            save_parquet(results, site_name, var_name)
+                        else:
+                            # Results keep the file order, so rows come out as in a serial run
+                            save_csv(results, csv_output_dir, site_name, var_name)
+                except BaseException:
+                    if matrix is not None:
+                        matrix.abort()
+                    raise
+
+                if matrix is not None and matrix.close():
+                    print(f"   -> SAVED: {matrix.paths[0]} {matrix.shape}")
+
+    write_dead_letters(os.path.join(config.PATH_DEAD_LETTER, "extract.jsonl"), dead_letters)
+
+    print(f"\n=== ALL {config.TABLE_FORMAT.upper()} TABLES HAVE BEEN GENERATED SUCCESSFULLY ===")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,250 @@
+"""
+Opt-in per-task instrumentation (config.INSTRUMENTATION).
+
+While a task runs, the hot paths report into the active recorder:
+- stages: wall and CPU time per named stage ("load", "mask", "regrid",
+  "regrid.sum", "write", ...); nested stages share a prefix and overlap
+  their parent
+- counters: cache hits and misses ("mask_cache.memory_hit", "index_map.miss", ...)
+- bytes read (decoded pixels) and bytes written (output files)
+
+When the task ends, one JSON line is appended to
+`PATH_INSTRUMENTATION/events_<pid>.jsonl` (one file per process, so workers
+never interleave writes) with the stages, counters, bytes and the process
+peak RSS. Everything is a no-op when no task is active.
+
+The active task is per thread, so tasks on a thread pool keep separate
+records; helper threads of a task report into it through `bind`. CPU time is
+process-wide for a task on the main thread (process workers, sequential runs)
+and per thread for a task on a pool thread, where the process clock would also
+count the other tasks; the record's `cpu_clock` says which.
+
+Summarize the records per site and variable with:
+
+    python -m src.regrid_project.instrumentation [folder]
+"""
+import os
+import sys
+import glob
+import json
+import time
+import functools
+import threading
+import contextlib
+from . import config
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Recorder of the task running in each thread (absent = instrumentation idle)
+_STATE = threading.local()
+_IDLE = contextlib.nullcontext()
+
+def _active():
+    return getattr(_STATE, 'recorder', None)
+
+def _peak_rss_mb():
+    """High-water mark of this process' resident memory (MB), None if unknown."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, macOS bytes
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / (1024 * 1024), 1)
+    return None
+
+class TaskRecorder:
+    """Stage timings, counters and byte counts of one task."""
+
+    def __init__(self, kind, **fields):
+        self.fields = dict(kind=kind, **fields)
+        self.stages = {}
+        self.counters = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.started = time.time()
+        self.wall_start = time.perf_counter()
+        self.thread_clock = threading.current_thread() is not threading.main_thread()
+        self.cpu_clock = time.thread_time if self.thread_clock else time.process_time
+        self.cpu_start = self.cpu_clock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), self.cpu_clock()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            entry['wall'] += time.perf_counter() - wall
+            entry['cpu'] += self.cpu_clock() - cpu
+            entry['calls'] += 1
+
+    def finish(self, status):
+        """The JSON record of the task."""
+        record = dict(self.fields)
+        record.update({
+            'pid': os.getpid(),
+            'start': round(self.started, 3),
+            'status': status,
+            'wall': round(time.perf_counter() - self.wall_start, 6),
+            'cpu': round(self.cpu_clock() - self.cpu_start, 6),
+            'cpu_clock': "thread" if self.thread_clock else "process",
+            'stages': {name: {'wall': round(s['wall'], 6), 'cpu': round(s['cpu'], 6), 'calls': s['calls']}
+                       for name, s in self.stages.items()},
+            'counters': self.counters,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_rss_mb': _peak_rss_mb(),
+        })
+        return record
+
+def _write_record(record):
+    try:
+        os.makedirs(config.PATH_INSTRUMENTATION, exist_ok=True)
+        path = os.path.join(config.PATH_INSTRUMENTATION, f"events_{os.getpid()}.jsonl")
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        print(f"   [WARNING] Could not write instrumentation record: {e}")
+
+@contextlib.contextmanager
+def task(kind, **fields):
+    """Record one task (no-op unless config.INSTRUMENTATION; nested tasks join the outer one)."""
+    if not config.INSTRUMENTATION or _active() is not None:
+        yield None
+        return
+    recorder = _STATE.recorder = TaskRecorder(kind, **fields)
+    status = "ok"
+    try:
+        yield recorder
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _STATE.recorder = None
+        _write_record(recorder.finish(status))
+
+def bind(function):
+    """`function` reporting into the calling thread's task when run on another thread."""
+    recorder = _active()
+    if recorder is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        _STATE.recorder = recorder
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _STATE.recorder = None
+    return wrapper
+
+def stage(name):
+    """Context manager timing a stage of the active task."""
+    recorder = _active()
+    return recorder.stage(name) if recorder is not None else _IDLE
+
+def timed(name):
+    """Decorator: the whole function call is stage `name` of the active task."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            recorder = _active()
+            if recorder is None:
+                return function(*args, **kwargs)
+            with recorder.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    """Increment a counter of the active task (e.g. a cache hit)."""
+    recorder = _active()
+    if recorder is not None:
+        recorder.counters[name] = recorder.counters.get(name, 0) + n
+
+def add_bytes_read(n):
+    recorder = _active()
+    if recorder is not None:
+        recorder.bytes_read += int(n)
+
+def add_file_written(path):
+    """Count the size of a file the active task wrote."""
+    recorder = _active()
+    if recorder is not None:
+        try:
+            recorder.bytes_written += os.path.getsize(path)
+        except OSError:
+            pass
+
+def load_records(folder=None):
+    """All records in the instrumentation folder."""
+    records = []
+    for path in sorted(glob.glob(os.path.join(folder or config.PATH_INSTRUMENTATION, "events_*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass  # Truncated line from an interrupted run
+    return records
+
+def summarize(records):
+    """
+    Aggregate records per (kind, site, variable).
+
+    Returns:
+        dict: key -> {'tasks', 'errors', 'wall', 'cpu', 'stages': {name: wall},
+        'counters', 'bytes_read', 'bytes_written', 'peak_rss_mb'}
+    """
+    summary = {}
+    for record in records:
+        key = (record.get('kind'), record.get('site'), record.get('variable'))
+        entry = summary.setdefault(key, {'tasks': 0, 'errors': 0, 'wall': 0.0, 'cpu': 0.0, 'stages': {},
+                                         'counters': {}, 'bytes_read': 0, 'bytes_written': 0,
+                                         'peak_rss_mb': 0.0})
+        entry['tasks'] += 1
+        entry['errors'] += record.get('status') != "ok"
+        entry['wall'] += record.get('wall', 0.0)
+        entry['cpu'] += record.get('cpu', 0.0)
+        for name, values in record.get('stages', {}).items():
+            entry['stages'][name] = entry['stages'].get(name, 0.0) + values['wall']
+        for name, value in record.get('counters', {}).items():
+            entry['counters'][name] = entry['counters'].get(name, 0) + value
+        entry['bytes_read'] += record.get('bytes_read', 0)
+        entry['bytes_written'] += record.get('bytes_written', 0)
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'], record.get('peak_rss_mb') or 0.0)
+    return summary
+
+def print_summary(summary):
+    print("\n" + "="*60)
+    print("INSTRUMENTATION SUMMARY")
+    print("="*60)
+    for (kind, site, variable), entry in sorted(summary.items(), key=lambda item: str(item[0])):
+        print(f"\n{kind} | {site} | {variable}: {entry['tasks']} task(s), {entry['errors']} error(s)")
+        print(f"   wall {entry['wall']:.2f}s  cpu {entry['cpu']:.2f}s  "
+              f"(mean {entry['wall'] / entry['tasks']:.3f}s/task)  peak RSS {entry['peak_rss_mb']:.0f} MB")
+        print(f"   read {entry['bytes_read'] / 1e6:.1f} MB  written {entry['bytes_written'] / 1e6:.1f} MB")
+        for name, wall in sorted(entry['stages'].items(), key=lambda item: -item[1]):
+            share = 100.0 * wall / entry['wall'] if entry['wall'] else 0.0
+            print(f"   {name:<18} {wall:9.3f}s  {share:5.1f}%")
+        if entry['counters']:
+            print("   " + ", ".join(f"{name}={value}" for name, value in sorted(entry['counters'].items())))
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else None
+    records = load_records(folder)
+    if not records:
+        print(f"No instrumentation records in {folder or config.PATH_INSTRUMENTATION}")
+        sys.exit(1)
+    print_summary(summarize(records))
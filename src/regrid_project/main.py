@@ -1,11 +1,24 @@
 import os
 import glob
 import re
-from multiprocessing import Pool, Manager
+import time
 import geopandas as gpd
+import xarray as xr
 from src.regrid_project import config
 from src.regrid_project import mapbiomas_handler as mb_h
 from src.regrid_project import ecostress_handler as eco_h
+from src.regrid_project import instrumentation as instr
+from src.regrid_project.multiprocessing_config import MultiprocessingConfig, PerformanceMonitor
+from src.regrid_project.build_manifest import BuildManifest, output_fingerprint
+from src.regrid_project.datacube import CubeWriter
+from src.regrid_project.pipeline import AsyncWriter, prefetch
+from src.regrid_project.executor import TaskFailure, make_pool, run_tasks, write_dead_letters
+from src.regrid_project.scheduler import (MemoryScheduler, TaskMemoryProbe, estimate_task_memory,
+                                          memory_budget)
+
+# Worker state loaded once per process by init_worker: site name -> buffer GeoDataFrame
+_WORKER_SITES = {}
+
 def extract_year(filename):
     """Extract year from filename pattern 'doy2018...'"""
     match = re.search(r"doy(\d{4})", filename)
@@ -13,45 +26,486 @@ def extract_year(filename):
         return int(match.group(1))
     return None
 
-def process_single_file(args=None):
-    """Dual-mode function:
-    - If called with no arguments, act as the orchestrator that discovers sites/variables
-      and dispatches worker tasks to the process pool.
-    - If called with a single `args` tuple (filepath, output_dir, gdf_buffer), process
-      that single file and return the output path or an error message.
+def extract_acquisition_id(filename):
+    """Acquisition timestamp from filename pattern 'doy2018217153917'"""
+    match = re.search(r"doy(\d+)", filename)
+    if match:
+        return match.group(1)
+    return None
+
+def load_site_buffer(site_name, buffer_path):
+    """Read a site buffer shapefile (first geometry only), tagged with the site name."""
+    gdf_buffer = gpd.read_file(buffer_path)
+
+    # Ensure only 1 geometry (first) to avoid list problems
+    if len(gdf_buffer) > 1:
+        gdf_buffer = gdf_buffer.iloc[[0]]
+    gdf_buffer.name = site_name
+    return gdf_buffer
+
+def config_snapshot():
+    """Current values of the upper-case settings in config (re-applied in workers)."""
+    return {key: getattr(config, key) for key in dir(config) if key.isupper()}
+
+def init_worker(site_paths, settings=None, resources=None):
+    """Pool initializer: apply the parent's configuration and the worker's
+    thread/cache share, then load every site buffer and its SiteContext
+    (template, clip mask) once per worker process.
+
+    Returns the callable restoring the thread/cache settings (see
+    MultiprocessingConfig.apply_worker_resources).
     """
-    # Worker mode: process a single file (used by Pool.map)
-    if args is not None:
+    if settings:
+        for key, value in settings.items():
+            setattr(config, key, value)
+    restore_resources = MultiprocessingConfig.apply_worker_resources(resources)
+
+    try:
+        _WORKER_SITES.clear()
+        for site_name, buffer_path in site_paths.items():
+            gdf_buffer = load_site_buffer(site_name, buffer_path)
+            eco_h.get_site_context(gdf_buffer)
+            _WORKER_SITES[site_name] = gdf_buffer
+    except Exception:
+        if restore_resources is not None:
+            restore_resources()
+        raise
+    return restore_resources
+
+def resolve_buffer(site):
+    """Tasks carry a site name (looked up in the worker state) or a GeoDataFrame."""
+    if isinstance(site, str):
+        if site not in _WORKER_SITES:
+            # Worker started without the initializer (e.g. direct call): load on demand
+            _WORKER_SITES[site] = load_site_buffer(site, config.SITES[site])
+        return _WORKER_SITES[site]
+    return site
+
+def group_files_by_grid(eco_files, max_scenes=None):
+    """
+    Group files by source grid signature (read from headers only) and split
+    each group into chunks of at most `max_scenes` files.
+    """
+    max_scenes = max_scenes or config.BATCH_MAX_SCENES
+    groups = {}
+    for filepath in eco_files:
         try:
-            filepath, output_dir, gdf_buffer = args
+            signature = eco_h.file_grid_signature(filepath)
         except Exception as e:
-            return f"[ERROR] Invalid args for worker: {e}"
+            print(f"   [WARNING] Could not read header of {os.path.basename(filepath)}: {e}")
+            signature = filepath  # Unreadable file: own group, reported by the worker
+        groups.setdefault(signature, []).append(filepath)
+
+    chunks = []
+    for files in groups.values():
+        for start in range(0, len(files), max_scenes):
+            chunks.append(files[start:start + max_scenes])
+    return chunks
+
+def output_is_done(out_path):
+    """Worker-side skip check. With BUILD_MANIFEST the orchestrator only queues
+    out-of-date outputs, so an existing file is stale and gets overwritten."""
+    return not config.BUILD_MANIFEST and os.path.exists(out_path)
+
+def task_items(task):
+    """(filepath, output_dir) items behind a task, whatever the mode."""
+    if len(task) == 2:  # fused: (items, site)
+        return list(task[0])
+    if isinstance(task[0], list):  # batched: (filepaths, output_dir, site)
+        return [(filepath, task[1]) for filepath in task[0]]
+    return [(task[0], task[1])]  # single file: (filepath, output_dir, site)
+
+def filter_out_of_date(tasks, manifest, site_buffers):
+    """
+    Drop outputs that are up to date according to the build manifest.
+    Returns (remaining tasks, {out_path: expected record}) for the outputs queued.
+    Existing outputs without a record (written before the manifest existed) that
+    are newer than their inputs are recorded as built from the current record
+    instead of being rebuilt. Only file metadata is read; no raster is opened.
+    """
+    coverage_files = {}  # (site, year) -> MapBiomas file the mask would use
+    pending = {}
+    remaining = []
+    reasons = {}
+    seeded = 0
+    for task in tasks:
+        site_name = task[-1]
+        keep = []
+        for filepath, output_dir in task_items(task):
+            filename = os.path.basename(filepath)
+            out_path = os.path.join(output_dir, f"Regrid_{filename}")
+            year = extract_year(filename)
+            if year and (site_name, year) not in coverage_files:
+                coverage_files[(site_name, year)] = mb_h.find_coverage_file(year, site_buffers[site_name])
+            inputs = [filepath]
+            if year and coverage_files[(site_name, year)]:
+                inputs.append(coverage_files[(site_name, year)])
+
+            record = manifest.expected_record(inputs)
+            if manifest.is_up_to_date(out_path, record):
+                continue
+            reason = manifest.reason(out_path, record)
+            if (reason == "no build record"
+                    and os.path.getmtime(out_path) >= max(os.path.getmtime(path) for path in inputs)):
+                manifest.record(out_path, record)
+                seeded += 1
+                continue
+            reasons[reason] = reasons.get(reason, 0) + 1
+            pending[out_path] = record
+            keep.append((filepath, output_dir))
 
+        if not keep:
+            continue
+        if len(task) == 2:
+            remaining.append((keep, site_name))
+        elif isinstance(task[0], list):
+            remaining.append(([filepath for filepath, _ in keep], task[1], site_name))
+        else:
+            remaining.append(task)
+
+    if seeded:
+        print(f"   [BUILD] {seeded} existing output(s) without a build record adopted as up to date")
+        manifest.save()
+    for reason, count in sorted(reasons.items()):
+        print(f"   [BUILD] {count} output(s) to (re)build: {reason}")
+    return remaining, pending
+
+def task_labels(task):
+    """Site, variable(s), file count and first file of a task, for instrumentation."""
+    items = task_items(task)
+    # output_dir is OUTPUT_ROOT/<site>/<var>; fused tasks span several variables
+    variables = sorted({os.path.basename(output_dir) for _, output_dir in items})
+    return {
+        'site': os.path.basename(os.path.dirname(items[0][1])) if items else None,
+        'variable': "+".join(variables),
+        'files': len(items),
+        'file': os.path.basename(items[0][0]) if items else None,
+    }
+
+def describe_task(task):
+    """Short label of a task for retry and failure messages."""
+    items = task_items(task)
+    label = os.path.basename(items[0][0]) if items else "empty task"
+    return label if len(items) == 1 else f"{label} (+{len(items) - 1} scene(s))"
+
+def run_task(job):
+    """Run `worker(task)` for a (worker, task) job and return (task, result),
+    so results from imap_unordered can be matched to their task."""
+    worker, task = job
+    with instr.task("regrid", **task_labels(task)):
+        return task, worker(task)
+
+def run_admitted_task(job):
+    """run_task plus the memory the task added to its worker (for MemoryScheduler)."""
+    with TaskMemoryProbe() as probe:
+        out = run_task(job)
+    return out, probe.report()
+
+def run_unmeasured_task(job):
+    """run_task for MemoryScheduler without a measurement (thread backend)."""
+    return run_task(job), (None, 0, False, None)
+
+def write_output(result_da, diagnostics, out_path, source=None):
+    """
+    Write a regridded scene (and its diagnostics) as the "write" stage. The
+    diagnostics are written after the output and stamped with the pipeline
+    fingerprint, so readers can tell them from those of an older build.
+    """
+    with instr.stage("write"):
+        result_da.rio.to_raster(out_path)
+        instr.add_file_written(out_path)
+        if diagnostics is not None:
+            stamp = output_fingerprint()
+            for path in eco_h.write_diagnostics(diagnostics, out_path, source, stamp):
+                instr.add_file_written(path)
+
+def append_to_cubes(task, cube_writers, run_start):
+    """Append the outputs of a finished task to the site/variable datacubes."""
+    for filepath, output_dir in task_items(task):
+        out_path = os.path.join(output_dir, f"Regrid_{os.path.basename(filepath)}")
+        if not os.path.exists(out_path) or os.path.getmtime(out_path) < run_start:
+            continue
+        # output_dir is OUTPUT_ROOT/<site>/<var>
+        site_name = os.path.basename(os.path.dirname(output_dir))
+        var_name = os.path.basename(output_dir)
+        if (site_name, var_name) not in cube_writers:
+            cube_writers[(site_name, var_name)] = CubeWriter(site_name, var_name)
+        try:
+            cube_writers[(site_name, var_name)].add_from_file(out_path, os.path.basename(filepath))
+        except Exception as e:
+            print(f"      [ERROR] Datacube append failed for {out_path}: {e}")
+
+def flush_cubes(cube_writers):
+    """
+    Backfill every site/variable cube with the outputs on disk it is missing
+    (up-to-date outputs never reach append_to_cubes), then write the buffered
+    scenes in time order.
+    """
+    for site_name in config.SITES:
+        for var_name in config.VARIABLES:
+            output_dir = os.path.join(config.OUTPUT_ROOT, site_name, var_name)
+            if not glob.glob(os.path.join(output_dir, "Regrid_*.tif")):
+                continue
+            try:
+                if (site_name, var_name) not in cube_writers:
+                    cube_writers[(site_name, var_name)] = CubeWriter(site_name, var_name)
+                queued = cube_writers[(site_name, var_name)].backfill(output_dir)
+                if queued:
+                    print(f"   [CUBE] {site_name}/{var_name}: backfilling {queued} existing output(s)")
+            except Exception as e:
+                print(f"   [ERROR] Datacube backfill failed for {site_name}/{var_name}: {e}")
+    # Single writer: buffered scenes are written in time order
+    for (site_name, var_name), writer in cube_writers.items():
+        if not writer.buffer:
+            continue
+        try:
+            writer.flush()
+            print(f"   [CUBE] {site_name}/{var_name} -> {writer.path}")
+        except Exception as e:
+            print(f"   [ERROR] Datacube write failed for {site_name}/{var_name}: {e}")
+
+def estimate_task_cost(task):
+    """Bytes of input behind a task (batched and fused tasks sum their files)."""
+    paths = task[0] if isinstance(task[0], list) else [task[0]]
+    total = 0
+    for path in paths:
+        if isinstance(path, tuple):
+            path = path[0]
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+def regrid_scene_group(items, gdf_buffer):
+    """Regrid a group of scenes with shared work.
+
+    `items` is a list of (filepath, output_dir). Scenes are grouped by their
+    clipped grid; within a group the forest mask is built once per MapBiomas
+    year, all scenes are stacked into a (time, y, x) array and aggregated in
+    one call, and all outputs are written at the end.
+    Returns a list of status messages (one per file).
+    """
+    messages = []
+    stacks = {}  # grid signature -> list of (filename, out_path, scene, forest mask)
+    masks = {}   # (grid signature, year) -> forest mask shared by the scenes
+    for filepath, output_dir in items:
         filename = os.path.basename(filepath)
         out_path = os.path.join(output_dir, f"Regrid_{filename}")
 
-        # Skip if already processed
-        if os.path.exists(out_path):
-            return f"[SKIP] {filename} (already exists)"
+        if output_is_done(out_path):
+            messages.append(f"[SKIP] {filename} (already exists)")
+            continue
 
         year = extract_year(filename)
         if not year:
-            return f"[SKIP] {filename} (year not identified)"
+            messages.append(f"[SKIP] {filename} (year not identified)")
+            continue
 
         eco_da = eco_h.load_ecostress(filepath, gdf_buffer)
         if eco_da is None:
-            return f"[ERROR] {filename} (failed to load ECOSTRESS)"
+            messages.append(f"[ERROR] {filename} (failed to load ECOSTRESS)")
+            continue
 
-        mask = mb_h.create_forest_mask(eco_da, year, gdf_buffer)
+        # Same header should give the same clipped grid; group again to be safe
+        signature = eco_h.grid_signature(eco_da)
+        if (signature, year) not in masks:
+            masks[(signature, year)] = mb_h.create_forest_mask(eco_da, year, gdf_buffer)
+        mask = masks[(signature, year)]
         if mask is None:
-            return f"[ERROR] {filename} (failed to create mask)"
+            messages.append(f"[ERROR] {filename} (failed to create mask)")
+            continue
 
-        result_da = eco_h.apply_mask_and_regrid_centered(eco_da, mask, gdf_buffer)
-        if result_da is None:
-            return f"[ERROR] {filename} (regrid failed)"
+        stacks.setdefault(signature, []).append((filename, out_path, eco_da, mask))
 
+    for scenes in stacks.values():
+        filenames = [scene[0] for scene in scenes]
         try:
-            result_da.rio.to_raster(out_path)
+            eco_stack = xr.concat([scene[2] for scene in scenes], dim='time').assign_coords(time=filenames)
+            if all(scene[3] is scenes[0][3] for scene in scenes):
+                # One shared mask (e.g. all variables of one acquisition)
+                mask_stack = scenes[0][3]
+            else:
+                mask_stack = xr.concat([scene[3] for scene in scenes], dim='time').assign_coords(time=filenames)
+            result_stack = eco_h.apply_mask_and_regrid_stack(
+                eco_stack, mask_stack, gdf_buffer, return_diagnostics=config.WRITE_DIAGNOSTICS)
+            if config.WRITE_DIAGNOSTICS:
+                result_stack, diagnostics = result_stack
+        except Exception as e:
+            messages.extend(f"[ERROR] {filename} (regrid failed: {e})" for filename in filenames)
+            continue
+
+        for i, (filename, out_path, eco_da, mask) in enumerate(scenes):
+            try:
+                if config.WRITE_DIAGNOSTICS:
+                    write_output(result_stack.isel(time=i, drop=True), diagnostics.isel(time=i, drop=True),
+                                 out_path, (eco_da, mask))
+                else:
+                    write_output(result_stack.isel(time=i, drop=True), None, out_path)
+                messages.append(f"[OK] {filename} -> {out_path}")
+            except Exception as e:
+                messages.append(f"[ERROR] {filename} (saving failed: {e})")
+
+    return messages
+
+def read_scene(filepath, output_dir, gdf_buffer):
+    """
+    Input stage of one scene: (filename, out_path, year, clipped scene), or a
+    status message when the scene is skipped or cannot be read.
+    """
+    filename = os.path.basename(filepath)
+    out_path = os.path.join(output_dir, f"Regrid_{filename}")
+
+    # Skip if already processed
+    if output_is_done(out_path):
+        return f"[SKIP] {filename} (already exists)"
+
+    year = extract_year(filename)
+    if not year:
+        return f"[SKIP] {filename} (year not identified)"
+
+    eco_da = eco_h.load_ecostress(filepath, gdf_buffer)
+    if eco_da is None:
+        return f"[ERROR] {filename} (failed to load ECOSTRESS)"
+    return filename, out_path, year, eco_da
+
+def regrid_scene(scene, gdf_buffer):
+    """
+    Compute stage of one scene (output of read_scene): (result, diagnostics,
+    (scene, forest mask)) with WRITE_DIAGNOSTICS, else (result, None, None);
+    or a status message on failure.
+    """
+    filename, _, year, eco_da = scene
+    mask = mb_h.create_forest_mask(eco_da, year, gdf_buffer)
+    if mask is None:
+        return f"[ERROR] {filename} (failed to create mask)"
+
+    result_da = eco_h.apply_mask_and_regrid_centered(
+        eco_da, mask, gdf_buffer, return_diagnostics=config.WRITE_DIAGNOSTICS)
+    if result_da is None:
+        return f"[ERROR] {filename} (regrid failed)"
+    if config.WRITE_DIAGNOSTICS:
+        return (*result_da, (eco_da, mask))
+    return result_da, None, None
+
+def process_file_pipeline(args):
+    """Worker for pipelined mode: regrid a chunk of files with overlapped I/O.
+
+    `args` is (filepaths, output_dir, site), like batched mode, but scenes are
+    regridded one by one: threads read up to PREFETCH_DEPTH scenes ahead while
+    the worker computes, and a writer thread saves the outputs (at most
+    WRITE_QUEUE_DEPTH waiting). Returns a list of status messages (one per file).
+    """
+    try:
+        filepaths, output_dir, site = args
+        gdf_buffer = resolve_buffer(site)
+    except Exception as e:
+        return [f"[ERROR] Invalid args for pipeline worker: {e}"]
+
+    def read(filepath):
+        scene = read_scene(filepath, output_dir, gdf_buffer)
+        if not isinstance(scene, str):
+            scene[3].load()  # Decode here, on the reader thread
+        return scene
+
+    messages = {}
+    with AsyncWriter(config.WRITE_QUEUE_DEPTH) as writer:
+        # bind: reads and writes are recorded in this task's instrumentation
+        for filepath, scene in prefetch(instr.bind(read), filepaths, config.PREFETCH_THREADS,
+                                        config.PREFETCH_DEPTH):
+            filename = os.path.basename(filepath)
+            if isinstance(scene, Exception):
+                messages[filepath] = f"[ERROR] {filename} (failed to load ECOSTRESS: {scene})"
+                continue
+            regridded = scene if isinstance(scene, str) else regrid_scene(scene, gdf_buffer)
+            if isinstance(regridded, str):
+                messages[filepath] = regridded
+                continue
+            del scene  # Only the small regridded result waits for the writer (plus the source with diagnostics)
+            out_path = os.path.join(output_dir, f"Regrid_{filename}")
+            result_da, diagnostics, source = regridded
+            writer.submit(filepath, instr.bind(write_output), result_da, diagnostics, out_path, source)
+            messages[filepath] = f"[OK] {filename} -> {out_path}"
+
+    for filepath, error in writer.errors.items():
+        messages[filepath] = f"[ERROR] {os.path.basename(filepath)} (saving failed: {error})"
+    return [messages[filepath] for filepath in filepaths]
+
+def process_file_batch(args):
+    """Worker for batched mode: regrid a list of files sharing a source grid.
+
+    `args` is (filepaths, output_dir, site), where site is a site name or a
+    buffer GeoDataFrame. Returns a list of status messages (one per file).
+    """
+    try:
+        filepaths, output_dir, site = args
+        gdf_buffer = resolve_buffer(site)
+    except Exception as e:
+        return [f"[ERROR] Invalid args for batch worker: {e}"]
+
+    return regrid_scene_group([(filepath, output_dir) for filepath in filepaths], gdf_buffer)
+
+def process_acquisition(args):
+    """Worker for fused mode: regrid every variable of one acquisition.
+
+    `args` is (items, site) with items = [(filepath, output_dir), ...], one per
+    variable. The variables share one forest mask and one aggregation map and
+    are written to their own OUTPUT_ROOT/<site>/<var> folders.
+    Returns a list of status messages (one per file).
+    """
+    try:
+        items, site = args
+        gdf_buffer = resolve_buffer(site)
+    except Exception as e:
+        return [f"[ERROR] Invalid args for acquisition worker: {e}"]
+
+    return regrid_scene_group(items, gdf_buffer)
+
+def group_files_by_acquisition(files_by_var):
+    """
+    Group one site's files across variables by acquisition timestamp ('doy...').
+    `files_by_var` maps variable -> (files, output_dir). Returns a list of item
+    lists [(filepath, output_dir), ...], one per acquisition.
+    """
+    groups = {}
+    for var_name, (files, output_dir) in files_by_var.items():
+        for filepath in files:
+            acquisition = extract_acquisition_id(os.path.basename(filepath)) or filepath
+            group = groups.setdefault(acquisition, {})
+            # Two files of one variable with the same timestamp: keep them apart
+            while var_name in group:
+                acquisition = (acquisition, filepath)
+                group = groups.setdefault(acquisition, {})
+            group[var_name] = (filepath, output_dir)
+    return [list(group.values()) for group in groups.values()]
+
+def process_single_file(args=None):
+    """Dual-mode function:
+    - If called with no arguments, act as the orchestrator that discovers sites/variables
+      and dispatches worker tasks to the process pool.
+    - If called with a single `args` tuple (filepath, output_dir, site), process
+      that single file and return the output path or an error message. `site` is a
+      site name loaded by init_worker (or a buffer GeoDataFrame).
+    """
+    # Worker mode: process a single file (used by Pool.map)
+    if args is not None:
+        try:
+            filepath, output_dir, site = args
+            gdf_buffer = resolve_buffer(site)
+        except Exception as e:
+            return f"[ERROR] Invalid args for worker: {e}"
+
+        scene = read_scene(filepath, output_dir, gdf_buffer)
+        if isinstance(scene, str):
+            return scene
+        regridded = regrid_scene(scene, gdf_buffer)
+        if isinstance(regridded, str):
+            return regridded
+
+        filename, out_path = scene[0], scene[1]
+        try:
+            result_da, diagnostics, source = regridded
+            write_output(result_da, diagnostics, out_path, source)
             return f"[OK] {filename} -> {out_path}"
         except Exception as e:
             return f"[ERROR] {filename} (saving failed: {e})"
@@ -59,31 +513,41 @@ def process_single_file(args=None):
     # Orchestrator mode: no args provided
     print("=== STARTING BATCH PROCESSING (MULTI-SITES / MULTI-VARS) ===")
 
-    # Get number of CPU cores available
-    num_workers = os.cpu_count() or 4
-    print(f"Using {num_workers} CPU cores for parallel processing")
+    # Get number of CPU cores available (or the configured worker count)
+    num_workers = config.NUM_WORKERS or os.cpu_count() or 4
+    print(f"Using {num_workers} {config.EXECUTION_BACKEND} workers for parallel processing")
 
-    # 1. Loop through SITES
+    # Check site buffers before starting the pool
+    site_paths = {}
     for site_name, buffer_path in config.SITES.items():
-        print(f"\n##################################################")
-        print(f"### SITE: {site_name}")
-        print(f"##################################################")
-
-        # Load Site Buffer
         if not os.path.exists(buffer_path):
             print(f"[ERROR] Shapefile not found: {buffer_path}")
             continue
+        site_paths[site_name] = buffer_path
 
-        print(f"Loading Buffer: {os.path.basename(buffer_path)}")
-        gdf_buffer = gpd.read_file(buffer_path)
+    if config.FUSE_VARIABLES:
+        print("Fused mode: one task per acquisition across variables")
+        worker = process_acquisition
+    elif config.BATCH_MODE:
+        worker = process_file_batch
+    elif config.PIPELINE_CHUNK:
+        print(f"Pipelined mode: chunks of {config.PIPELINE_CHUNK} scenes, "
+              f"{config.PREFETCH_THREADS} reader thread(s), {config.PREFETCH_DEPTH} scene(s) read ahead")
+        worker = process_file_pipeline
+    else:
+        worker = process_single_file
 
-        # Ensure only 1 geometry (first) to avoid list problems
-        if len(gdf_buffer) > 1:
-            gdf_buffer = gdf_buffer.iloc[[0]]
+    # 1. Collect every (site, variable, file) task into one global queue
+    tasks = []
+    for site_name in site_paths:
+        print(f"\n##################################################")
+        print(f"### SITE: {site_name}")
+        print(f"##################################################")
+        files_by_var = {}
 
         # 2. Loop through VARIABLES
         for var_name in config.VARIABLES:
-            print(f"\n   >>> Processing Variable: {var_name}")
+            print(f"\n   >>> Collecting Variable: {var_name}")
 
             # -----------------------------------------------------------
             # INTELLIGENT PATH CONSTRUCTION
@@ -109,17 +573,132 @@ def process_single_file(args=None):
                 continue
 
             # 3. Prepare arguments for parallel processing
-            # Create list of tuples (filepath, output_dir, gdf_buffer) for each file
-            task_args = [(filepath, output_dir, gdf_buffer) for filepath in eco_files]
+            if config.FUSE_VARIABLES:
+                # Grouped across variables once the site is fully listed
+                files_by_var[var_name] = (eco_files, output_dir)
+            elif config.BATCH_MODE:
+                # One task per chunk of files sharing a source grid
+                chunks = group_files_by_grid(eco_files)
+                print(f"   Batched mode: {len(chunks)} stack(s) of up to {config.BATCH_MAX_SCENES} scenes")
+                tasks.extend((chunk, output_dir, site_name) for chunk in chunks)
+            elif config.PIPELINE_CHUNK:
+                # One task per chunk of files, regridded scene by scene with overlapped I/O
+                chunks = [eco_files[start:start + config.PIPELINE_CHUNK]
+                          for start in range(0, len(eco_files), config.PIPELINE_CHUNK)]
+                tasks.extend((chunk, output_dir, site_name) for chunk in chunks)
+            else:
+                # Create list of tuples (filepath, output_dir, site_name) for each file
+                tasks.extend((filepath, output_dir, site_name) for filepath in eco_files)
+
+        if files_by_var:
+            acquisitions = group_files_by_acquisition(files_by_var)
+            print(f"\n   Fused mode: {len(acquisitions)} acquisition(s) for {site_name}")
+            tasks.extend((items, site_name) for items in acquisitions)
+
+    if not tasks:
+        print("\n[WARNING] No input files found.")
+        return
+
+    # Incremental build: only queue outputs whose inputs, parameters or code changed
+    manifest = None
+    pending = {}
+    site_buffers = None
+    if config.BUILD_MANIFEST or config.MEMORY_ADMISSION:
+        site_buffers = {site: load_site_buffer(site, path) for site, path in site_paths.items()}
+    if config.BUILD_MANIFEST:
+        manifest = BuildManifest()
+        total_outputs = sum(len(task_items(task)) for task in tasks)
+        tasks, pending = filter_out_of_date(tasks, manifest, site_buffers)
+        print(f"\nBuild manifest: {total_outputs - len(pending)} up to date, {len(pending)} to build")
+        if not tasks:
+            if config.DATACUBE_OUTPUT:
+                flush_cubes({})
+            print("\n=== EVERYTHING UP TO DATE ===")
+            return
 
-            # 4. Process files in parallel
-            print(f"   Starting parallel processing with {num_workers} workers...")
-            with Pool(processes=num_workers) as pool:
-                results = pool.map(process_single_file, task_args)
+    # 4. Largest inputs first so they do not end up as stragglers at the end
+    estimates = None
+    if config.MEMORY_ADMISSION:
+        # Peak memory per task from the raster headers, also the best cost measure
+        # (a pipelined task only holds the scene being regridded plus those read ahead)
+        held = config.PREFETCH_DEPTH if worker is process_file_pipeline else None
+        estimates = [estimate_task_memory(task_items(task), site_buffers[task[-1]], held_scenes=held)
+                     for task in tasks]
+        order = sorted(range(len(tasks)), key=lambda i: estimates[i], reverse=True)
+        tasks = [tasks[i] for i in order]
+        estimates = [estimates[i] for i in order]
+    else:
+        tasks.sort(key=estimate_task_cost, reverse=True)
+    # Deadline per task grows with the scenes it holds (batched/fused tasks)
+    timeouts = [MultiprocessingConfig.get_task_timeout(len(task_items(task))) for task in tasks]
 
-            # 5. Display results
-            for result in results:
-                print(f"      {result}")
+    # 5. One long-lived pool for the whole run; each worker loads buffers,
+    # templates and configuration once, so tasks only carry identifiers.
+    # Hung or crashed workers are replaced and their task retried.
+    print(f"\nDispatching {len(tasks)} task(s) to {num_workers} workers "
+          f"(timeout {MultiprocessingConfig.TASK_TIMEOUT_SECONDS}s per scene, "
+          f"{MultiprocessingConfig.MAX_TASK_RETRIES} retries)...")
+    monitor = PerformanceMonitor("Regrid", len(tasks))
+    monitor.start()
+    run_start = time.time() - 1.0  # Margin for coarse filesystem timestamps
+    cube_writers = {}  # (site, var) -> CubeWriter, only used with DATACUBE_OUTPUT
+    scheduler = None
+    dead_letters = []
+    try:
+        # Cores and GDAL cache split between the workers (no oversubscription)
+        resources = MultiprocessingConfig.get_worker_resources(num_workers, config.EXECUTION_BACKEND)
+        print(MultiprocessingConfig.describe_worker_resources(num_workers, resources))
+        with make_pool(config.EXECUTION_BACKEND, num_workers, initializer=init_worker,
+                       initargs=(site_paths, config_snapshot(), resources)) as pool:
+            # Results stream back as soon as each task finishes
+            jobs = [(worker, task) for task in tasks]
+            task_function = run_task
+            # Budget measured once the workers exist, so their baseline is excluded
+            budget = memory_budget() if estimates is not None else None
+            if budget is not None:
+                scheduler = MemoryScheduler(budget, estimates, getattr(pool, 'worker_pids', None))
+                # Process RSS only measures a task when it has the process to itself
+                if config.EXECUTION_BACKEND == "process":
+                    task_function = run_admitted_task
+                else:
+                    task_function = run_unmeasured_task
+                print(f"Memory admission: budget {budget / 2**20:.0f} MB, "
+                      f"largest task ~{estimates[0] / 2**20:.0f} MB")
+            elif estimates is not None:
+                print("[WARNING] MEMORY_ADMISSION needs psutil or MEMORY_BUDGET_MB; dispatching without it")
+            results = run_tasks(pool, task_function, jobs, timeouts=timeouts,
+                                retries=MultiprocessingConfig.MAX_TASK_RETRIES, admission=scheduler,
+                                describe=lambda job: describe_task(job[1]))
+            for index, outcome in results:
+                if isinstance(outcome, TaskFailure):
+                    task = tasks[index]
+                    dead_letters.append({'task': describe_task(task), 'site': task[-1],
+                                         'files': [filepath for filepath, _ in task_items(task)],
+                                         'error': outcome.error, 'attempts': outcome.attempts})
+                    monitor.update()
+                    continue
+                task, result = outcome
+                messages = result if isinstance(result, list) else [result]
+                for message in messages:
+                    print(f"      {message}")
+                if config.DATACUBE_OUTPUT:
+                    append_to_cubes(task, cube_writers, run_start)
+                monitor.update()
+    finally:
+        write_dead_letters(os.path.join(config.PATH_DEAD_LETTER, "regrid.jsonl"), dead_letters)
+        if config.DATACUBE_OUTPUT:
+            flush_cubes(cube_writers)
+        if manifest is not None:
+            # Record outputs written during this run (also after an interruption)
+            for out_path, record in pending.items():
+                if os.path.exists(out_path) and os.path.getmtime(out_path) >= run_start:
+                    manifest.record(out_path, record)
+            manifest.save()
+    monitor.stop()
+    if scheduler is not None:
+        print(f"  Memory admission: peak reserved {scheduler.peak_committed / 2**20:.0f} MB, "
+              f"retained by workers {scheduler.peak_retained / 2**20:.0f} MB at most, "
+              f"{scheduler.waits} wait(s), estimate scale {scheduler.scale:.2f}")
 
     print("\n=== PROCESSING COMPLETED SUCCESSFULLY ===")
     print("\n=== To extract time series, run the extraction code: extract_to_csv.py ===")
@@ -1,11 +1,37 @@
 import os
 import glob
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import xarray as xr
 import rioxarray as rxr
 from rasterio.enums import Resampling
 from . import config
+from . import instrumentation as instr
+from .multiprocessing_config import MultiprocessingConfig
+from .ecostress_handler import get_site_context, grid_signature
 import geopandas as gpd
-import os
-import glob
+
+# Pre-cut manifest index, loaded once per process (reloaded if the manifest changes)
+_PRECUT_INDEX = None
+
+# In-process LRU of forest masks: cache key -> (coverage file signature, boolean array)
+_MASK_CACHE = OrderedDict()
+# Guards the LRU when tasks run on threads (config.EXECUTION_BACKEND)
+_MASK_CACHE_LOCK = threading.Lock()
+
+def get_effective_year(year, verbose=True):
+    """
+    MapBiomas year actually used for an acquisition year.
+    Fallback Logic: If year is 2025, use 2024.
+    """
+    if year >= 2025:
+        if verbose:
+            print(f"   -> [WARNING] MapBiomas {year} not available. Using MapBiomas 2024 as reference.")
+        return 2024
+    return year
 
 def get_mapbiomas_file(year):
     """
@@ -13,11 +39,7 @@ def get_mapbiomas_file(year):
     Fallback Logic: If year is 2025, use 2024.
     """
     # === FALLBACK LOGIC ===
-    if year >= 2025:
-        print(f"   -> [WARNING] MapBiomas {year} not available. Using MapBiomas 2024 as reference.")
-        target_year = 2024
-    else:
-        target_year = year
+    target_year = get_effective_year(year)
 
     pattern = os.path.join(config.PATH_MAPBIOMAS_DIR, f"{target_year}_coverage_*.tif")
     files = glob.glob(pattern)
@@ -27,54 +49,243 @@ def get_mapbiomas_file(year):
         return None
     return files[0]
 
-def create_forest_mask(ecostress_data_array, year, gdf_buffer):
-    """
-    1. Open MapBiomas (With year fallback if necessary).
-    2. Box Clipping (Memory Optimized).
-    3. Fine Clipping + Reprojection.
-    """
-    # First: check if there is a pre-cut MapBiomas file for this site/year
-    # Expected location: PATH_MAPBIOMAS_CUT/<SITE>/<year>_coverage_*.tif
+def _get_site_name(gdf_buffer):
+    """Site name attached to the buffer GeoDataFrame, if any."""
     try:
-        site_name = None
         # Attempt to infer site name from buffer if possible
         if hasattr(gdf_buffer, 'name') and gdf_buffer.name:
-            site_name = gdf_buffer.name
+            return gdf_buffer.name
     except:
-        site_name = None
+        pass
+    return None
+
+class PrecutIndex:
+    """
+    In-memory index over the pre-cut manifest: a (site, year) dictionary plus
+    per-year bounding-box arrays for buffers without a site name.
+    """
+
+    def __init__(self, entries, root, manifest_mtime=None):
+        self.manifest_mtime = manifest_mtime
+        self.by_site_year = {}
+        self.by_year = {}
+        for entry in entries:
+            entry = dict(entry)
+            entry['path'] = os.path.join(root, entry['path'])
+            self.by_site_year.setdefault((entry['site'], entry['year']), entry)
+            self.by_year.setdefault(entry['year'], []).append(entry)
+        self.bounds_by_year = {
+            year: np.array([entry['bounds'] for entry in year_entries], dtype=float)
+            for year, year_entries in self.by_year.items()
+        }
+
+    def lookup(self, site, year):
+        """Manifest entry for a named site, or None."""
+        return self.by_site_year.get((site, year))
+
+    def query(self, year, gdf_buffer):
+        """
+        Entry whose bounds overlap the buffer the most, or None.
+        Buffer bounds come from the cached site context (no raster I/O).
+        """
+        entries = self.by_year.get(year)
+        if not entries:
+            return None
+        context = get_site_context(gdf_buffer)
+        buf = np.array([context.buffer_in(entry['crs']).total_bounds for entry in entries])
+        bounds = self.bounds_by_year[year]
+        overlap_x = np.minimum(bounds[:, 2], buf[:, 2]) - np.maximum(bounds[:, 0], buf[:, 0])
+        overlap_y = np.minimum(bounds[:, 3], buf[:, 3]) - np.maximum(bounds[:, 1], buf[:, 1])
+        overlap = np.where((overlap_x >= 0) & (overlap_y >= 0), overlap_x * overlap_y, -1.0)
+        best = int(np.argmax(overlap))
+        return entries[best] if overlap[best] >= 0 else None
+
+def get_precut_index():
+    """
+    PrecutIndex built from config.PATH_MAPBIOMAS_MANIFEST, or None if there is
+    no manifest (run prepare_mapbiomas_masks.py to create it).
+    """
+    global _PRECUT_INDEX
+    manifest_path = config.PATH_MAPBIOMAS_MANIFEST
+    try:
+        mtime = os.stat(manifest_path).st_mtime_ns
+    except OSError:
+        return None
+    if _PRECUT_INDEX is None or _PRECUT_INDEX.manifest_mtime != mtime:
+        try:
+            with open(manifest_path) as f:
+                entries = json.load(f)['entries']
+        except Exception as e:
+            print(f"[WARNING] Could not read MapBiomas manifest {manifest_path}: {e}")
+            return None
+        _PRECUT_INDEX = PrecutIndex(entries, os.path.dirname(manifest_path), mtime)
+    return _PRECUT_INDEX
+
+def find_precut_file(year, gdf_buffer):
+    """
+    Look for a pre-cut MapBiomas file for this site/year.
+    Expected location: PATH_MAPBIOMAS_CUT/<SITE>/<year>_coverage_*.tif
+
+    Uses the manifest index when available (dictionary / bounds query only);
+    otherwise falls back to globbing the site folders and opening rasters.
+    """
+    if not os.path.isdir(config.PATH_MAPBIOMAS_CUT):
+        return None
+
+    site_name = _get_site_name(gdf_buffer)
+    index = get_precut_index()
+    if index is not None:
+        entry = index.lookup(site_name, year) if site_name else None
+        if entry is None:
+            entry = index.query(year, gdf_buffer)
+        if entry is not None and os.path.exists(entry['path']):
+            return entry['path']
+        return None
+
+    # If site_name known, look there first
+    if site_name:
+        candidate_dir = os.path.join(config.PATH_MAPBIOMAS_CUT, site_name)
+        pattern = os.path.join(candidate_dir, f"{year}_coverage_*.tif")
+        files = glob.glob(pattern) if os.path.isdir(candidate_dir) else []
+        if files:
+            return files[0]
 
     # If caller provided a GeoDataFrame without name, attempt to match by spatial intersection
     # We'll check any pre-cut files per site and load the first matching site folder
-    precut_path = None
-    if os.path.isdir(config.PATH_MAPBIOMAS_CUT):
-        # If site_name known, look there first
-        if site_name:
-            candidate_dir = os.path.join(config.PATH_MAPBIOMAS_CUT, site_name)
-            pattern = os.path.join(candidate_dir, f"{year}_coverage_*.tif")
-            files = glob.glob(pattern) if os.path.isdir(candidate_dir) else []
-            if files:
-                precut_path = files[0]
-
-        # If not found, check each site folder and test intersection with buffer
-        if precut_path is None:
-            for site, shp in config.SITES.items():
-                candidate_dir = os.path.join(config.PATH_MAPBIOMAS_CUT, site)
-                pattern = os.path.join(candidate_dir, f"{year}_coverage_*.tif")
-                files = glob.glob(pattern)
-                if not files:
-                    continue
-                # Quick spatial test: open the first file's bounds and compare to buffer bounds
-                try:
-                    mb_test = rxr.open_rasterio(files[0], masked=True)
-                    mb_bounds = mb_test.rio.bounds()
-                    minx, miny, maxx, maxy = mb_bounds
-                    buf_minx, buf_miny, buf_maxx, buf_maxy = gdf_buffer.total_bounds
-                    # If bounding boxes intersect, assume it's the right pre-cut file
-                    if not (maxx < buf_minx or minx > buf_maxx or maxy < buf_miny or miny > buf_maxy):
-                        precut_path = files[0]
-                        break
-                except Exception:
-                    continue
+    for site, shp in config.SITES.items():
+        candidate_dir = os.path.join(config.PATH_MAPBIOMAS_CUT, site)
+        pattern = os.path.join(candidate_dir, f"{year}_coverage_*.tif")
+        files = glob.glob(pattern)
+        if not files:
+            continue
+        # Quick spatial test: open the first file's bounds and compare to buffer bounds
+        try:
+            mb_test = rxr.open_rasterio(files[0], masked=True)
+            mb_bounds = mb_test.rio.bounds()
+            minx, miny, maxx, maxy = mb_bounds
+            buf_minx, buf_miny, buf_maxx, buf_maxy = gdf_buffer.total_bounds
+            # If bounding boxes intersect, assume it's the right pre-cut file
+            if not (maxx < buf_minx or minx > buf_maxx or maxy < buf_miny or miny > buf_maxy):
+                return files[0]
+        except Exception:
+            continue
+    return None
+
+def find_coverage_file(year, gdf_buffer):
+    """
+    MapBiomas file (pre-cut if available) that a mask for this acquisition
+    year would be built from. No raster I/O when the manifest exists.
+    """
+    effective_year = get_effective_year(year, verbose=False)
+    return find_precut_file(effective_year, gdf_buffer) or get_mapbiomas_file(effective_year)
+
+def _file_signature(path):
+    """(path, size, mtime) of the coverage file; changes when the file is replaced."""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+def _mask_cache_key(gdf_buffer, effective_year, ecostress_data_array):
+    """
+    Cache key: site (name and buffer geometry), effective MapBiomas year,
+    ECOSTRESS grid (transform/shape/CRS) and forest classes.
+    """
+    site_name = _get_site_name(gdf_buffer) or ""
+    geometry_hash = hashlib.sha1(gdf_buffer.geometry.iloc[0].wkb).hexdigest()
+    raw = repr((site_name, geometry_hash, effective_year, grid_signature(ecostress_data_array),
+                sorted(config.FOREST_CLASSES)))
+    return f"{site_name or 'site'}_{effective_year}_{hashlib.sha1(raw.encode()).hexdigest()[:20]}"
+
+def _mask_to_dataarray(mask_arr, ecostress_data_array):
+    """Wrap a cached boolean array with the ECOSTRESS coordinates."""
+    y_dim, x_dim = ecostress_data_array.rio.y_dim, ecostress_data_array.rio.x_dim
+    return xr.DataArray(
+        mask_arr,
+        coords={y_dim: ecostress_data_array[y_dim], x_dim: ecostress_data_array[x_dim]},
+        dims=(y_dim, x_dim)
+    )
+
+def _remember_mask(key, coverage_sig, mask_arr):
+    """Insert into the in-process LRU, evicting the oldest entries."""
+    with _MASK_CACHE_LOCK:
+        _MASK_CACHE[key] = (coverage_sig, mask_arr)
+        _MASK_CACHE.move_to_end(key)
+        while len(_MASK_CACHE) > config.MASK_CACHE_SIZE:
+            _MASK_CACHE.popitem(last=False)
+
+def _load_cached_mask(key, coverage_sig):
+    """
+    Boolean mask array from the LRU or the on-disk store, or None when missing
+    or built from a different version of the coverage file.
+    """
+    with _MASK_CACHE_LOCK:
+        entry = _MASK_CACHE.get(key)
+        if entry is not None and entry[0] == coverage_sig:
+            _MASK_CACHE.move_to_end(key)
+    if entry is not None and entry[0] == coverage_sig:
+        instr.count("mask_cache.memory_hit")
+        return entry[1]
+
+    disk_path = os.path.join(config.PATH_MASK_CACHE, f"{key}.npz")
+    if not os.path.exists(disk_path):
+        instr.count("mask_cache.miss")
+        return None
+    try:
+        with np.load(disk_path) as stored:
+            if json.loads(str(stored['coverage'])) != coverage_sig:
+                instr.count("mask_cache.miss")
+                return None
+            shape = tuple(stored['shape'])
+            mask_arr = np.unpackbits(stored['bits'], count=shape[0] * shape[1]).astype(bool).reshape(shape)
+    except Exception as e:
+        print(f"   -> [WARNING] Ignoring unreadable mask cache {disk_path}: {e}")
+        return None
+
+    _remember_mask(key, coverage_sig, mask_arr)
+    instr.count("mask_cache.file_hit")
+    return mask_arr
+
+def _store_cached_mask(key, coverage_sig, mask_arr):
+    """Save in the LRU and as a bit-packed file (atomic replace, safe across workers and threads)."""
+    _remember_mask(key, coverage_sig, mask_arr)
+    try:
+        os.makedirs(config.PATH_MASK_CACHE, exist_ok=True)
+        disk_path = os.path.join(config.PATH_MASK_CACHE, f"{key}.npz")
+        tmp_path = f"{disk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, bits=np.packbits(mask_arr.ravel()), shape=np.array(mask_arr.shape),
+                     coverage=np.array(json.dumps(coverage_sig)))
+        os.replace(tmp_path, disk_path)
+    except Exception as e:
+        print(f"   -> [WARNING] Could not write mask cache: {e}")
+
+@instr.timed("mask")
+def create_forest_mask(ecostress_data_array, year, gdf_buffer, use_cache=None):
+    """
+    1. Open MapBiomas (With year fallback if necessary).
+    2. Box Clipping (Memory Optimized).
+    3. Fine Clipping + Reprojection.
+
+    Masks are cached (in-process LRU + bit-packed files in PATH_MASK_CACHE) per
+    site, effective MapBiomas year and ECOSTRESS grid; an entry is rebuilt
+    when the coverage file changes. `use_cache` defaults to config.MASK_CACHE_ENABLED.
+    """
+    if use_cache is None:
+        use_cache = config.MASK_CACHE_ENABLED
+    effective_year = get_effective_year(year)
+
+    # First: check if there is a pre-cut MapBiomas file for this site/year
+    precut_path = find_precut_file(effective_year, gdf_buffer)
+    mb_path = None if precut_path else get_mapbiomas_file(effective_year)
+    coverage_path = precut_path or mb_path
+    if coverage_path is None:
+        return None
+
+    if use_cache:
+        key = _mask_cache_key(gdf_buffer, effective_year, ecostress_data_array)
+        coverage_sig = _file_signature(coverage_path)
+        cached = _load_cached_mask(key, coverage_sig)
+        if cached is not None:
+            return _mask_to_dataarray(cached, ecostress_data_array)
 
     if precut_path:
         try:
@@ -82,12 +293,13 @@ def create_forest_mask(ecostress_data_array, year, gdf_buffer):
         except Exception as e:
             print(f"[WARNING] Failed to open pre-cut MapBiomas {precut_path}: {e}")
             precut_path = None
+            mb_path = get_mapbiomas_file(effective_year)
 
     # If no pre-cut available, fall back to original behavior
     if not precut_path:
-        mb_path = get_mapbiomas_file(year)
         if mb_path is None:
             return None
+        coverage_path = mb_path
 
         # 1. Open MapBiomas with chunks
         mb_da = rxr.open_rasterio(mb_path, masked=True, chunks={'x': 2048, 'y': 2048}).squeeze()
@@ -96,7 +308,7 @@ def create_forest_mask(ecostress_data_array, year, gdf_buffer):
     if not mb_da.rio.crs:
         mb_da.rio.write_crs("EPSG:4326", inplace=True)
 
-    buffer_mb = gdf_buffer.to_crs(mb_da.rio.crs)
+    buffer_mb = get_site_context(gdf_buffer).buffer_in(mb_da.rio.crs)
 
     try:
         # If the data covers a broader area than the buffer, do a box crop to reduce memory
@@ -104,6 +316,7 @@ def create_forest_mask(ecostress_data_array, year, gdf_buffer):
         try:
             mb_box = mb_da.rio.clip_box(minx, miny, maxx, maxy, auto_expand=True)
             mb_box.load()
+            instr.add_bytes_read(mb_box.nbytes)
         except Exception:
             mb_box = mb_da
 
@@ -111,7 +324,8 @@ def create_forest_mask(ecostress_data_array, year, gdf_buffer):
         mb_clipped = mb_box.rio.clip(buffer_mb.geometry) if mb_box is not None else mb_da.rio.clip(buffer_mb.geometry)
         mb_reprojected = mb_clipped.rio.reproject_match(
             ecostress_data_array,
-            resampling=Resampling.nearest
+            resampling=Resampling.nearest,
+            num_threads=MultiprocessingConfig.get_warp_threads()
         )
     except Exception as e:
         print(f"[ERROR] Failed in geometric processing: {e}")
@@ -119,4 +333,8 @@ def create_forest_mask(ecostress_data_array, year, gdf_buffer):
     
     # 4. Create the mask
     mask = mb_reprojected.isin(config.FOREST_CLASSES)
+
+    if use_cache:
+        # Key the entry on the file the mask was actually built from
+        _store_cached_mask(key, _file_signature(coverage_path), np.asarray(mask.values, dtype=bool))
     return mask
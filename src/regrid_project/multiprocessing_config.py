@@ -6,9 +6,18 @@ behavior in the Regrid project.
 """
 
 import os
-import psutil
 from typing import Optional
 
+try:
+    import psutil
+except ImportError:  # Optional dependency (see requirements.txt)
+    psutil = None
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # Optional: resizes BLAS/OpenMP pools already loaded by NumPy
+    threadpool_limits = None
+
 class MultiprocessingConfig:
     """Configuration for multiprocessing parameters"""
     
@@ -21,9 +30,17 @@ class MultiprocessingConfig:
     WARN_MEMORY_THRESHOLD = 0.85      # Warn if memory > 85%
     ERROR_MEMORY_THRESHOLD = 0.95     # Error if memory > 95%
     
-    # Timeout settings
-    TASK_TIMEOUT_SECONDS = 300  # 5 minutes
-    POOL_TIMEOUT_SECONDS = 3600  # 1 hour
+    # Timeout settings (executor.WorkerPool kills and replaces a worker past its deadline)
+    TASK_TIMEOUT_SECONDS = 300  # 5 minutes per scene in a task
+    POOL_TIMEOUT_SECONDS = 3600  # 1 hour, upper bound for any single task
+    MAX_TASK_RETRIES = 2  # Extra attempts after a timeout, crash or exception
+    
+    # Thread and cache budget shared by the workers (see get_worker_resources)
+    THREADS_PER_WORKER = None   # GDAL/BLAS/OpenMP threads per worker (None = cores // workers)
+    GDAL_CACHE_FRACTION = 0.10  # Share of available memory for the GDAL block caches
+    GDAL_CACHE_MIN_MB = 32      # Floor per cache
+    BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                        "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
     
     # Batch processing
     BATCH_SIZE = None  # Auto-calculate if None
@@ -87,6 +104,146 @@ class MultiprocessingConfig:
             # If psutil not available, assume memory is OK
             return True
     
+    @classmethod
+    def get_task_timeout(cls, scenes: int = 1) -> Optional[float]:
+        """
+        Deadline for one task
+
+        Args:
+            scenes (int): Scenes processed by the task (batched/fused tasks hold several)
+
+        Returns:
+            float: Seconds before the worker is killed (None = no deadline)
+        """
+        if cls.TASK_TIMEOUT_SECONDS is None:
+            return cls.POOL_TIMEOUT_SECONDS
+        timeout = cls.TASK_TIMEOUT_SECONDS * max(1, scenes)
+        if cls.POOL_TIMEOUT_SECONDS is not None:
+            timeout = min(timeout, cls.POOL_TIMEOUT_SECONDS)
+        return timeout
+
+    @classmethod
+    def get_worker_resources(cls, workers: int, backend: str = "process") -> dict:
+        """
+        Split the cores and the GDAL cache budget between the workers, so N
+        workers with multithreaded GDAL and BLAS do not oversubscribe the machine
+        
+        Every task gets cores // workers GDAL warp threads. Worker processes
+        each have their own BLAS/OpenMP pool and GDAL block cache, so those get
+        the same share of the cores and of the cache budget. Thread workers
+        share one process: its single BLAS/OpenMP pool and GDAL cache are sized
+        for the whole process.
+        
+        Args:
+            workers (int): Number of workers in the pool
+            backend (str): Execution backend, "process" or "thread"
+        
+        Returns:
+            dict: 'backend', 'threads' (per task), 'blas_threads', 'gdal_cache_mb'
+            and 'env' (variable -> value)
+        """
+        workers = max(1, workers)
+        cores = os.cpu_count() or 1
+        threads = cls.THREADS_PER_WORKER or max(1, cores // workers)
+        per_process = backend == "process"
+        blas_threads = threads if per_process else cores
+        
+        if psutil is not None:
+            cache_budget_mb = psutil.virtual_memory().available / (1024 * 1024) * cls.GDAL_CACHE_FRACTION
+        else:
+            cache_budget_mb = workers * cls.MAX_MEMORY_PER_WORKER_MB * cls.GDAL_CACHE_FRACTION
+        cache_mb = max(cls.GDAL_CACHE_MIN_MB, int(cache_budget_mb / (workers if per_process else 1)))
+        
+        env = {"GDAL_NUM_THREADS": str(threads), "GDAL_CACHEMAX": str(cache_mb)}
+        env.update({name: str(blas_threads) for name in cls.BLAS_THREAD_VARS})
+        return {'backend': backend, 'threads': threads, 'blas_threads': blas_threads,
+                'gdal_cache_mb': cache_mb, 'env': env}
+    
+    @staticmethod
+    def user_env(resources: dict) -> dict:
+        """Variables of `resources` already set in the environment (kept as they are)"""
+        return {name: os.environ[name] for name in resources['env'] if name in os.environ}
+    
+    @classmethod
+    def apply_worker_resources(cls, resources: Optional[dict]):
+        """
+        Apply get_worker_resources() in a worker (pool initializer)
+        
+        Variables already set in the environment win. GDAL and BLAS may be
+        loaded before the worker starts (fork), so the GDAL cache is resized
+        through rasterio and the BLAS/OpenMP pools through threadpoolctl when
+        it is installed.
+        
+        Returns:
+            callable: Restores the previous environment, GDAL cache and BLAS
+            limits (run by the thread backend, whose initializer runs in the
+            calling process), or None when nothing was applied
+        """
+        if not resources:
+            return None
+        from rasterio.env import get_gdal_config, set_gdal_config
+        
+        user = cls.user_env(resources)
+        previous_env = {name: os.environ.get(name) for name in resources['env'] if name not in user}
+        previous_cache = get_gdal_config("GDAL_CACHEMAX")
+        for name in previous_env:
+            os.environ[name] = resources['env'][name]
+        
+        cache = os.environ["GDAL_CACHEMAX"]
+        if cache.isdigit():
+            # Values below 100000 are MB for GDAL; rasterio takes bytes
+            set_gdal_config("GDAL_CACHEMAX", int(cache) * 1024 * 1024 if int(cache) < 100000 else int(cache))
+        
+        limiter = None
+        threads = os.environ["OMP_NUM_THREADS"]
+        if threadpool_limits is not None and threads.isdigit():
+            limiter = threadpool_limits(int(threads))
+        
+        def restore():
+            for name, value in previous_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            if isinstance(previous_cache, int):
+                set_gdal_config("GDAL_CACHEMAX", previous_cache)
+            if limiter is not None:
+                limiter.restore_original_limits()
+        return restore
+    
+    @staticmethod
+    def get_warp_threads() -> int:
+        """
+        Threads for one GDAL warp (reproject ``num_threads``): GDAL_NUM_THREADS,
+        1 when unset. rasterio always passes its own thread count to the warper,
+        so the variable alone is not enough.
+        """
+        value = os.environ.get("GDAL_NUM_THREADS", "1")
+        if value.upper() == "ALL_CPUS":
+            return os.cpu_count() or 1
+        return int(value) if value.isdigit() and int(value) > 0 else 1
+    
+    @classmethod
+    def describe_worker_resources(cls, workers: int, resources: dict) -> str:
+        """Report of the settings the workers run with"""
+        user = cls.user_env(resources)
+        effective = dict(resources['env'], **user)
+        cache = effective['GDAL_CACHEMAX']
+        if cache.isdigit() and int(cache) < 100000:
+            cache += " MB"
+        if resources.get('backend', "process") == "process":
+            text = (f"Worker resources: {workers} process(es) x {effective['GDAL_NUM_THREADS']} GDAL thread(s), "
+                    f"{effective['OMP_NUM_THREADS']} BLAS/OpenMP thread(s), GDAL cache {cache} each")
+        else:
+            text = (f"Worker resources: {workers} thread(s) x {effective['GDAL_NUM_THREADS']} GDAL thread(s); "
+                    f"shared by the process: {effective['OMP_NUM_THREADS']} BLAS/OpenMP thread(s), "
+                    f"GDAL cache {cache}")
+        if user:
+            text += f" (from the environment: {', '.join(sorted(user))})"
+        if threadpool_limits is None:
+            text += "\n   (threadpoolctl not installed: BLAS/OpenMP pools NumPy loaded before the workers started keep their size)"
+        return text
+    
     @classmethod
     def get_batch_size(cls, total_files: int, workers: int) -> int:
         """
@@ -183,6 +340,8 @@ def suggest_configuration(verbose: bool = False) -> dict:
     }
     
     try:
+        if psutil is None:
+            raise ImportError("psutil")
         memory = psutil.virtual_memory()
         config['memory_available'] = True
         config['memory_percent'] = memory.percent
@@ -230,3 +389,7 @@ if __name__ == "__main__":
         print("OK ✓")
     else:
         print("FAILED ✗")
+    
+    # Thread and cache share of each worker
+    resources = MultiprocessingConfig.get_worker_resources(config['workers'])
+    print(MultiprocessingConfig.describe_worker_resources(config['workers'], resources))
@@ -0,0 +1,77 @@
+"""
+Building blocks to overlap reading, compute and writing inside a worker.
+
+Rasterio/GDAL release the GIL while decoding and encoding, so a few threads
+keep the disk busy while the worker's main thread computes:
+
+    with AsyncWriter(depth=4) as writer:
+        for item, data in prefetch(read, items, threads=2, depth=4):
+            writer.submit(item, write, compute(data))
+    writer.errors  # item -> exception raised by its write
+
+Both stages are bounded: `prefetch` keeps at most `depth` items read ahead of
+the consumer and `AsyncWriter.submit` blocks while `depth` writes are queued,
+so memory stays capped whatever the number of items.
+"""
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+def prefetch(read, items, threads=2, depth=4):
+    """
+    Yield (item, read(item)) in item order, reading up to `depth` items ahead
+    on `threads` threads. An exception raised by read(item) is yielded in
+    place of its result.
+    """
+    items = list(items)
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="prefetch") as pool:
+        futures = deque()
+        next_item = 0
+        while futures or next_item < len(items):
+            while next_item < len(items) and len(futures) < max(1, depth):
+                futures.append((items[next_item], pool.submit(read, items[next_item])))
+                next_item += 1
+            item, future = futures.popleft()
+            try:
+                yield item, future.result()
+            except Exception as e:
+                yield item, e
+
+class AsyncWriter:
+    """
+    One writer thread fed by a bounded queue. Use as a context manager: leaving
+    it waits for every queued write. Failed writes are kept in `errors`.
+    """
+
+    def __init__(self, depth=4):
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.errors = {}
+        self.thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            key, func, args, kwargs = job
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self.errors[key] = e
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queue func(*args, **kwargs); blocks while the queue is full."""
+        self.queue.put((key, func, args, kwargs))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
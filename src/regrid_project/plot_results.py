@@ -4,22 +4,67 @@ import re
 from multiprocessing import Pool
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import ListedColormap
 import geopandas as gpd
-import rioxarray as rxr
-import xarray as xr
 from src.regrid_project import config
+from src.regrid_project.build_manifest import output_fingerprint
 from src.regrid_project import ecostress_handler as eco_h
 from src.regrid_project import mapbiomas_handler as mb_h
 
 # Style configuration
 plt.style.use('seaborn-v0_8-whitegrid')
 
+# Minimum coverage fraction shown in the final-result panel
+THRESHOLD_TEST = 0.50
+
 def extract_year(filename):
     match = re.search(r"doy(\d{4})", filename)
     if match:
         return int(match.group(1))
     return 2018 # Fallback
 
+def load_scene(site_name, var_name, filepath, gdf_buffer):
+    """
+    Data behind one validation figure.
+
+    Returns:
+        tuple: (da_masked, mean_grid, fraction_grid, da_final_thresh) where
+        da_masked is the forest-masked source scene and the grids are on the
+        clipped template; None if the scene or its mask cannot be loaded
+    """
+    filename = os.path.basename(filepath)
+    year = extract_year(filename)
+
+    # Written next to the output by main.py with WRITE_DIAGNOSTICS; used only
+    # if newer than the output and stamped with the current parameters/code
+    out_path = os.path.join(config.OUTPUT_ROOT, site_name, var_name, f"Regrid_{filename}")
+    stamp = output_fingerprint()
+    diagnostics = eco_h.read_diagnostics(out_path, stamp)
+    source = eco_h.read_source_diagnostics(out_path, stamp) if diagnostics is not None else None
+    if source is not None:
+        da_masked = source['value'].where(source['forest_mask'] == 1)
+    else:
+        # --- Otherwise rebuild the scene, its mask and the SUM / COUNT diagnostics ---
+        da_raw = eco_h.load_ecostress(filepath, gdf_buffer)
+        if da_raw is None: return None
+
+        mask = mb_h.create_forest_mask(da_raw, year, gdf_buffer)
+        if mask is None: return None
+        da_masked = da_raw.where(mask)
+
+        _, diagnostics = eco_h.apply_mask_and_regrid_centered(
+            da_raw, mask, gdf_buffer, return_diagnostics=True)
+    
+    # Results (already clipped to the site)
+    count_grid = diagnostics['count']
+    mean_grid = diagnostics['sum'] / count_grid.where(count_grid > 0) # Pure Mean
+    fraction_grid = diagnostics['fraction'] # Coverage Percentage
+
+    # Apply Thresholds for visualization
+    da_final_thresh = mean_grid.where(fraction_grid >= THRESHOLD_TEST)
+    return da_masked, mean_grid, fraction_grid, da_final_thresh
+
 def generate_plot(site_name, var_name, filepath, buffer_path, output_folder):
     """
     Generate 4-panel plot for detailed validation.
@@ -27,57 +72,20 @@ def generate_plot(site_name, var_name, filepath, buffer_path, output_folder):
     filename = os.path.basename(filepath)
     print(f"   -> Generating plot for: {filename} ...")
     
-    year = extract_year(filename)
-    
     # 1. Load Buffer
     gdf_buffer = gpd.read_file(buffer_path)
     if len(gdf_buffer) > 1: gdf_buffer = gdf_buffer.iloc[[0]]
 
-    # 2. Load and Mask Data
+    # 2. Load, Mask and Regrid Data
     try:
-        da_raw = eco_h.load_ecostress(filepath, gdf_buffer)
-        if da_raw is None: return
-        
-        mask = mb_h.create_forest_mask(da_raw, year, gdf_buffer)
-        if mask is None: return
-        da_masked = da_raw.where(mask)
-        
-        # 3. Generate Template
-        template_da = eco_h.create_centered_template(gdf_buffer)
-        target_crs = template_da.rio.crs
-        
-        # --- MANUAL MATHEMATICAL CALCULATION (To display in plots 3 and 4) ---
+        scene = load_scene(site_name, var_name, filepath, gdf_buffer)
+        if scene is None: return
+        da_masked, mean_grid, fraction_grid, da_final_thresh = scene
         
-        # A. Prepare Numerator (Sum) and Denominator (Count)
-        data_filled = da_masked.fillna(0.0)
-        data_filled.rio.write_nodata(None, inplace=True)
-        
-        valid_weights = da_masked.notnull().astype(np.float32)
-        valid_weights.rio.write_nodata(None, inplace=True)
-        
-        # B. Reproject using SUM
-        sum_grid = data_filled.rio.reproject_match(template_da, resampling=eco_h.Resampling.sum, nodata=np.nan)
-        count_grid = valid_weights.rio.reproject_match(template_da, resampling=eco_h.Resampling.sum, nodata=np.nan)
-        
-        # C. Calculate Maximum Possible for Fraction
-        # --- CORRECTION HERE: Use xr.ones_like instead of rxr.ones_like ---
-        dummy_full = xr.ones_like(da_masked).astype(np.float32) 
-        dummy_full.rio.write_nodata(None, inplace=True)
-        max_count_grid = dummy_full.rio.reproject_match(template_da, resampling=eco_h.Resampling.sum, nodata=np.nan)
-        
-        # D. Results
-        mean_grid = sum_grid / count_grid.where(count_grid > 0) # Pure Mean
-        fraction_grid = count_grid / max_count_grid # Coverage Percentage
-
-        # E. Apply Thresholds for visualization
-        THRESHOLD_TEST = 0.50 # 1%
-        da_final_thresh = mean_grid.where(fraction_grid >= THRESHOLD_TEST)
-        
-        # Clippings for plotting
-        buffer_utm = gdf_buffer.to_crs(target_crs)
-        mean_grid = mean_grid.rio.clip(buffer_utm.geometry)
-        da_final_thresh = da_final_thresh.rio.clip(buffer_utm.geometry)
-        fraction_grid = fraction_grid.rio.clip(buffer_utm.geometry)
+        # 3. Template (cached per site)
+        context = eco_h.get_site_context(gdf_buffer)
+        target_crs = context.template.rio.crs
+        buffer_utm = context.buffer_utm
 
     except Exception as e:
         print(f"      [ERROR] Failed to process {filename}: {e}")
@@ -163,6 +171,149 @@ def process_plot_task(args):
     except Exception as e:
         return f"[ERROR] {site_name} - {var_name}: {str(e)}"
 
+def _north_up(da):
+    """(array with the first row at the top, imshow extent) of a 2D grid."""
+    x, y = da.x.values, da.y.values
+    dx = abs(x[1] - x[0]) if x.size > 1 else 1.0
+    dy = abs(y[1] - y[0]) if y.size > 1 else 1.0
+    values = da.values
+    if y.size > 1 and y[0] < y[-1]:
+        values = values[::-1]
+    extent = (x.min() - dx / 2, x.max() + dx / 2, y.min() - dy / 2, y.max() + dy / 2)
+    return values, extent
+
+class ValidationFigure:
+    """
+    The 4-panel validation figure of one site/variable, built once and updated
+    for every scene (batch mode).
+
+    Every layer is an image whose data is swapped per scene; the buffer
+    outline and the OCO-3 grid (a single LineCollection) are drawn once. The
+    source pixels of panel 2 are shown as an image of the valid-pixel mask
+    instead of one scatter marker per pixel.
+    """
+
+    def __init__(self, site_name, var_name, context, mean_grid, dpi):
+        self.dpi = dpi
+        self.target_crs = context.template.rio.crs
+        self.fig, axes = plt.subplots(1, 4, figsize=(30, 10), constrained_layout=True)
+        self.axes = axes
+        buffer_utm = context.buffer_utm
+
+        empty = np.full((1, 1), np.nan)
+        kwargs = {'origin': 'upper', 'interpolation': 'nearest'}
+        self.original = axes[0].imshow(empty, cmap='viridis', **kwargs)
+        self.fig.colorbar(self.original, ax=axes[0], label=var_name, shrink=0.6)
+        self.valid = axes[1].imshow(empty, cmap=ListedColormap(['dimgray']), **kwargs)
+        self.fraction = axes[2].imshow(empty, cmap='jet_r', vmin=0, vmax=1, **kwargs)
+        self.fig.colorbar(self.fraction, ax=axes[2], label='Fraction (0–1)', shrink=0.6)
+        self.final = axes[3].imshow(empty, cmap='viridis', **kwargs)
+        self.fig.colorbar(self.final, ax=axes[3], label=f'Mean {var_name}', shrink=0.6)
+
+        # Static layers: buffer, centre and the template grid
+        for ax in axes:
+            buffer_utm.boundary.plot(ax=ax, color='black', linewidth=1)
+        c = buffer_utm.geometry.centroid.iloc[0]
+        axes[1].scatter(c.x, c.y, c='black', s=150, marker='o')
+        axes[1].scatter(c.x, c.y, c='cyan', s=50, marker='+')
+
+        x_g, y_g = mean_grid.x.values, mean_grid.y.values
+        x_lim = (x_g.min() - config.TARGET_RES_X, x_g.max() + config.TARGET_RES_X)
+        y_lim = (y_g.min() - config.TARGET_RES_Y, y_g.max() + config.TARGET_RES_Y)
+        lines = [[(x - config.TARGET_RES_X/2, y_lim[0]), (x - config.TARGET_RES_X/2, y_lim[1])] for x in x_g]
+        lines += [[(x_lim[0], y - config.TARGET_RES_Y/2), (x_lim[1], y - config.TARGET_RES_Y/2)] for y in y_g]
+        axes[1].add_collection(LineCollection(lines, colors='red', linewidths=1, alpha=0.6))
+
+        titles = [f"1. Original ({site_name})", "2. Geometry (pixel 2.20x1.66km)",
+                  f"3. Coverage Fraction\n(Cells where fraction > {THRESHOLD_TEST})",
+                  f"4. Final Result (> {THRESHOLD_TEST*100}%)\n(Mean)"]
+        for ax, title in zip(axes, titles):
+            ax.set_title(title, fontsize=14)
+            ax.set_aspect('equal')
+            ax.grid(False)
+            ax.set_xlim(*x_lim)
+            ax.set_ylim(*y_lim)
+
+    def update(self, scene, title):
+        """Swap in the data of one scene (output of load_scene)."""
+        da_masked, _, fraction_grid, da_final_thresh = scene
+        # One reprojection at most, shared by panels 1 and 2
+        if da_masked.rio.crs != self.target_crs:
+            da_masked = da_masked.rio.reproject(self.target_crs, resampling=eco_h.Resampling.nearest)
+
+        values, extent = _north_up(da_masked)
+        self.original.set_data(values)
+        self.original.set_extent(extent)
+        if np.isfinite(values).any():
+            self.original.set_clim(np.nanmin(values), np.nanmax(values))
+        self.valid.set_data(np.where(np.isnan(values), np.nan, 1.0))
+        self.valid.set_extent(extent)
+
+        values, extent = _north_up(fraction_grid)
+        self.fraction.set_data(values)
+        self.fraction.set_extent(extent)
+
+        values, extent = _north_up(da_final_thresh)
+        self.final.set_data(values)
+        self.final.set_extent(extent)
+        if np.isfinite(values).any():
+            self.final.set_clim(np.nanmin(values), np.nanmax(values))
+
+        self.fig.suptitle(title, fontsize=16)
+
+    def save(self, out_path):
+        self.fig.savefig(out_path, dpi=self.dpi)
+
+    def close(self):
+        plt.close(self.fig)
+
+def render_all_scenes(site_name, var_name, files, buffer_path, output_folder, dpi=None):
+    """
+    Batch mode: one validation figure per scene of a site/variable, written to
+    <output_folder>/<site>/<var>/Validation_<scene>.png with a reused figure.
+    Returns a status message.
+    """
+    dpi = dpi or config.PLOT_BATCH_DPI
+    out_dir = os.path.join(output_folder, site_name, var_name)
+    os.makedirs(out_dir, exist_ok=True)
+
+    gdf_buffer = gpd.read_file(buffer_path)
+    if len(gdf_buffer) > 1: gdf_buffer = gdf_buffer.iloc[[0]]
+    context = eco_h.get_site_context(gdf_buffer)
+
+    figure = None
+    done, failed = 0, 0
+    try:
+        for filepath in sorted(files):
+            filename = os.path.basename(filepath)
+            try:
+                scene = load_scene(site_name, var_name, filepath, gdf_buffer)
+                if scene is None:
+                    failed += 1
+                    continue
+                if figure is None:
+                    figure = ValidationFigure(site_name, var_name, context, scene[1], dpi)
+                figure.update(scene, filename)
+                figure.save(os.path.join(out_dir, f"Validation_{os.path.splitext(filename)[0]}.png"))
+                done += 1
+            except Exception as e:
+                print(f"      [ERROR] Failed to plot {filename}: {e}")
+                failed += 1
+    finally:
+        if figure is not None:
+            figure.close()
+
+    status = "[OK]" if not failed else "[WARNING]"
+    return f"{status} {site_name} - {var_name}: {done} figure(s) in {out_dir} ({failed} failed)"
+
+def process_batch_plot_task(args):
+    """Render every scene of one site/variable (batch mode)"""
+    site_name, var_name, files, buffer_path, output_folder = args
+    try:
+        return render_all_scenes(site_name, var_name, files, buffer_path, output_folder)
+    except Exception as e:
+        return f"[ERROR] {site_name} - {var_name}: {str(e)}"
+
 def main():
     print("=== GENERATING VALIDATION PLOTS (4-PANEL METHOD - SUM) ===")
     plot_dir = os.path.join(config.BASE_PATH, "Validation_plots")
@@ -190,15 +341,20 @@ def main():
             if not files:
                 continue
             
-            # Add first file from each site/variable combination
-            plot_tasks.append((site_name, var_name, files[0], buffer_path, plot_dir))
+            if config.PLOT_ALL_SCENES:
+                # Every scene, one reused figure per site/variable
+                plot_tasks.append((site_name, var_name, files, buffer_path, plot_dir))
+            else:
+                # Add first file from each site/variable combination
+                plot_tasks.append((site_name, var_name, files[0], buffer_path, plot_dir))
     
     print(f"\nTotal plot tasks: {len(plot_tasks)}")
     
     if plot_tasks:
         print(f"Starting parallel plot generation...")
+        task_function = process_batch_plot_task if config.PLOT_ALL_SCENES else process_plot_task
         with Pool(processes=num_workers) as pool:
-            results = pool.map(process_plot_task, plot_tasks)
+            results = pool.map(task_function, plot_tasks)
         
         # Display results
         for result in results:
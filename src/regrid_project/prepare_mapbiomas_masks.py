@@ -13,12 +13,109 @@ This script will:
   extent and save the result in `config.PATH_MAPBIOMAS_CUT/<SITE>/`.
 
 Next pipeline runs will use these pre-cut files when available.
+
+At the end a manifest (`config.PATH_MAPBIOMAS_MANIFEST`) is written with the
+site, year, path, bounds, CRS and checksum of every pre-cut file, so the
+pipeline can find them without opening any raster.
 """
 import os
 import glob
+import json
+import hashlib
+import rasterio
 import rioxarray as rxr
 import geopandas as gpd
 import config
+from executor import TaskFailure, make_pool, run_tasks
+from multiprocessing_config import MultiprocessingConfig
+
+# Buffers read by this process, keyed by shapefile path
+_BUFFERS = {}
+
+
+def file_checksum(path, block_size=1 << 20):
+    """SHA-256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_manifest(verbose=True):
+    """
+    Scan `config.PATH_MAPBIOMAS_CUT/<SITE>/<year>_coverage_*.tif` and write the
+    manifest. Paths are stored relative to PATH_MAPBIOMAS_CUT.
+    """
+    entries = []
+    for site in config.SITES.keys():
+        site_dir = os.path.join(config.PATH_MAPBIOMAS_CUT, site)
+        for path in sorted(glob.glob(os.path.join(site_dir, "*_coverage_*.tif"))):
+            prefix = os.path.basename(path).split("_")[0]
+            if not prefix.isdigit():
+                continue
+            try:
+                with rasterio.open(path) as src:
+                    bounds = list(src.bounds)
+                    crs = src.crs.to_string() if src.crs else "EPSG:4326"
+            except Exception as e:
+                print(f"  [ERROR] Could not read header of {path}: {e}")
+                continue
+            entries.append({
+                'site': site,
+                'year': int(prefix),
+                'path': os.path.relpath(path, config.PATH_MAPBIOMAS_CUT),
+                'bounds': bounds,
+                'crs': crs,
+                'checksum': file_checksum(path),
+            })
+
+    tmp_path = config.PATH_MAPBIOMAS_MANIFEST + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'entries': entries}, f, indent=2)
+    os.replace(tmp_path, config.PATH_MAPBIOMAS_MANIFEST)
+    if verbose:
+        print(f"[MANIFEST] {len(entries)} pre-cut files -> {config.PATH_MAPBIOMAS_MANIFEST}")
+    return entries
+
+
+def load_buffer(shp):
+    """Site buffer (first geometry), read once per process."""
+    gdf = _BUFFERS.get(shp)
+    if gdf is None:
+        gdf = gpd.read_file(shp)
+        if len(gdf) > 1:
+            gdf = gdf.iloc[[0]]
+        _BUFFERS[shp] = gdf
+    return gdf
+
+
+def cut_coverage(job):
+    """Clip one MapBiomas file to one site buffer and save it (pool task). Returns a status message."""
+    mb_path, year, site, shp, out_fn = job
+    # Open MapBiomas (lazy): only the box around the buffer is read
+    mb_da = rxr.open_rasterio(mb_path, masked=True)
+    if not mb_da.rio.crs:
+        mb_da.rio.write_crs("EPSG:4326", inplace=True)
+
+    # Reproject buffer to MapBiomas CRS
+    buf_proj = load_buffer(shp).to_crs(mb_da.rio.crs)
+    try:
+        minx, miny, maxx, maxy = buf_proj.total_bounds
+        mb_box = mb_da.rio.clip_box(minx, miny, maxx, maxy, auto_expand=True)
+    except Exception as e:
+        return f"  [ERROR] Box crop failed for {site}/{year}: {e}"
+
+    try:
+        mb_clipped = mb_box.rio.clip(buf_proj.geometry)
+    except Exception as e:
+        return f"  [ERROR] Fine clip failed for {site}/{year}: {e}"
+
+    try:
+        mb_clipped.rio.to_raster(out_fn)
+        return f"  [SAVED] {out_fn}"
+    except Exception as e:
+        return f"  [ERROR] Saving failed for {site}/{year}: {e}"
 
 
 def prepare_all_masks(verbose=True):
@@ -27,19 +124,17 @@ def prepare_all_masks(verbose=True):
     mb_files = glob.glob(pattern)
     if not mb_files:
         print(f"No MapBiomas files found in {config.PATH_MAPBIOMAS_DIR}")
+        # Still index any pre-cut files already on disk
+        write_manifest(verbose=verbose)
         return
 
-    # Load site buffers once
+    # Check site buffers once
     site_buffers = {}
     for site, shp in config.SITES.items():
         if not os.path.exists(shp):
             print(f"[WARNING] Buffer shapefile not found for {site}: {shp}")
             continue
-        gdf = gpd.read_file(shp)
-        if len(gdf) > 1:
-            gdf = gdf.iloc[[0]]
-        # ensure consistent CRS
-        site_buffers[site] = gdf
+        site_buffers[site] = shp
 
     if not site_buffers:
         print("No valid site buffers available. Exiting.")
@@ -50,63 +145,52 @@ def prepare_all_masks(verbose=True):
         out_dir = os.path.join(config.PATH_MAPBIOMAS_CUT, site)
         os.makedirs(out_dir, exist_ok=True)
 
-    # Process each MapBiomas file
+    # One job per (MapBiomas file, site) without a pre-cut file yet
+    jobs = []
     for mb_path in mb_files:
-        try:
-            # Extract year from filename
-            basename = os.path.basename(mb_path)
-            # Expected pattern: <year>_coverage_....tif
-            year = None
-            parts = basename.split("_")
-            if parts and parts[0].isdigit():
-                year = int(parts[0])
-            if year is None:
-                print(f"[SKIP] Could not determine year for {basename}")
+        # Extract year from filename
+        basename = os.path.basename(mb_path)
+        # Expected pattern: <year>_coverage_....tif
+        year = None
+        parts = basename.split("_")
+        if parts and parts[0].isdigit():
+            year = int(parts[0])
+        if year is None:
+            print(f"[SKIP] Could not determine year for {basename}")
+            continue
+
+        for site, shp in site_buffers.items():
+            out_dir = os.path.join(config.PATH_MAPBIOMAS_CUT, site)
+            out_pattern = os.path.join(out_dir, f"{year}_coverage_*.tif")
+            existing = glob.glob(out_pattern)
+            if existing:
+                if verbose:
+                    print(f"  [SKIP] Pre-cut exists for {site} year {year}")
                 continue
 
-            if verbose:
-                print(f"Processing MapBiomas {basename} (year {year})")
-
-            # Open MapBiomas (lazy) once
-            mb_da = rxr.open_rasterio(mb_path, masked=True)
-            if not mb_da.rio.crs:
-                mb_da.rio.write_crs("EPSG:4326", inplace=True)
-
-            # For each site, crop and save
-            for site, gdf in site_buffers.items():
-                out_dir = os.path.join(config.PATH_MAPBIOMAS_CUT, site)
-                out_pattern = os.path.join(out_dir, f"{year}_coverage_*.tif")
-                existing = glob.glob(out_pattern)
-                if existing:
-                    if verbose:
-                        print(f"  [SKIP] Pre-cut exists for {site} year {year}")
-                    continue
-
-                # Reproject buffer to MapBiomas CRS
-                buf_proj = gdf.to_crs(mb_da.rio.crs)
-                try:
-                    minx, miny, maxx, maxy = buf_proj.total_bounds
-                    mb_box = mb_da.rio.clip_box(minx, miny, maxx, maxy, auto_expand=True)
-                except Exception as e:
-                    print(f"  [ERROR] Box crop failed for {site}/{year}: {e}")
-                    continue
-
-                try:
-                    mb_clipped = mb_box.rio.clip(buf_proj.geometry)
-                except Exception as e:
-                    print(f"  [ERROR] Fine clip failed for {site}/{year}: {e}")
-                    continue
-
-                # Build output filename and save
-                out_fn = os.path.join(out_dir, f"{year}_coverage_{site}.tif")
-                try:
-                    mb_clipped.rio.to_raster(out_fn)
-                    print(f"  [SAVED] {out_fn}")
-                except Exception as e:
-                    print(f"  [ERROR] Saving failed for {site}/{year}: {e}")
-
-        except Exception as e:
-            print(f"[ERROR] Processing failed for {mb_path}: {e}")
+            # Build output filename
+            out_fn = os.path.join(out_dir, f"{year}_coverage_{site}.tif")
+            jobs.append((mb_path, year, site, shp, out_fn))
+
+    # Crops are GDAL reads and writes: run them on the configured backend
+    if jobs:
+        num_workers = min(len(jobs), config.NUM_WORKERS or os.cpu_count() or 4)
+        resources = MultiprocessingConfig.get_worker_resources(num_workers, config.EXECUTION_BACKEND)
+        if verbose:
+            print(f"Cutting {len(jobs)} MapBiomas file(s) with {num_workers} {config.EXECUTION_BACKEND} workers")
+            print(MultiprocessingConfig.describe_worker_resources(num_workers, resources))
+        with make_pool(config.EXECUTION_BACKEND, num_workers, initializer=MultiprocessingConfig.apply_worker_resources,
+                       initargs=(resources,)) as pool:
+            for index, outcome in run_tasks(pool, cut_coverage, jobs,
+                                            describe=lambda job: f"{job[2]}/{job[1]}"):
+                if isinstance(outcome, TaskFailure):
+                    mb_path, year, site = jobs[index][:3]
+                    print(f"[ERROR] Processing failed for {mb_path} ({site}): {outcome.error.splitlines()[0]}")
+                else:
+                    print(outcome)
+
+    # Index every pre-cut file (new and previously existing)
+    write_manifest(verbose=verbose)
 
 
 if __name__ == "__main__":
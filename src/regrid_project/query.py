@@ -0,0 +1,155 @@
+"""
+Indexed queries over the extracted time series (extract_to_csv output).
+
+The table of a site/variable is loaded once and indexed:
+- rows sorted by date, so a date range is a binary search (`np.searchsorted`)
+- rows grouped per pixel (still in date order), so a pixel's time series is
+  a contiguous block found through a pixel_id lookup
+- a KD-tree over the pixel centres (scipy's cKDTree when installed, a NumPy
+  scan of the few hundred pixels otherwise) for nearest-pixel lookups
+
+    rows = query("ATTO", "LST", start="2019-01-01", end="2019-12-31", lat=-2.14, lon=-59.0)
+    rows = query("ATTO", "LST", bbox=(-59.1, -2.2, -58.9, -2.0))
+
+Results are DataFrames with the CSV columns (value column named after the variable).
+"""
+import os
+import numpy as np
+import pandas as pd
+from src.regrid_project import config
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # Optional: fall back to a NumPy nearest-neighbour scan
+    cKDTree = None
+
+# Loaded indexes: (site, variable) -> ResultIndex
+_INDEX_CACHE = {}
+
+
+def load_table(site_name, var_name):
+    """Extracted rows of one site/variable from the format in config.TABLE_FORMAT."""
+    if config.TABLE_FORMAT == "parquet":
+        import pyarrow.compute as pc
+        from src.regrid_project.table_writer import open_dataset
+        # Partition pruning: only the files of this site/variable are opened
+        table = open_dataset().to_table(
+            filter=(pc.field('site') == site_name) & (pc.field('variable') == var_name))
+        df = table.to_pandas()
+        df['pixel_id'] = df['pixel_id'].astype(str)
+        df['date'] = pd.to_datetime(df['date'])
+        df = df.rename(columns={'value': var_name})
+        return df[['date', 'year', 'doy', 'latitude', 'longitude', var_name, 'pixel_id', 'x', 'y']]
+
+    csv_path = os.path.join(config.BASE_PATH, "Tables_CSVs", f"{site_name}_{var_name}.csv")
+    return pd.read_csv(csv_path, parse_dates=['date'])
+
+
+class ResultIndex:
+    """Date, pixel and spatial indexes over the rows of one site/variable."""
+
+    def __init__(self, df):
+        # Sorted date index: a date range is a contiguous slice of the rows
+        df = df.sort_values('date', kind='stable').reset_index(drop=True)
+        self.df = df
+        self.dates = df['date'].to_numpy(dtype='datetime64[ns]')
+
+        # Pixel index: rows of each pixel are one block of `pixel_rows`, in date order
+        codes, pixel_ids = pd.factorize(df['pixel_id'])
+        self.pixel_rows = np.argsort(codes, kind='stable')
+        self.pixel_offsets = np.searchsorted(codes[self.pixel_rows], np.arange(len(pixel_ids) + 1))
+        self.pixel_code = {pixel_id: code for code, pixel_id in enumerate(pixel_ids)}
+        self.row_codes = codes
+
+        # One row per pixel (first occurrence) with its centre
+        first = self.pixel_rows[self.pixel_offsets[:-1]]
+        self.pixels = df.loc[first, ['pixel_id', 'latitude', 'longitude', 'x', 'y']].reset_index(drop=True)
+
+        # Spatial index over pixel centres; longitude scaled by cos(latitude)
+        # so degree distances are close to isotropic
+        self.lon_scale = np.cos(np.deg2rad(self.pixels['latitude'].mean())) if len(self.pixels) else 1.0
+        self.points = np.column_stack([self.pixels['longitude'] * self.lon_scale, self.pixels['latitude']])
+        self.tree = cKDTree(self.points) if cKDTree is not None and len(self.points) else None
+
+    def date_slice(self, start=None, end=None):
+        """Row slice for [start, end] (dates, both inclusive)."""
+        lo = 0 if start is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start)), 'left')
+        hi = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end)), 'right')
+        return slice(lo, hi)
+
+    def nearest_pixel(self, lat, lon):
+        """pixel_id of the pixel centre closest to (lat, lon)."""
+        point = np.array([lon * self.lon_scale, lat])
+        if self.tree is not None:
+            _, code = self.tree.query(point)
+        else:
+            code = int(np.argmin(((self.points - point) ** 2).sum(axis=1)))
+        return self.pixels['pixel_id'].iat[code]
+
+    def pixels_in_bbox(self, bbox):
+        """pixel_ids with centre inside (min_lon, min_lat, max_lon, max_lat)."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        lon, lat = self.pixels['longitude'], self.pixels['latitude']
+        inside = (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+        return self.pixels['pixel_id'][inside].tolist()
+
+    def pixel_positions(self, pixel_id, start=None, end=None):
+        """Row positions of one pixel within [start, end], in date order."""
+        code = self.pixel_code.get(pixel_id)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        rows = self.pixel_rows[self.pixel_offsets[code]:self.pixel_offsets[code + 1]]
+        dates = self.dates[rows]
+        lo = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start)), 'left')
+        hi = len(rows) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end)), 'right')
+        return rows[lo:hi]
+
+    def select(self, start=None, end=None, pixel_id=None, lat=None, lon=None, bbox=None):
+        """
+        Rows for a date range and at most one spatial selector: pixel_id,
+        nearest pixel to (lat, lon), or bbox (min_lon, min_lat, max_lon, max_lat).
+        """
+        selectors = [pixel_id is not None, lat is not None or lon is not None, bbox is not None]
+        if sum(selectors) > 1:
+            raise ValueError("Use only one of pixel_id, lat/lon or bbox")
+        if (lat is None) != (lon is None):
+            raise ValueError("lat and lon must be given together")
+
+        if lat is not None:
+            pixel_id = self.nearest_pixel(lat, lon)
+        if pixel_id is not None:
+            return self.df.iloc[self.pixel_positions(pixel_id, start, end)]
+
+        rows = self.date_slice(start, end)
+        if bbox is None:
+            return self.df.iloc[rows]
+        codes = [self.pixel_code[p] for p in self.pixels_in_bbox(bbox)]
+        keep = np.isin(self.row_codes[rows], codes)
+        return self.df.iloc[np.arange(rows.start, rows.stop)[keep]]
+
+
+def get_index(site_name, var_name, reload=False):
+    """Cached ResultIndex of a site/variable (built on first use)."""
+    key = (site_name, var_name)
+    if reload or key not in _INDEX_CACHE:
+        _INDEX_CACHE[key] = ResultIndex(load_table(site_name, var_name))
+    return _INDEX_CACHE[key]
+
+
+def query(site_name, var_name, start=None, end=None, pixel_id=None, lat=None, lon=None, bbox=None):
+    """
+    Extracted rows of a site/variable.
+
+    Args:
+        site_name (str): Site, e.g. "ATTO"
+        var_name (str): Variable, e.g. "LST"
+        start, end: Date range, both inclusive (None = open)
+        pixel_id (str): One pixel
+        lat, lon (float): The pixel whose centre is nearest to this point
+        bbox (tuple): (min_lon, min_lat, max_lon, max_lat), pixel centres inside
+
+    Returns:
+        pd.DataFrame: Matching rows in date order
+    """
+    index = get_index(site_name, var_name)
+    return index.select(start, end, pixel_id=pixel_id, lat=lat, lon=lon, bbox=bbox)
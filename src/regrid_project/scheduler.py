@@ -0,0 +1,222 @@
+"""
+Memory-aware admission of regrid tasks to the worker pool (config.MEMORY_ADMISSION).
+
+Each task's memory is estimated before it is queued from the raster headers
+only: the pixels of the window around the site buffer (what load_ecostress
+decodes) x 4 bytes (float32 after masking) x the number of scene-sized
+buffers alive at the peak of the task (masked scene, fillna copy, weights,
+forest mask, ...). Tasks are dispatched largest first and one is only admitted
+while the estimates of the running tasks plus its own stay under the budget
+(MEMORY_BUDGET_MB, or MEMORY_BUDGET_FRACTION of the memory available once the
+pool has started); a task larger than the whole budget runs alone.
+
+Workers report the RSS their task added (see TaskMemoryProbe). Memory still
+held when the task ends (imports and GDAL state on a worker's first task, mask
+and index-map caches) is tracked per worker process and taken off the budget
+while that worker is alive (a killed or replaced worker frees it); the
+transient part rescales the estimates: up at once when a task used more than
+predicted, down slowly when tasks stay below.
+"""
+import os
+import sys
+import numpy as np
+import rasterio
+from . import config
+from . import ecostress_handler as eco_h
+from .multiprocessing_config import MultiprocessingConfig
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Scene-sized float32 buffers alive at the peak of a task: the regrid copies plus
+# the forest mask build (MapBiomas at 30 m has ~5x the pixels of a 70 m scene).
+# Starting values measured with benchmark.py; the scheduler rescales them.
+REGRID_COPIES = {"gdal": 24, "bincount": 12}
+# Weight of a new measurement when the estimates are scaled down, and the
+# lowest scale (RSS reused from freed memory can make a task look free)
+SCALE_DECAY = 0.2
+MIN_SCALE = 0.25
+
+def rss_bytes():
+    """Current resident memory of this process, None if unknown."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_bytes():
+    """High-water mark of this process' resident memory, None if unknown."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', None)
+    return None
+
+def available_bytes():
+    """Memory available to new allocations (psutil), None if unknown."""
+    if psutil is None:
+        return None
+    return psutil.virtual_memory().available
+
+class TaskMemoryProbe:
+    """
+    Memory a task added to its worker (used inside the worker).
+
+    The process high-water mark only moves when this task sets a new peak;
+    then `footprint` (peak - RSS at the start) is exact. Otherwise it is an
+    upper bound (`exact` False): the old peak minus the RSS at the start.
+    `retained` is the RSS still held at the end (caches, first-use state).
+    """
+
+    def __enter__(self):
+        self.start = rss_bytes()
+        self.peak_before = peak_rss_bytes()
+        self.footprint = None
+        self.retained = 0
+        self.exact = False
+        return self
+
+    def __exit__(self, *exc):
+        peak_after = peak_rss_bytes()
+        end = rss_bytes()
+        if None not in (self.start, self.peak_before, peak_after, end):
+            self.footprint = max(0, peak_after - self.start)
+            self.retained = end - self.start
+            self.exact = peak_after > self.peak_before
+        return False
+
+    def report(self):
+        """(footprint, retained, exact, pid), sent back with the task result."""
+        return self.footprint, self.retained, self.exact, os.getpid()
+
+def scene_bytes(filepath, gdf_buffer):
+    """Bytes of the clipped float32 scene load_ecostress would decode, from the header."""
+    with rasterio.open(filepath) as src:
+        width, height = src.width, src.height
+        if gdf_buffer is not None:
+            raster_crs = src.crs if src.crs else eco_h.CRS_METRICO
+            bounds = eco_h.get_site_context(gdf_buffer).buffer_in(raster_crs).total_bounds
+            window = eco_h.buffer_window(src, bounds)
+            if window is None:
+                return 0
+            width, height = int(window.width), int(window.height)
+        # masked=True decodes to float32 at least
+        itemsize = max([4] + [np.dtype(dtype).itemsize for dtype in src.dtypes])
+    return width * height * itemsize
+
+def estimate_task_memory(items, gdf_buffer=None, engine=None, held_scenes=None):
+    """
+    Estimated peak bytes of one task; `items` are its (filepath, output_dir)
+    pairs. Stacked and fused tasks hold every scene at once; a pipelined task
+    (`held_scenes` set) regrids one scene while `held_scenes` others wait
+    decoded, one buffer each.
+    """
+    copies = REGRID_COPIES.get(engine or config.REGRID_ENGINE, max(REGRID_COPIES.values()))
+    sizes = []
+    for filepath, _ in items:
+        try:
+            sizes.append(scene_bytes(filepath, gdf_buffer))
+        except Exception:
+            # Unreadable header: the worker reports the error, assume a full worker share
+            sizes.append(MultiprocessingConfig.MAX_MEMORY_PER_WORKER_MB * 1024 * 1024 // copies)
+    if held_scenes is None or not sizes:
+        return sum(sizes) * copies
+    sizes.sort(reverse=True)
+    return sizes[0] * copies + sum(sizes[1:1 + held_scenes])
+
+def memory_budget():
+    """
+    Bytes the running tasks may use together: MEMORY_BUDGET_MB, or
+    MEMORY_BUDGET_FRACTION of the available memory. None when unknown.
+    """
+    if config.MEMORY_BUDGET_MB:
+        return int(config.MEMORY_BUDGET_MB * 1024 * 1024)
+    available = available_bytes()
+    if available is None:
+        return None
+    return int(available * config.MEMORY_BUDGET_FRACTION)
+
+class MemoryScheduler:
+    """
+    Admission policy for executor.run_tasks: a task is dispatched only while
+    the sum of the running estimates fits the budget.
+
+    Tasks are admitted in the given order (largest first); when the next one
+    does not fit, dispatching waits for running tasks to finish instead of
+    letting smaller ones overtake it, so large tasks do not starve at the end.
+    The task function must return (result, TaskMemoryProbe.report()).
+    `live_workers` (e.g. WorkerPool.worker_pids) returns the pids of the
+    current workers, so memory retained by a worker that exited is released.
+    """
+
+    def __init__(self, budget, estimates, live_workers=None):
+        self.budget = budget
+        self.estimates = estimates
+        self.live_workers = live_workers
+        self.scale = 1.0
+        self.committed = 0
+        self.reserved = {}         # job index -> bytes reserved while it runs
+        self.worker_retained = {}  # worker pid -> RSS it kept after its tasks
+        self.peak_committed = 0
+        self.peak_retained = 0
+        self.waits = 0
+
+    @property
+    def retained(self):
+        """RSS kept by the live workers after their tasks."""
+        if self.live_workers is not None:
+            live = set(self.live_workers())
+            for pid in [pid for pid in self.worker_retained if pid not in live]:
+                del self.worker_retained[pid]
+        return sum(max(0, value) for value in self.worker_retained.values())
+
+    def admit(self, index, running):
+        """Reserve memory for job `index` if it fits (always when nothing runs)."""
+        reserved = int(self.estimates[index] * self.scale)
+        if running and self.committed + reserved + self.retained > self.budget:
+            self.waits += 1
+            return False
+        if reserved > self.budget:
+            print(f"      [WARNING] Task needs ~{reserved / 2**20:.0f} MB, over the "
+                  f"{self.budget / 2**20:.0f} MB budget: running it alone")
+        self.reserved[index] = reserved
+        self.committed += reserved
+        self.peak_committed = max(self.peak_committed, self.committed)
+        return True
+
+    def release(self, index, ok, value):
+        """Free the reservation of a finished job and learn from its measurement."""
+        self.committed -= self.reserved.pop(index)
+        if not ok:
+            return value
+        result, (footprint, retained, exact, pid) = value
+        self.observe(self.estimates[index], footprint, retained, exact, pid)
+        return result
+
+    def observe(self, estimate, footprint, retained, exact, pid=None):
+        """Rescale the estimates from the memory a task actually added."""
+        if footprint is None:
+            return
+        self.worker_retained[pid] = self.worker_retained.get(pid, 0) + retained
+        self.peak_retained = max(self.peak_retained, self.retained)
+        if not estimate:
+            return
+        ratio = max(0, footprint - max(0, retained)) / estimate
+        if exact and ratio > self.scale:
+            # Under-estimated: trust the measurement at once
+            self.scale = ratio
+        elif ratio < self.scale:
+            # Over-estimated (an upper bound is enough to know): decay towards it
+            self.scale = max(MIN_SCALE, self.scale + SCALE_DECAY * (ratio - self.scale))
@@ -0,0 +1,137 @@
+"""
+Streaming Parquet output for the extracted time series.
+
+Rows are written under `PATH_TABLES_PARQUET` as a hive-partitioned dataset:
+
+    Tables_Parquet/site=ATTO/variable=LST/year=2019/part-0.parquet
+
+extract_to_csv fills one preallocated buffer of `config.PARQUET_ROW_GROUP_ROWS`
+rows per year and writes it as a row group when full, so memory is bounded by
+the row-group size instead of growing with the archive. Columns use compact
+types: `date` as date32, `doy` as int16, values and lat/lon as float32 and
+`pixel_id` dictionary-encoded. `site`, `variable` and `year` live in the
+partition path, so readers can prune them without opening any file:
+
+    ds = open_dataset()
+    ds.to_table(columns=['date', 'pixel_id', 'value'],
+                filter=(pc.field('site') == 'ATTO') & (pc.field('variable') == 'LST') &
+                       (pc.field('year') == 2019))
+
+Requires the optional `pyarrow` package.
+"""
+import os
+import shutil
+import numpy as np
+from src.regrid_project import config
+
+# Partition value used by hive-style readers for a missing year
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise ImportError("TABLE_FORMAT = 'parquet' requires the 'pyarrow' package: pip install pyarrow")
+    return pyarrow
+
+
+def table_schema():
+    """
+    Arrow schema of the files (partition columns excluded). Unlike the CSVs the
+    data column is always `value`: `variable` is a partition key, so one dataset
+    holds every variable.
+    """
+    pa = _require_pyarrow()
+    return pa.schema([
+        ('date', pa.date32()),
+        ('doy', pa.int16()),
+        ('latitude', pa.float32()),
+        ('longitude', pa.float32()),
+        ('value', pa.float32()),
+        ('pixel_id', pa.dictionary(pa.int32(), pa.string())),
+        ('x', pa.float64()),
+        ('y', pa.float64()),
+    ])
+
+
+def open_dataset(root=None):
+    """Open the partitioned tables as a pyarrow dataset (lazy, prunable)."""
+    _require_pyarrow()
+    import pyarrow.dataset as pds
+    return pds.dataset(root or config.PATH_TABLES_PARQUET, format="parquet", partitioning="hive")
+
+
+class ParquetTableWriter:
+    """
+    Streams the rows of one site/variable into `site=<site>/variable=<var>/year=<year>/`.
+
+    The partition is written next to the old one and swapped in by `close()`,
+    so an interrupted extraction leaves the previous tables intact.
+    """
+
+    def __init__(self, site_name, var_name, root=None, row_group_rows=None):
+        self.pa = _require_pyarrow()
+        import pyarrow.parquet as pq
+        self.pq = pq
+
+        self.var_name = var_name
+        self.schema = table_schema()
+        self.row_group_rows = row_group_rows or config.PARQUET_ROW_GROUP_ROWS
+        root = root or config.PATH_TABLES_PARQUET
+        self.path = os.path.join(root, f"site={site_name}", f"variable={var_name}")
+        # Dot prefix: dataset readers skip it while it is being written
+        self.tmp_path = os.path.join(root, f"site={site_name}", f".variable={var_name}.tmp")
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+        self.writers = {}  # year partition -> open ParquetWriter
+        self.rows = 0
+
+    def write_row_group(self, year, columns):
+        """
+        Write the rows held in `columns` (extract_to_csv.ColumnBuffers) as one
+        row group of the `year` partition.
+        """
+        n = columns.size
+        if n == 0:
+            return
+        partition = NULL_PARTITION if year is None else str(int(year))
+        writer = self.writers.get(partition)
+        if writer is None:
+            folder = os.path.join(self.tmp_path, f"year={partition}")
+            os.makedirs(folder, exist_ok=True)
+            writer = self.pq.ParquetWriter(os.path.join(folder, "part-0.parquet"),
+                                           self.schema, compression="zstd")
+            self.writers[partition] = writer
+
+        pa = self.pa
+        table = pa.Table.from_arrays([
+            pa.array(columns.date[:n].astype('datetime64[D]'), type=pa.date32(), from_pandas=True),
+            pa.array(columns.doy[:n].astype(np.int16), mask=~columns.dated[:n]),
+            pa.array(columns.latitude[:n].astype(np.float32)),
+            pa.array(columns.longitude[:n].astype(np.float32)),
+            pa.array(columns.value[:n].astype(np.float32, copy=False)),
+            pa.array(columns.pixel_id[:n]).dictionary_encode(),
+            pa.array(columns.x[:n]),
+            pa.array(columns.y[:n]),
+        ], schema=self.schema)
+        writer.write_table(table, row_group_size=n)
+        self.rows += n
+
+    def close(self):
+        """Finish the files and replace the previous partition of this site/variable."""
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        if not os.path.exists(self.tmp_path):
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """Discard everything written so far (the previous partition is kept)."""
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
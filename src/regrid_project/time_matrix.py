@@ -0,0 +1,168 @@
+"""
+Dense (pixel, time) matrix per site and variable for fast time-series access.
+
+`extract_to_csv` can fill, next to the tables, one float32 matrix per
+site/variable in `PATH_TIME_MATRIX`:
+- `<site>_<var>.npy`: shape (pixels, acquisitions), NaN where there is no
+  value, stored as a .npy file so it is opened with `mmap_mode='r'`
+- `<site>_<var>_pixels.csv`: row -> pixel_id, x, y, latitude, longitude
+- `<site>_<var>_times.csv`: column -> acquisition time and source filename,
+  sorted by time
+
+Rows are C-contiguous, so the whole time series of a pixel is one contiguous
+read, and a date range is a contiguous column slice found by binary search:
+
+    m = TimeSeriesMatrix("ATTO", "LST")
+    m.pixel_series("248434_9769187")
+    m.date_range("2019-01-01", "2019-12-31")
+"""
+import os
+import numpy as np
+import pandas as pd
+from src.regrid_project import config
+from src.regrid_project.datacube import acquisition_time
+
+
+def matrix_paths(site_name, var_name, root=None):
+    """(matrix, pixels sidecar, times sidecar) paths of one site/variable."""
+    base = os.path.join(root or config.PATH_TIME_MATRIX, f"{site_name}_{var_name}")
+    return base + ".npy", base + "_pixels.csv", base + "_times.csv"
+
+
+class TimeMatrixWriter:
+    """
+    Fills the matrix of one site/variable while the rasters are extracted.
+
+    Columns come from the file list (known before any raster is read) and rows
+    from the grid of the first raster, so every raster is written straight
+    into its column of the memory-mapped file; nothing is accumulated.
+    """
+
+    def __init__(self, site_name, var_name, filepaths, root=None):
+        self.paths = matrix_paths(site_name, var_name, root)
+        os.makedirs(os.path.dirname(self.paths[0]), exist_ok=True)
+
+        filenames = [os.path.basename(f) for f in filepaths]
+        times = [acquisition_time(name) for name in filenames]
+        order = sorted((t, name) for t, name in zip(times, filenames) if t is not None)
+        skipped = len(filenames) - len(order)
+        if skipped:
+            print(f"   [WARNING] Time matrix: {skipped} file(s) without acquisition time skipped")
+        self.times = pd.DataFrame({
+            'time': np.array([t for t, _ in order], dtype='datetime64[ns]'),
+            'filename': [name for _, name in order],
+        })
+        self.column_of = {name: col for col, name in enumerate(self.times['filename'])}
+
+        self.matrix = None
+        self.shape = None
+        self.pixels = None
+        self.row_of = {}  # grid -> flat index -> row (-1 for pixels not in the matrix)
+        self.row_by_id = None
+        self.tmp_paths = [path + ".tmp" for path in self.paths]
+
+    def _create(self, coords):
+        """Allocate the matrix with one row per pixel of the first grid."""
+        self.pixels = pd.DataFrame({
+            'pixel_id': coords.pixel_id,
+            'x': coords.x,
+            'y': coords.y,
+            'latitude': coords.latitude,
+            'longitude': coords.longitude,
+        })
+        self.row_by_id = {pixel_id: row for row, pixel_id in enumerate(coords.pixel_id)}
+        self.shape = (len(self.pixels), len(self.times))
+        # .npy header + raw data; the tmp name keeps an interrupted run from replacing the last matrix
+        self.matrix = np.lib.format.open_memmap(self.tmp_paths[0], mode='w+', dtype=np.float32, shape=self.shape)
+        self.matrix[:] = np.nan
+
+    def _rows(self, grid, coords):
+        """Matrix row of every pixel of `grid` (-1 where the pixel is not a row)."""
+        rows = self.row_of.get(grid)
+        if rows is None:
+            rows = np.array([self.row_by_id.get(p, -1) for p in coords.pixel_id], dtype=np.int64)
+            if (rows < 0).any():
+                print(f"   [WARNING] Time matrix: grid differs from the first raster, "
+                      f"{int((rows < 0).sum())} pixel(s) not stored")
+            self.row_of[grid] = rows
+        return rows
+
+    def add(self, result, coords):
+        """Write one raster (output of process_raster_file) into its column."""
+        filename, _, _, grid, index, values = result
+        col = self.column_of.get(filename)
+        if col is None:
+            return
+        if self.matrix is None:
+            self._create(coords)
+        rows = self._rows(grid, coords)[index]
+        keep = rows >= 0
+        self.matrix[rows[keep], col] = values[keep]
+
+    def close(self):
+        """Flush the matrix and sidecars and move them into place."""
+        if self.matrix is None:
+            self.abort()
+            return False
+        self.matrix.flush()
+        del self.matrix
+        self.matrix = None
+        self.pixels.rename_axis('row').to_csv(self.tmp_paths[1])
+        self.times.rename_axis('column').to_csv(self.tmp_paths[2])
+        for tmp_path, path in zip(self.tmp_paths, self.paths):
+            os.replace(tmp_path, path)
+        return True
+
+    def abort(self):
+        """Discard the partially written matrix (the previous one is kept)."""
+        self.matrix = None
+        for tmp_path in self.tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class TimeSeriesMatrix:
+    """Read-only access to a matrix written by TimeMatrixWriter."""
+
+    def __init__(self, site_name, var_name, root=None):
+        matrix_path, pixels_path, times_path = matrix_paths(site_name, var_name, root)
+        self.values = np.load(matrix_path, mmap_mode='r')
+        self.pixels = pd.read_csv(pixels_path, index_col='row')
+        times = pd.read_csv(times_path, index_col='column', parse_dates=['time'])
+        self.times = times['time'].to_numpy(dtype='datetime64[ns]')
+        self.filenames = times['filename'].to_numpy()
+        self.row_by_id = {pixel_id: row for row, pixel_id in enumerate(self.pixels['pixel_id'])}
+
+    def row(self, pixel_id):
+        """Matrix row of a pixel_id (KeyError if unknown)."""
+        return self.row_by_id[pixel_id]
+
+    def columns(self, start=None, end=None):
+        """
+        Column slice covering [start, end] (any datetime-like, both inclusive;
+        a date without time includes that whole day).
+        """
+        lo, hi = 0, len(self.times)
+        if start is not None:
+            lo = np.searchsorted(self.times, np.datetime64(pd.Timestamp(start)), 'left')
+        if end is not None:
+            end = pd.Timestamp(end)
+            if end == end.normalize():
+                hi = np.searchsorted(self.times, np.datetime64(end + pd.Timedelta(days=1)), 'left')
+            else:
+                hi = np.searchsorted(self.times, np.datetime64(end), 'right')
+        return slice(lo, hi)
+
+    def pixel_series(self, pixel_id, start=None, end=None, dropna=True):
+        """Time series of one pixel as a Series indexed by acquisition time."""
+        cols = self.columns(start, end)
+        series = pd.Series(np.array(self.values[self.row(pixel_id), cols]),
+                           index=pd.DatetimeIndex(self.times[cols], name='time'))
+        return series.dropna() if dropna else series
+
+    def date_range(self, start=None, end=None):
+        """All pixels for a date range: DataFrame (pixel_id x acquisition time)."""
+        cols = self.columns(start, end)
+        return pd.DataFrame(np.array(self.values[:, cols]),
+                            index=pd.Index(self.pixels['pixel_id'], name='pixel_id'),
+                            columns=pd.DatetimeIndex(self.times[cols], name='time'))